@@ -0,0 +1,118 @@
+import threading
+import time
+from queue import Queue
+from typing import Callable, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import CallbackContext, TypeHandler, Updater
+
+# reasons an update is not admitted
+DUPLICATE, THROTTLED, BUSY = 'duplicate', 'throttled', 'busy'
+
+REPLIES = {
+    THROTTLED: 'Please wait for the answer to your previous message.',
+    BUSY: 'The bot is very busy right now, please try again in a moment.',
+}
+
+
+class AdmissionControl:
+    """Decides which incoming updates the bot handles, before they are queued for the dispatcher.
+
+    A chat may have at most `max_in_flight` updates queued or being handled, a message identical to the chat's last
+    admitted one within `duplicate_window` seconds is dropped, and while more than `max_backlog` updates are waiting
+    new updates are turned away with a short reply, so the delay of the admitted ones stays bounded.
+    """
+
+    def __init__(self, max_in_flight: int = 3, duplicate_window: float = 2.0, max_backlog: int = 1000):
+        self.max_in_flight = max_in_flight
+        self.duplicate_window = duplicate_window
+        self.max_backlog = max_backlog
+        # updates handled outside the dispatcher and not finished yet, per chat and in total, e.g. by the async engine
+        self.pending: Optional[Callable[[int], int]] = None
+        self.backlog: Optional[Callable[[], int]] = None
+        self.admitted = 0
+        self.rejected = {DUPLICATE: 0, THROTTLED: 0, BUSY: 0}
+
+        self._in_flight: Dict[int, int] = {}
+        # chat id -> text and time of the last admitted message
+        self._last: Dict[int, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+
+    def admit(self, chat_id: int, text: Optional[str], queued: int) -> Optional[str]:
+        """Counts an update of a chat as in flight and returns None if it is admitted, otherwise returns why not.
+
+        `queued` is the number of updates waiting for the dispatcher.
+        """
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(chat_id)
+            if text is not None and last is not None and last[0] == text and now - last[1] < self.duplicate_window:
+                reason = DUPLICATE
+            elif self._in_flight.get(chat_id, 0) + (self.pending(chat_id) if self.pending else 0) >= \
+                    self.max_in_flight:
+                reason = THROTTLED
+            elif queued + (self.backlog() if self.backlog else 0) >= self.max_backlog:
+                reason = BUSY
+            else:
+                reason = None
+                self.admitted += 1
+                self._in_flight[chat_id] = self._in_flight.get(chat_id, 0) + 1
+                if text is not None:
+                    self._last[chat_id] = (text, now)
+            if reason is not None:
+                self.rejected[reason] += 1
+            if now - self._pruned_at > 60:
+                self._pruned_at = now
+                self._last = {chat_id: last for chat_id, last in self._last.items()
+                              if now - last[1] < self.duplicate_window}
+        return reason
+
+    def release(self, chat_id: int) -> None:
+        """Marks an admitted update of a chat as handled."""
+        with self._lock:
+            count = self._in_flight.get(chat_id, 0) - 1
+            if count > 0:
+                self._in_flight[chat_id] = count
+            else:
+                self._in_flight.pop(chat_id, None)
+
+
+class AdmissionQueue(Queue):
+    """Update queue of the dispatcher that only takes the updates admission control admits.
+
+    Rejected updates are answered through `reply(chat_id, text)`, except duplicates, which are dropped silently.
+    """
+
+    def __init__(self, control: AdmissionControl, reply: Callable[[int, str], None]):
+        super().__init__()
+        self.control = control
+        self.reply = reply
+
+    def put(self, item, block: bool = True, timeout: Optional[float] = None) -> None:
+        if isinstance(item, Update) and item.effective_chat is not None:
+            message = item.effective_message
+            chat_id = item.effective_chat.id
+            reason = self.control.admit(chat_id, message.text if message is not None else None, self.qsize())
+            if reason is not None:
+                if reason in REPLIES:
+                    self.reply(chat_id, REPLIES[reason])
+                return
+        super().put(item, block, timeout)
+
+
+def install(updater: Updater, control: AdmissionControl, reply: Callable[[int, str], None]) -> AdmissionQueue:
+    """Puts admission control in front of the updater's dispatcher, before any updates are received.
+
+    Every update is released again once all handler groups of the dispatcher have handled it.
+    """
+    queue = AdmissionQueue(control, reply)
+    updater.update_queue = updater.dispatcher.update_queue = queue
+
+    def release(update: Update, context: CallbackContext) -> None:
+        if update.effective_chat is not None:
+            control.release(update.effective_chat.id)
+
+    # the bot's handlers are all in the default group 0
+    updater.dispatcher.add_handler(TypeHandler(Update, release), group=1)
+    return queue
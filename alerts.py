@@ -0,0 +1,208 @@
+import heapq
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+
+class Alert:
+    """Notifies a chat once the price of an instrument rises above or falls below a threshold."""
+
+    __slots__ = ('alert_id', 'chat_id', 'isin', 'name', 'direction', 'price')
+
+    def __init__(self, chat_id: int, isin: str, name: str, direction: str, price: float, alert_id: str = None):
+        self.alert_id = alert_id or uuid.uuid4().hex
+        self.chat_id = chat_id
+        self.isin = isin
+        self.name = name
+        self.direction = direction
+        self.price = price
+
+    def describe(self) -> str:
+        return f'{self.name} ({self.isin}) {self.direction} €{self.price:,.2f}'
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Alert':
+        return cls(data['chat_id'], data['isin'], data['name'], data['direction'], data['price'],
+                   alert_id=data['alert_id'])
+
+
+class AlertBook:
+    """Price alerts of all chats, kept in two heaps per ISIN.
+
+    Alerts waiting for a rise are in a min-heap of their thresholds and alerts waiting for a fall in a max-heap,
+    so a new price only has to be compared with the top of each heap: checking a price costs O(log n) per alert that
+    fires, however many alerts are waiting. Removed alerts are skipped when they reach the top of their heap.
+    """
+
+    def __init__(self, max_per_chat: int = 20):
+        self.max_per_chat = max_per_chat
+        self.triggered = 0
+        self.persistence = None
+
+        self._alerts: Dict[str, Alert] = {}
+        self._by_chat: Dict[int, set] = {}
+        # isin -> heap of (threshold, alert id); thresholds of falling alerts are negated
+        self._above: Dict[str, List[Tuple[float, str]]] = {}
+        self._below: Dict[str, List[Tuple[float, str]]] = {}
+        # isin -> number of live alerts, so removed entries can be compacted away
+        self._live: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def resume(self, persistence) -> int:
+        """Saves alerts from now on and restores the alerts saved before the last restart."""
+        self.persistence = persistence
+        alerts = [Alert.from_dict(data) for data in persistence.load_alerts()]
+        with self._lock:
+            for alert in alerts:
+                self._insert(alert)
+        return len(alerts)
+
+    def add(self, alert: Alert) -> None:
+        """Adds an alert, raises a ValueError if its chat already has the maximum number of alerts."""
+        with self._lock:
+            if len(self._by_chat.get(alert.chat_id, ())) >= self.max_per_chat:
+                raise ValueError(f'You can have at most {self.max_per_chat} alerts.')
+            self._insert(alert)
+        if self.persistence is not None:
+            self.persistence.save_alert(alert.alert_id, alert.to_dict())
+
+    def remove(self, alert_id: str) -> Optional[Alert]:
+        with self._lock:
+            alert = self._alerts.pop(alert_id, None)
+            if alert is None:
+                return None
+            self._forget(alert)
+            # rebuild the heaps once they hold more removed alerts than live ones
+            live = self._live.get(alert.isin, 0)
+            if len(self._above.get(alert.isin, ())) + len(self._below.get(alert.isin, ())) > 2 * live + 16:
+                self._compact(alert.isin)
+        if self.persistence is not None:
+            self.persistence.delete_alert(alert_id)
+        return alert
+
+    def of_chat(self, chat_id: int) -> List[Alert]:
+        """Returns the alerts of a chat, sorted by instrument and threshold."""
+        with self._lock:
+            alerts = [self._alerts[alert_id] for alert_id in self._by_chat.get(chat_id, ())]
+        return sorted(alerts, key=lambda alert: (alert.name, alert.price))
+
+    def isins(self) -> List[str]:
+        """Returns the distinct ISINs that have alerts."""
+        with self._lock:
+            return list(self._live)
+
+    def check(self, isin: str, bid: float, ask: float) -> List[Alert]:
+        """Removes and returns the alerts of an ISIN that fire at the given quote.
+
+        Rising alerts fire once the bid reaches their threshold, falling alerts once the ask does, i.e. when the
+        instrument could be sold or bought at the alert's price.
+        """
+        fired = []
+        with self._lock:
+            above = self._above.get(isin)
+            while above and above[0][0] <= bid:
+                fired.append(heapq.heappop(above)[1])
+            below = self._below.get(isin)
+            while below and -below[0][0] >= ask:
+                fired.append(heapq.heappop(below)[1])
+            fired = [self._alerts.pop(alert_id) for alert_id in fired if alert_id in self._alerts]
+            for alert in fired:
+                self._forget(alert)
+            self.triggered += len(fired)
+        if self.persistence is not None:
+            for alert in fired:
+                self.persistence.delete_alert(alert.alert_id)
+        return fired
+
+    def __len__(self) -> int:
+        return len(self._alerts)
+
+    def _insert(self, alert: Alert) -> None:
+        self._alerts[alert.alert_id] = alert
+        self._by_chat.setdefault(alert.chat_id, set()).add(alert.alert_id)
+        self._live[alert.isin] = self._live.get(alert.isin, 0) + 1
+        if alert.direction == 'above':
+            heapq.heappush(self._above.setdefault(alert.isin, []), (alert.price, alert.alert_id))
+        else:
+            heapq.heappush(self._below.setdefault(alert.isin, []), (-alert.price, alert.alert_id))
+
+    def _forget(self, alert: Alert) -> None:
+        """Drops the bookkeeping of an alert that has been removed from `_alerts`; its heap entry stays behind."""
+        chat_alerts = self._by_chat.get(alert.chat_id)
+        if chat_alerts is not None:
+            chat_alerts.discard(alert.alert_id)
+            if not chat_alerts:
+                del self._by_chat[alert.chat_id]
+        self._live[alert.isin] -= 1
+        if not self._live[alert.isin]:
+            del self._live[alert.isin]
+            self._above.pop(alert.isin, None)
+            self._below.pop(alert.isin, None)
+
+    def _compact(self, isin: str) -> None:
+        for heaps in (self._above, self._below):
+            if isin in heaps:
+                heaps[isin] = [entry for entry in heaps[isin] if entry[1] in self._alerts]
+                heapq.heapify(heaps[isin])
+
+
+class Watchlists:
+    """Instruments every chat follows with /watch, as (isin, name) pairs in the order they were added."""
+
+    def __init__(self, max_per_chat: int = 20):
+        self.max_per_chat = max_per_chat
+        self.persistence = None
+
+        self._lists: Dict[int, List[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def resume(self, persistence) -> int:
+        """Saves watchlists from now on and restores the ones saved before the last restart."""
+        self.persistence = persistence
+        with self._lock:
+            for chat_id, data in persistence.load_watchlists():
+                self._lists[chat_id] = [tuple(entry) for entry in data]
+        return len(self._lists)
+
+    def add(self, chat_id: int, isin: str, name: str) -> bool:
+        """Adds an instrument to a chat's watchlist, returns False if it is already on it.
+
+        Raises a ValueError if the watchlist is full.
+        """
+        with self._lock:
+            entries = self._lists.setdefault(chat_id, [])
+            if any(entry[0] == isin for entry in entries):
+                return False
+            if len(entries) >= self.max_per_chat:
+                raise ValueError(f'You can watch at most {self.max_per_chat} instruments.')
+            entries.append((isin, name))
+            self._save(chat_id)
+        return True
+
+    def remove(self, chat_id: int, isin: str) -> bool:
+        with self._lock:
+            entries = self._lists.get(chat_id, [])
+            remaining = [entry for entry in entries if entry[0] != isin]
+            if len(remaining) == len(entries):
+                return False
+            if remaining:
+                self._lists[chat_id] = remaining
+            else:
+                self._lists.pop(chat_id, None)
+            self._save(chat_id)
+        return True
+
+    def get(self, chat_id: int) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._lists.get(chat_id, ()))
+
+    def _save(self, chat_id: int) -> None:
+        if self.persistence is None:
+            return
+        if chat_id in self._lists:
+            self.persistence.save_watchlist(chat_id, self._lists[chat_id])
+        else:
+            self.persistence.delete_watchlist(chat_id)
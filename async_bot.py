@@ -0,0 +1,472 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import aiohttp
+from telegram import Bot, Message, ReplyKeyboardRemove, ReplyMarkup, Update
+from telegram.ext import ConversationHandler, Handler
+
+from async_lemon import AsyncLemonClient
+import eventlog
+import metrics
+from persistence import SQLitePersistence
+from sessions import ChatSession
+from prefetch import Prefetch
+from trading_bot import (BYE_MESSAGE, ERROR_MESSAGE, INSTRUMENT_NOT_FOUND, ORDER_EXPIRED_MESSAGE, PROCESSING_MESSAGE,
+                         QUICKTRADE_ERROR_MESSAGE, QUICKTRADE_FORMAT, TIMEOUT_MESSAGE, Step, TradingBot, ask_quantity,
+                         begin_quicktrade, begin_trade, check_order_confirmation, check_quantity,
+                         check_quicktrade_confirmation, choose_instrument, choose_side, choose_type, complete_trade,
+                         confirm_quantity, confirm_quicktrade_order, idempotency_key, instrument_cache,
+                         instrument_index, lemon_session, list_instruments, order_watcher, parse_quicktrade,
+                         quote_feed, watch_trade_order)
+
+
+class AsyncTelegram:
+    """Non-blocking sender for Bot API requests over one shared connection pool."""
+
+    def __init__(self, token: str, base_url: Optional[str] = None, connections: int = 100):
+        self.url = f'{base_url or "https://api.telegram.org/bot"}{token}'
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections))
+
+    async def send_message(self, chat_id: int, text: str, reply_markup: Optional[ReplyMarkup] = None) -> None:
+        payload = {'chat_id': chat_id, 'text': text}
+        if reply_markup is not None:
+            payload['reply_markup'] = reply_markup.to_dict()
+        async with self.session.post(f'{self.url}/sendMessage', json=payload) as response:
+            response.raise_for_status()
+
+    async def close(self) -> None:
+        await self.session.close()
+
+
+class AsyncChat:
+    """Conversation state of one chat served by the async engine."""
+
+    def __init__(self, chat_id: int, telegram: AsyncTelegram, session: Optional[ChatSession] = None):
+        self.chat_id = chat_id
+        self.session = session or ChatSession(chat_id)
+        # handle the messages of a chat one at a time and in order
+        self.lock = asyncio.Lock()
+        self._telegram = telegram
+
+    @property
+    def state(self) -> Optional[int]:
+        return self.session.state
+
+    @state.setter
+    def state(self, state: Optional[int]) -> None:
+        self.session.state = state
+
+    async def reply(self, text: str, reply_markup: Optional[ReplyMarkup] = None) -> None:
+        await self._telegram.send_message(self.chat_id, text, reply_markup)
+
+    async def send(self, step: Step) -> int:
+        """Sends the reply of a step and returns its state."""
+        await self.reply(step.text, step.reply_markup)
+        return step.state
+
+
+AsyncHandler = Callable[[Message, AsyncChat], Awaitable[Optional[int]]]
+
+
+class AsyncTradingBot:
+    """Coroutine versions of the /trade and /quicktrade conversations of `TradingBot`.
+
+    The steps, replies and decisions are the ones of `TradingBot`, shared through the step helpers of trading_bot;
+    only the I/O differs. Orders, balances and positions go through the async lemon client, quotes through the shared
+    `QuoteFeed`, and the trade data of a chosen instrument is prefetched with `Prefetch`, as in the threaded handlers.
+    """
+
+    def __init__(self, engine: 'AsyncEngine'):
+        self.engine = engine
+
+    @property
+    def lemon(self) -> AsyncLemonClient:
+        return self.engine.lemon
+
+    async def find_instruments(self, search: str, instrument_type: str) -> list:
+        """Resolves instruments from the local index, then from the instrument cache and only then the API."""
+        instruments = instrument_index.search(search, instrument_type) or \
+            instrument_cache.get((search, instrument_type))
+        if instruments is None:
+            instruments = await self.lemon.search_instruments(search, instrument_type)
+            instrument_cache.set((search, instrument_type), instruments)
+        return instruments
+
+    def trade_data_calls(self, isin: str) -> dict:
+        """Returns the coroutine functions of the calls get_side needs, like trading_bot.trade_data_calls."""
+        return {
+            'quote': lambda: quote_feed.get_async(isin),
+            'balance': self.lemon.get_balance,
+            'positions': lambda: self.lemon.get_positions(isin),
+        }
+
+    async def discard_order(self, chat: AsyncChat) -> None:
+        """Cancels the order of a chat if it was created but never activated."""
+        order_id, chat.session.order_id = chat.session.order_id, None
+        if order_id is None:
+            return
+        try:
+            await self.lemon.cancel_order(order_id)
+        except Exception as e:
+            eventlog.error(e)
+
+    async def quick_trade(self, message: Message, chat: AsyncChat) -> int:
+        """Initiates quick trade sequence."""
+        return await chat.send(begin_quicktrade(chat.session))
+
+    async def perform_quicktrade(self, message: Message, chat: AsyncChat) -> int:
+        """Places quicktrade order."""
+        try:
+            trade = parse_quicktrade(message.text)
+            if trade is None:
+                return await chat.send(QUICKTRADE_FORMAT)
+
+            instrument_list = await self.find_instruments(trade.search, trade.instrument_type)
+            if len(instrument_list) == 0:
+                return await chat.send(INSTRUMENT_NOT_FOUND)
+
+            instrument = instrument_list[0]
+            order, latest_quote = await asyncio.gather(
+                self.lemon.create_order(instrument.isin, trade.side, trade.quantity,
+                                        idempotency=idempotency_key(chat.chat_id, message.message_id)),
+                quote_feed.get_async(instrument.isin),
+                return_exceptions=True,
+            )
+            return await chat.send(confirm_quicktrade_order(chat.session, trade, instrument, order, latest_quote))
+
+        except Exception as e:
+            eventlog.error(e)
+            # the order exists if only the quote failed, so it is cancelled instead of left open
+            await self.discard_order(chat)
+            return await chat.send(Step(ConversationHandler.END, QUICKTRADE_ERROR_MESSAGE))
+
+    async def confirm_quicktrade(self, message: Message, chat: AsyncChat) -> int:
+        """Activates quicktrade order."""
+        step = check_quicktrade_confirmation(chat.session, message.text)
+        if step is not None:
+            await self.discard_order(chat)
+            return await chat.send(step)
+
+        try:
+            await self.lemon.activate_order(chat.session.order_id)
+        except Exception as e:
+            eventlog.error(e)
+            return await chat.send(Step(ConversationHandler.END, QUICKTRADE_ERROR_MESSAGE))
+        order_id, chat.session.order_id = chat.session.order_id, None
+        await chat.reply(PROCESSING_MESSAGE)
+        order_watcher.watch(order_id, chat.chat_id, self.engine.bot)
+        return ConversationHandler.END
+
+    async def trade(self, message: Message, chat: AsyncChat) -> int:
+        """Retrieves financial instrument type."""
+        return await chat.send(begin_trade(chat.session))
+
+    async def get_search_query(self, message: Message, chat: AsyncChat) -> int:
+        """Prompts user to enter instrument name."""
+        return await chat.send(choose_type(chat.session, message.text))
+
+    async def get_instrument_name(self, message: Message, chat: AsyncChat) -> int:
+        """Searches for instrument and prompts user to select an instrument."""
+        chat.session.search_query = message.text.lower()
+        try:
+            instruments = await self.find_instruments(chat.session.search_query, chat.session.type)
+        except Exception as e:
+            eventlog.error(e)
+            return await chat.send(Step(ConversationHandler.END, ERROR_MESSAGE))
+        return await chat.send(list_instruments(chat.session, instruments))
+
+    async def get_isin(self, message: Message, chat: AsyncChat) -> int:
+        """Retrieves ISIN and prompts user to select side (buy/sell)."""
+        step = choose_instrument(chat.session, message.text)
+        if step.state == TradingBot.ISIN:
+            # start fetching what get_side needs while the user decides whether to buy or sell
+            isin = chat.session.isin
+            chat.session.prefetch = Prefetch(isin, self.trade_data_calls(isin), start=_start_task)
+        return await chat.send(step)
+
+    async def get_side(self, message: Message, chat: AsyncChat) -> int:
+        """Retrieves total balance (buy) or amount of shares owned (sell), most recent price and prompts user to
+        indicate quantity. """
+        isin = chat.session.isin
+        calls = choose_side(chat.session, message.text, self.trade_data_calls(isin))
+        prefetch, chat.session.prefetch = chat.session.prefetch or Prefetch(isin, {}, start=_start_task), None
+        try:
+            futures = prefetch.reuse(isin, calls)
+            results = dict(zip(futures, await asyncio.gather(*futures.values())))
+            step = ask_quantity(chat.session, results)
+        except Exception as e:
+            eventlog.error(e)
+            return await chat.send(Step(ConversationHandler.END, ERROR_MESSAGE))
+        return await chat.send(step)
+
+    async def get_quantity(self, message: Message, chat: AsyncChat) -> int:
+        """Processes quantity (handles error if purchase/sale not possible), places order (if possible) and prompts
+        user to confirm order. """
+        step = check_quantity(chat.session, message.text)
+        if step is not None:
+            return await chat.send(step)
+
+        try:
+            order = await self.lemon.create_order(chat.session.isin, chat.session.side, int(chat.session.quantity),
+                                                  idempotency=idempotency_key(chat.chat_id, message.message_id))
+            chat.session.order_id = order.id
+        except Exception as e:
+            eventlog.error(e)
+            return await chat.send(Step(ConversationHandler.END, ERROR_MESSAGE))
+        return await chat.send(confirm_quantity(chat.session))
+
+    async def confirm_order(self, message: Message, chat: AsyncChat) -> int:
+        """Activates order (if applicable) and lets the order watcher report the execution price."""
+        step = check_order_confirmation(chat.session, message.text)
+        if step is not None:
+            await self.discard_order(chat)
+            return await chat.send(step)
+
+        try:
+            await self.lemon.activate_order(chat.session.order_id)
+        except Exception as e:
+            eventlog.error(e)
+            return await chat.send(Step(ConversationHandler.END, ERROR_MESSAGE))
+
+        order_id, chat.session.order_id = chat.session.order_id, None
+        await chat.reply(PROCESSING_MESSAGE)
+        watch_trade_order(order_id, chat.chat_id, self.engine.bot)
+        return TradingBot.CONFIRMATION
+
+    async def complete_order(self, message: Message, chat: AsyncChat) -> int:
+        """Prompts user to continue or end conversation."""
+        return await chat.send(complete_trade(chat.session, message.text))
+
+    async def cancel(self, message: Message, chat: AsyncChat) -> int:
+        """Cancels and ends the conversation."""
+        await self.discard_order(chat)
+        return await chat.send(Step(ConversationHandler.END, BYE_MESSAGE, ReplyKeyboardRemove()))
+
+
+def _start_task(call: Callable[[], Awaitable]) -> asyncio.Future:
+    return asyncio.ensure_future(call())
+
+
+def _is_text(text: str) -> bool:
+    return not text.startswith('/')
+
+
+def _command(text: str) -> str:
+    """Returns the command of a message like '/trade@lemon_bot', or an empty string."""
+    parts = text[1:].split()
+    return parts[0].split('@')[0] if text.startswith('/') and parts else ''
+
+
+class AsyncEngine:
+    """Runs the /trade and /quicktrade conversations as coroutines on an event loop in a background thread.
+
+    Updates are still received by python-telegram-bot; `AsyncEngineHandler` hands them over without blocking a
+    dispatcher thread, so the number of concurrent conversations is no longer bounded by the worker count.
+    """
+
+    def __init__(self, bot: Bot, token: str, base_url: Optional[str] = None, connections: int = 100,
+                 persistence: Optional[SQLitePersistence] = None):
+        self.bot = bot
+        self.token = token
+        self.base_url = base_url
+        self.connections = connections
+        # conversations are saved after every step and restored by start()
+        self.persistence = persistence
+        self.loop = asyncio.new_event_loop()
+        self.chats: Dict[int, AsyncChat] = {}
+        # chat id -> number of updates submitted to the loop but not handled yet
+        self._submitted: Dict[int, int] = {}
+        self._submitted_lock = threading.Lock()
+        self.lemon: Optional[AsyncLemonClient] = None
+        self.telegram: Optional[AsyncTelegram] = None
+
+        handlers = self.handlers = AsyncTradingBot(self)
+        self.entry_points: Dict[str, AsyncHandler] = {
+            'trade': handlers.trade,
+            'quicktrade': handlers.quick_trade,
+        }
+        self.fallbacks: Dict[str, AsyncHandler] = {'cancel': handlers.cancel, 'end': handlers.cancel}
+        self.states = {
+            TradingBot.TYPE: (re.compile('^(Stock|stock|ETF|etf)$').match, handlers.get_search_query),
+            TradingBot.REPLY: (_is_text, handlers.get_instrument_name),
+            TradingBot.NAME: (_is_text, handlers.get_isin),
+            TradingBot.ISIN: (_is_text, handlers.get_side),
+            TradingBot.SIDE: (_is_text, handlers.get_quantity),
+            TradingBot.QUANTITY: (_is_text, handlers.confirm_order),
+            TradingBot.CONFIRMATION: (lambda text: True, handlers.complete_order),
+            TradingBot.QUICKTRADE: (_is_text, handlers.perform_quicktrade),
+            TradingBot.QUICK: (_is_text, handlers.confirm_quicktrade),
+        }
+
+    def start(self) -> None:
+        """Starts the event loop thread and opens the shared HTTP connection pools."""
+        threading.Thread(target=self.loop.run_forever, name='async-engine', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._connect(), self.loop).result()
+        if self.persistence is not None:
+            asyncio.run_coroutine_threadsafe(self._recover(), self.loop).result()
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._disconnect(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _connect(self) -> None:
+        self.lemon = AsyncLemonClient(os.environ.get('TRADING_API_KEY'), os.environ.get('DATA_API_KEY'),
+                                      connections=self.connections, trading_url=os.getenv('LEMON_TRADING_URL'),
+                                      market_data_url=os.getenv('LEMON_MARKET_DATA_URL'), transport=lemon_session)
+        self.telegram = AsyncTelegram(self.token, self.base_url, connections=self.connections)
+
+    async def _recover(self) -> None:
+        for chat_id, data in self.persistence.load_sessions():
+            session = ChatSession.from_dict(chat_id, data)
+            if session.state is not None:
+                self.chats[chat_id] = AsyncChat(chat_id, self.telegram, session)
+        eventlog.event('conversations_restored', conversations=len(self.chats))
+
+    async def _disconnect(self) -> None:
+        await self.lemon.close()
+        await self.telegram.close()
+
+    def end(self, chat_ids: set) -> None:
+        """Ends the conversations of the given chats without a reply and cancels their unconfirmed orders, called from
+        any thread.
+
+        Returns right away; updates submitted afterwards are handled once the conversations have ended.
+        """
+        asyncio.run_coroutine_threadsafe(self._end(chat_ids), self.loop)
+
+    async def _end(self, chat_ids: set) -> None:
+        chats = [self.chats.pop(chat_id) for chat_id in chat_ids if chat_id in self.chats]
+        for chat in chats:
+            if self.persistence is not None:
+                self.persistence.delete_session(chat.chat_id)
+            await self.handlers.discard_order(chat)
+
+    def sweep(self, timeout: Callable[[int], float]) -> None:
+        """Ends conversations that were idle for longer than `timeout(state)` seconds, called from any thread."""
+        asyncio.run_coroutine_threadsafe(self._sweep(timeout), self.loop).result()
+
+    async def _sweep(self, timeout: Callable[[int], float]) -> None:
+        now = time.monotonic()
+        with self._submitted_lock:
+            busy = set(self._submitted)
+        expired = [chat for chat in self.chats.values()
+                   if chat.chat_id not in busy and now - chat.session.last_active > timeout(chat.state)]
+        for chat in expired:
+            del self.chats[chat.chat_id]
+            if self.persistence is not None:
+                self.persistence.delete_session(chat.chat_id)
+            text = TIMEOUT_MESSAGE if chat.session.order_id is None else ORDER_EXPIRED_MESSAGE
+            await self.handlers.discard_order(chat)
+            try:
+                await chat.reply(text, reply_markup=ReplyKeyboardRemove())
+            except Exception as e:
+                eventlog.error(e)
+
+        memory = sum(chat.session.size() for chat in self.chats.values())
+        eventlog.event('async_conversations_swept', live=len(self.chats), kib=round(memory / 1024, 1),
+                       expired=len(expired))
+
+    def route(self, state: Optional[int], text: str) -> Optional[AsyncHandler]:
+        """Returns the handler for a message in a chat in `state`, or None if the engine does not handle it."""
+        if text.startswith('/'):
+            command = _command(text)
+            if command in self.entry_points:
+                return self.entry_points[command]
+            if state is not None and command in self.fallbacks:
+                return self.fallbacks[command]
+        if state is not None:
+            matches, handler = self.states[state]
+            if matches(text):
+                return handler
+        return None
+
+    def accepts(self, chat_id: int, text: str) -> bool:
+        """Returns whether the engine handles a message, called from the dispatcher thread."""
+        chat = self.chats.get(chat_id)
+        if self.route(chat.state if chat is not None else None, text) is not None:
+            return True
+        # while earlier updates of the chat are still being handled its next state is not known yet, so accept
+        # everything that could continue the conversation and route it once it is the chat's turn
+        with self._submitted_lock:
+            busy = chat_id in self._submitted
+        return busy and (_is_text(text) or _command(text) in self.fallbacks)
+
+    def pending(self, chat_id: Optional[int] = None) -> int:
+        """Returns the number of updates submitted and not handled yet, of one chat or of all chats."""
+        with self._submitted_lock:
+            if chat_id is None:
+                return sum(self._submitted.values())
+            return self._submitted.get(chat_id, 0)
+
+    def submit(self, update: Update) -> None:
+        """Schedules an update on the event loop and returns immediately."""
+        chat_id = update.effective_chat.id
+        with self._submitted_lock:
+            self._submitted[chat_id] = self._submitted.get(chat_id, 0) + 1
+        asyncio.run_coroutine_threadsafe(self._handle(chat_id, update.effective_message), self.loop)
+
+    async def _handle(self, chat_id: int, message: Message) -> None:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = AsyncChat(chat_id, self.telegram)
+
+        try:
+            async with chat.lock:
+                chat.session.last_active = time.monotonic()
+                # the state may have changed since the update was routed
+                handler = self.route(chat.state, message.text)
+                if handler is None:
+                    return
+                token = eventlog.begin(handler.__name__, chat_id)
+                started = time.perf_counter()
+                error = None
+                try:
+                    state = await handler(message, chat)
+                except Exception as e:
+                    error = e
+                    metrics.handler_errors.inc(handler.__name__)
+                    state = ConversationHandler.END
+                seconds = time.perf_counter() - started
+                metrics.handler_seconds.observe(seconds, handler.__name__)
+                eventlog.end(token, seconds, state, error)
+
+                if state == ConversationHandler.END:
+                    chat.state = None
+                    chat.session.clear()
+                    if self.persistence is not None:
+                        self.persistence.delete_session(chat_id)
+                elif state is not None:
+                    chat.state = state
+                    if self.persistence is not None:
+                        self.persistence.save_session(chat_id, chat.session.to_dict())
+        finally:
+            with self._submitted_lock:
+                self._submitted[chat_id] -= 1
+                if self._submitted[chat_id] == 0:
+                    del self._submitted[chat_id]
+                    # forget chats without a conversation so memory only grows with active conversations
+                    if chat.state is None:
+                        self.chats.pop(chat_id, None)
+
+
+class AsyncEngineHandler(Handler):
+    """Passes the updates the async engine is responsible for to it, without blocking the dispatcher."""
+
+    def __init__(self, engine: AsyncEngine):
+        super().__init__(lambda update, context: None)
+        self.engine = engine
+
+    def check_update(self, update: object) -> bool:
+        if not isinstance(update, Update) or update.effective_chat is None:
+            return False
+        message = update.effective_message
+        if message is None or not message.text:
+            return False
+        return self.engine.accepts(update.effective_chat.id, message.text)
+
+    def handle_update(self, update, dispatcher, check_result, context=None) -> None:
+        self.engine.submit(update)
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from instrument_cache import TTLCache
+import metrics
+from transport import (DEFAULT_TIMEOUT, ENDPOINT_TIMEOUTS, RETRY_STATUSES, STALE_ENDPOINTS, CircuitOpenError,
+                       TransportSession, endpoint_of)
+
+TRADING_URLS = {
+    'paper': 'https://paper-trading.lemon.markets/v1',
+    'money': 'https://trading.lemon.markets/v1',
+}
+MARKET_DATA_URL = 'https://data.lemon.markets/v1'
+
+
+def _loads(text: str):
+    # expose response fields as attributes, like the results of the synchronous lemon client
+    return json.loads(text, object_hook=lambda fields: SimpleNamespace(**fields))
+
+
+class AsyncLemonClient:
+    """Coroutine-based client for the lemon.markets endpoints used by the bot.
+
+    All requests share one aiohttp session, and with it one pool of keep-alive connections. Requests follow the
+    policy of `transport`, the `TransportSession` of the synchronous client: the same per-endpoint timeouts, jittered
+    retries of reads, stale market data while an API is unavailable, and the same circuit breakers, so both engines
+    fail fast together. The client must be created and used inside a running event loop.
+    """
+
+    def __init__(self, trading_api_token: Optional[str], market_data_api_token: Optional[str], env: str = 'paper',
+                 connections: int = 100, trading_url: Optional[str] = None, market_data_url: Optional[str] = None,
+                 transport: Optional[TransportSession] = None):
+        self.trading_url = (trading_url or TRADING_URLS[env]).rstrip('/')
+        self.market_data_url = (market_data_url or MARKET_DATA_URL).rstrip('/')
+        self.transport = transport or TransportSession()
+        self._trading_headers = {'Authorization': f'Bearer {trading_api_token}'}
+        self._market_data_headers = {'Authorization': f'Bearer {market_data_api_token}'}
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=connections, keepalive_timeout=60),
+        )
+        # url and params -> last successful result of a stale-tolerant endpoint
+        self._last_good = TTLCache(maxsize=2048, ttl=self.transport.stale_ttl)
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    async def _request(self, method: str, url: str, headers: dict, **kwargs):
+        operation = metrics.operation(method, urlsplit(url).path)
+        started = time.perf_counter()
+        try:
+            return await self._send(method, url, headers, **kwargs)
+        except Exception:
+            metrics.upstream_errors.inc(operation)
+            raise
+        finally:
+            metrics.upstream_seconds.observe(time.perf_counter() - started, operation)
+
+    async def _send(self, method: str, url: str, headers: dict, **kwargs):
+        parts = urlsplit(url)
+        endpoint = endpoint_of(parts.path)
+        connect, read = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        breaker = self.transport.breaker(parts.netloc)
+        attempts = self.transport.attempts(method)
+        key = f'{url}?{kwargs.get("params")}' if method == 'GET' and endpoint in STALE_ENDPOINTS else None
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                return self._stale_or_raise(key, CircuitOpenError(f'{parts.netloc} is unavailable, failing fast'))
+            status = None
+            try:
+                async with self.session.request(method, url, headers=headers, timeout=timeout, **kwargs) as response:
+                    result = await response.json(loads=_loads) if response.ok else None
+                    status = response.status
+                    response.raise_for_status()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES
+                if not retryable:
+                    raise
+                if attempt == attempts - 1:
+                    return self._stale_or_raise(key, e)
+            else:
+                if key is not None:
+                    self._last_good.set(key, result)
+                return result
+            finally:
+                # settle a half-open trial whatever happened, like TransportSession does
+                if status is not None and status < 500:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            await asyncio.sleep(self.transport.backoff_delay(attempt))
+
+    def _stale_or_raise(self, key: Optional[str], error: Exception):
+        stale = self._last_good.get(key) if key is not None else None
+        if stale is None:
+            raise error
+        self.transport.stale_served += 1
+        return stale
+
+    async def _market_data(self, path: str, params):
+        return await self._request('GET', f'{self.market_data_url}{path}', self._market_data_headers, params=params)
+
+    async def _trading(self, method: str, path: str, **kwargs):
+        return await self._request(method, f'{self.trading_url}{path}', self._trading_headers, **kwargs)
+
+    async def search_instruments(self, search: str, instrument_type: str) -> list:
+        return (await self._market_data('/instruments', {'search': search, 'type': instrument_type})).results
+
+    async def get_instruments(self, isins: List[str]) -> list:
+        return (await self._market_data('/instruments', [('isin', isin) for isin in isins])).results
+
+    async def get_latest_quotes(self, isins: List[str]) -> list:
+        return (await self._market_data('/quotes/latest', [('isin', isin) for isin in isins])).results
+
+    async def get_balance(self) -> int:
+        return (await self._trading('GET', '/account')).results.balance
+
+    async def get_positions(self, isin: Optional[str] = None) -> list:
+        return (await self._trading('GET', '/positions', params={'isin': isin} if isin else {})).results
+
+    async def create_order(self, isin: str, side: str, quantity: int, idempotency: Optional[str] = None):
+        # same expiry as the synchronous client's expires_at=0
+        order = {'isin': isin, 'side': side, 'quantity': quantity, 'expires_at': 'P0D'}
+        if idempotency is not None:
+            order['idempotency'] = idempotency
+        return (await self._trading('POST', '/orders', json=order)).results
+
+    async def activate_order(self, order_id: str):
+        return await self._trading('POST', f'/orders/{order_id}/activate')
+
+    async def get_order(self, order_id: str):
+        return (await self._trading('GET', f'/orders/{order_id}')).results
+
+    async def cancel_order(self, order_id: str):
+        return await self._trading('DELETE', f'/orders/{order_id}')
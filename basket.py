@@ -0,0 +1,69 @@
+from typing import List, Tuple
+
+FORMAT = '\'buy 5 apple stock\''
+
+
+def parse_order(line: str) -> dict:
+    """Parses one basket line in the /quicktrade format, raises a ValueError if it does not fit."""
+    elements = line.split()
+    if len(elements) != 4:
+        raise ValueError(f'expected the format {FORMAT}')
+    side = elements[0].lower()
+    if side not in ('buy', 'sell'):
+        raise ValueError('the order must start with buy or sell')
+    try:
+        quantity = int(elements[1])
+    except ValueError:
+        raise ValueError('the quantity must be a whole number') from None
+    if quantity <= 0:
+        raise ValueError('the quantity must be positive')
+    instrument_type = 'stock' if elements[3].lower().startswith('share') else elements[3].lower()
+    return {
+        'line': line,
+        'side': side,
+        'quantity': quantity,
+        'search': elements[2].lower(),
+        'type': instrument_type,
+    }
+
+
+def parse_basket(text: str, max_orders: int) -> Tuple[List[dict], List[str]]:
+    """Parses one order per line and returns the orders and a message for every line that could not be parsed."""
+    orders = []
+    errors = []
+    for line in [line.strip() for line in text.splitlines() if line.strip()]:
+        try:
+            orders.append(parse_order(line))
+        except ValueError as e:
+            errors.append(f'\'{line}\': {e}')
+    if len(orders) > max_orders:
+        errors.append(f'Only the first {max_orders} orders are placed at once.')
+        orders = orders[:max_orders]
+    return orders, errors
+
+
+def describe(order: dict) -> str:
+    """Returns one line of the confirmation for an order that was created, rejected or failed."""
+    if order.get('error'):
+        return f'\'{order["line"]}\': {order["error"]}'
+    text = f'{order["side"]} {order["quantity"]} {order["name"]}'
+    if order.get('status') == 'rejected':
+        return f'{text}: rejected'
+    if order.get('price'):
+        text += f' at €{order["price"]:,.2f} per share (€{order["quantity"] * order["price"]:,.2f})'
+    return text
+
+
+def summarise(orders: List[dict], errors: List[str]) -> str:
+    """Returns the combined confirmation of a basket."""
+    placed = [order for order in orders if order.get('order_id') is not None]
+    lines = [f'{number}. {describe(order)}' for number, order in enumerate(orders, 1)]
+    lines.extend(errors)
+
+    totals = {}
+    for order in placed:
+        totals[order['side']] = totals.get(order['side'], 0.0) + order['quantity'] * (order.get('price') or 0.0)
+    if totals:
+        lines.append('')
+        lines.append(', '.join(f'{side}: €{total:,.2f}' for side, total in sorted(totals.items())))
+    return '\n'.join(lines)
@@ -0,0 +1,307 @@
+"""Local stand-in for the lemon.markets market data and trading APIs, used to benchmark the bot without an account.
+
+It serves the endpoints the bot calls, with a fixed set of instruments, deterministic quotes, an account with
+enough balance for any benchmark and a few positions. Every request waits `--latency` seconds (give or take
+`--jitter`) and activated orders are executed `--fill-delay` seconds after their activation.
+
+    python benchmarks/fake_lemon.py --port 8082 --latency 0.05
+    LEMON_MARKET_DATA_URL=http://127.0.0.1:8082/v1 LEMON_TRADING_URL=http://127.0.0.1:8082/v1 python main.py
+
+benchmarks/load_test.py starts one in its own process unless it is given the URL of a running one.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+# (isin, name, symbol, type) of the instruments the bot's scripts and /moon ask for
+KNOWN_INSTRUMENTS = [
+    ('US0378331005', 'APPLE INC.', 'AAPL', 'stock'),
+    ('US5949181045', 'MICROSOFT CORP.', 'MSFT', 'stock'),
+    ('US0231351067', 'AMAZON.COM INC.', 'AMZN', 'stock'),
+    ('US36467W1099', 'GAMESTOP CORP.', 'GME', 'stock'),
+    ('CA09228F1036', 'BLACKBERRY LTD', 'BB', 'stock'),
+    ('US18914F1030', 'CLOVER HEALTH INVESTMENTS CORP.', 'CLOV', 'stock'),
+    ('US00165C1045', 'AMC ENTERTAINMENT HOLDINGS INC.', 'AMC', 'stock'),
+    ('US69608A1088', 'PALANTIR TECHNOLOGIES INC.', 'PLTR', 'stock'),
+    ('US21077C1071', 'CONTEXTLOGIC INC.', 'WISH', 'stock'),
+    ('US62914V1061', 'NIO INC.', 'NIO', 'stock'),
+    ('US88160R1014', 'TESLA INC.', 'TSLA', 'stock'),
+    ('US88688T1007', 'TILRAY BRANDS INC.', 'TLRY', 'stock'),
+    ('FI0009000681', 'NOKIA OYJ', 'NOK', 'stock'),
+    ('IE00B4L5Y983', 'ISHARES CORE MSCI WORLD UCITS ETF', 'EUNL', 'etf'),
+    ('IE00B5BMR087', 'ISHARES CORE S&P 500 UCITS ETF', 'SXR8', 'etf'),
+]
+
+
+def now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def price_of(isin: str) -> float:
+    """Returns the same price in euros for an ISIN on every run, between 5 and 505."""
+    return round(5 + zlib.crc32(isin.encode()) % 50000 / 100, 2)
+
+
+def make_instruments(count: int) -> List[dict]:
+    """Returns the known instruments followed by synthetic ones, `count` in total."""
+    rows = list(KNOWN_INSTRUMENTS)
+    for index in range(max(count - len(rows), 0)):
+        instrument_type = 'etf' if index % 5 == 0 else 'stock'
+        rows.append((f'XF{index:09d}0', f'SYNTHETIC {instrument_type.upper()} {index:05d}', f'S{index:05d}',
+                     instrument_type))
+    return [{
+        'isin': isin,
+        'wkn': isin[3:9],
+        'name': name,
+        'title': name,
+        'symbol': symbol,
+        'type': instrument_type,
+        'venues': [{'name': 'Fake Exchange', 'title': 'Fake', 'mic': 'XMUN', 'is_open': True, 'tradable': True,
+                    'currency': 'EUR'}],
+    } for isin, name, symbol, instrument_type in rows[:count]]
+
+
+class FakeLemon(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8082, latency: float = 0.0, jitter: float = 0.0,
+                 fill_delay: float = 0.5, instruments: int = 2000, positions: int = 5, mic: str = 'XMUN'):
+        super().__init__((host, port), _LemonRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.fill_delay = fill_delay
+        self.mic = mic
+        self.requests = 0
+
+        self.instruments = make_instruments(instruments)
+        self.by_isin = {instrument['isin']: instrument for instrument in self.instruments}
+        self.positions = [{
+            'isin': instrument['isin'],
+            'isin_title': instrument['title'],
+            'quantity': 10,
+            'buy_price_avg': int(price_of(instrument['isin']) * 9000),
+            'estimated_price': int(price_of(instrument['isin']) * 10000),
+            'estimated_price_total': int(price_of(instrument['isin']) * 100000),
+        } for instrument in self.instruments[:positions]]
+
+        # order id -> order, as returned by GET /orders/{id}, and idempotency key -> order id
+        self._orders: Dict[str, dict] = {}
+        self._idempotency: Dict[str, str] = {}
+        self._order_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def delay(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def handle_request_of(self, method: str, path: str, query: Dict[str, List[str]], body: dict) -> Tuple[int, dict]:
+        """Returns the status and JSON response of an API request."""
+        with self._lock:
+            self.requests += 1
+        # the first segment is the API version
+        segments = [segment for segment in path.split('/') if segment][1:]
+
+        if method == 'GET' and segments == ['instruments']:
+            return 200, self.get_instruments(query)
+        if method == 'GET' and segments == ['quotes', 'latest']:
+            isins = _values(query, 'isin')
+            results = [{'isin': isin, 'mic': self.mic, 'b_v': 1000, 'a_v': 1000, 'b': price_of(isin),
+                        'a': round(price_of(isin) * 1.001, 2), 't': now()} for isin in isins if isin in self.by_isin]
+            return 200, _page(results, query)
+        if method == 'GET' and segments == ['venues']:
+            today = datetime.date.today()
+            venue = {'name': 'Fake Exchange', 'title': 'Fake', 'mic': self.mic, 'is_open': True,
+                     'opening_hours': {'start': '00:00', 'end': '23:59', 'timezone': 'UTC'},
+                     'opening_days': [(today + datetime.timedelta(days=day)).isoformat() for day in range(-1, 14)]}
+            return 200, _page([venue], query)
+        if method == 'GET' and segments == ['account']:
+            return 200, {'time': now(), 'mode': 'paper', 'results': {
+                'created_at': now(), 'account_id': 'acc_fake', 'mode': 'paper', 'balance': 1_000_000 * 10000,
+                'cash_to_invest': 1_000_000 * 10000, 'cash_to_withdraw': 0, 'trading_plan': 'go', 'data_plan': 'go'}}
+        if method == 'GET' and segments == ['positions']:
+            isins = _values(query, 'isin')
+            positions = [position for position in self.positions if not isins or position['isin'] in isins]
+            return 200, {'mode': 'paper', **_page(positions, query)}
+        if method == 'POST' and segments == ['orders']:
+            return self.create_order(body)
+        if segments[:1] == ['orders'] and len(segments) > 1:
+            order_id, action = segments[1], segments[2:]
+            if method == 'GET' and not action:
+                return self.order_response(order_id, lambda order: None)
+            if method == 'DELETE' and not action:
+                return self.order_response(order_id, self.cancel)
+            if method == 'POST' and action == ['activate']:
+                return self.order_response(order_id, self.activate)
+        return 404, _error('not_found', f'{method} {path} is not served by the fake API')
+
+    def get_instruments(self, query: Dict[str, List[str]]) -> dict:
+        instruments = self.instruments
+        isins = _values(query, 'isin')
+        if isins:
+            instruments = [self.by_isin[isin] for isin in isins if isin in self.by_isin]
+        search = query.get('search', [''])[0].lower()
+        if search:
+            instruments = [instrument for instrument in instruments
+                           if search in instrument['name'].lower() or search in instrument['symbol'].lower()]
+        types = _values(query, 'type')
+        if types:
+            instruments = [instrument for instrument in instruments if instrument['type'] in types]
+        return _page(instruments, query)
+
+    def create_order(self, body: dict) -> Tuple[int, dict]:
+        instrument = self.by_isin.get(body.get('isin'))
+        if instrument is None:
+            return 400, _error('instrument_not_found', 'Instrument not found')
+        quantity = int(body.get('quantity') or 0)
+        price = int(price_of(instrument['isin']) * 10000)
+        created = now()
+        with self._lock:
+            # an order created again with the same idempotency key is the order created the first time
+            if body.get('idempotency') in self._idempotency:
+                order = self._orders[self._idempotency[body['idempotency']]]
+                return 200, {'time': now(), 'mode': 'paper', 'results': _public(order)}
+            order = {
+                'id': f'ord_fake{next(self._order_ids):012d}',
+                'isin': instrument['isin'],
+                'isin_title': instrument['title'],
+                'created_at': created,
+                'expires_at': (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)).isoformat(),
+                'side': body.get('side'),
+                'quantity': quantity,
+                'estimated_price': price,
+                'estimated_price_total': price * quantity,
+                'venue': self.mic,
+                'status': 'inactive',
+                'type': 'market',
+                'executed_quantity': 0,
+                'executed_price': 0,
+                'idempotency': body.get('idempotency'),
+                'regulatory_information': {},
+                # monotonic time the order is executed at once activated
+                '_fills_at': None,
+            }
+            self._orders[order['id']] = order
+            if order['idempotency']:
+                self._idempotency[order['idempotency']] = order['id']
+        return 200, {'time': now(), 'mode': 'paper', 'results': _public(order)}
+
+    def order_response(self, order_id: str, change) -> Tuple[int, dict]:
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is None:
+                return 404, _error('order_not_found', 'Order not found')
+            if order['_fills_at'] is not None and order['status'] == 'activated' and \
+                    time.monotonic() >= order['_fills_at']:
+                order.update(status='executed', executed_quantity=order['quantity'],
+                             executed_price=order['estimated_price'], executed_at=now())
+            error = change(order)
+            if error is not None:
+                return 400, _error(error, f'Order is {order["status"]}')
+            return 200, {'time': now(), 'mode': 'paper', 'status': 'ok', 'results': _public(order)}
+
+    def activate(self, order: dict) -> Optional[str]:
+        if order['status'] != 'inactive':
+            return 'order_not_inactive'
+        order.update(status='activated', activated_at=now(), _fills_at=time.monotonic() + self.fill_delay)
+        return None
+
+    @staticmethod
+    def cancel(order: dict) -> Optional[str]:
+        if order['status'] in ('executed', 'canceled'):
+            return 'order_not_cancelable'
+        order.update(status='canceled', cancelled_at=now())
+        return None
+
+
+def _values(query: Dict[str, List[str]], name: str) -> List[str]:
+    # lists arrive as repeated parameters, but accept comma separated ones as well
+    return [value for values in query.get(name, []) for value in values.split(',') if value]
+
+
+def _page(results: list, query: Dict[str, List[str]]) -> dict:
+    limit = int(query.get('limit', ['100'])[0])
+    page = int(query.get('page', ['1'])[0])
+    return {'time': now(), 'results': results[(page - 1) * limit:page * limit], 'total': len(results),
+            'page': page, 'pages': max(math.ceil(len(results) / limit), 1)}
+
+
+def _public(order: dict) -> dict:
+    return {key: value for key, value in order.items() if not key.startswith('_')}
+
+
+def _error(code: str, message: str) -> dict:
+    return {'time': now(), 'mode': 'paper', 'status': 'error', 'error_code': code, 'error_message': message}
+
+
+class _LemonRequestHandler(BaseHTTPRequestHandler):
+    server: FakeLemon
+    # keep connections alive like the real API, so the bot's connection pool is exercised, and send the body right
+    # after the headers instead of waiting for the client's delayed ACK
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _handle(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}') if length else {}
+        except ValueError:
+            body = {}
+        parts = urlsplit(self.path)
+        self.server.delay()
+        status, response = self.server.handle_request_of(self.command, parts.path, parse_qs(parts.query), body)
+
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds every API request takes')
+    parser.add_argument('--jitter', type=float, default=0.5, help='share the latency varies by, up or down')
+    parser.add_argument('--fill-delay', type=float, default=0.5, help='seconds from activation to execution')
+    parser.add_argument('--instruments', type=int, default=2000, help='number of instruments')
+    parser.add_argument('--positions', type=int, default=5, help='number of positions in the account')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = FakeLemon(args.host, args.port, latency=args.latency, jitter=args.jitter, fill_delay=args.fill_delay,
+                     instruments=args.instruments, positions=args.positions)
+    print(f'Fake lemon.markets API listening on {fake.url}')
+    try:
+        fake.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f'Served {fake.requests} requests.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Local stand-in for the Telegram Bot API, used to measure update-to-reply latency of main.py.
+
+Start the fake first, then run the bot against it in either mode:
+
+    python benchmarks/fake_telegram.py --chats 50
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot BOT_TOKEN=123:fake python main.py
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot BOT_TOKEN=123:fake BOT_MODE=webhook \\
+        WEBHOOK_URL=http://127.0.0.1:8443/telegram WEBHOOK_SECRET=secret python main.py
+
+In polling mode the fake answers the bot's getUpdates long polls. Once the bot registers a URL with setWebhook,
+updates are POSTed to that URL with the registered secret token instead.
+"""
+import argparse
+import itertools
+import json
+import statistics
+import threading
+import time
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8081, deliver: Optional[Callable[[dict], None]] = None):
+        super().__init__((host, port), _BotApiRequestHandler)
+        # hands updates to the bot directly instead of through getUpdates or the webhook, see load_test.py
+        self.deliver = deliver
+        self.webhook_url = None
+        self.secret_token = None
+        self.connected = threading.Event()
+
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates = deque()
+        # chat id -> time the last update was sent, and replies received since
+        self._sent_at = {}
+        self._replies = {}
+        self._condition = threading.Condition()
+
+    def send(self, chat_id: int, text: str) -> None:
+        """Sends a text message from a user to the bot."""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        update = {'update_id': next(self._update_ids), 'message': message}
+
+        with self._condition:
+            self._sent_at[chat_id] = time.perf_counter()
+            self._replies[chat_id] = []
+            if self.webhook_url is None and self.deliver is None:
+                self._updates.append(update)
+                self._condition.notify_all()
+                return
+
+        if self.deliver is not None:
+            self.deliver(update)
+            return
+        request = urllib.request.Request(self.webhook_url, data=json.dumps(update).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        if self.secret_token:
+            request.add_header('X-Telegram-Bot-Api-Secret-Token', self.secret_token)
+        urllib.request.urlopen(request).close()
+
+    def wait_for_reply(self, chat_id: int, timeout: float = 30.0) -> Optional[float]:
+        """Returns the seconds between the last update sent to a chat and the bot's first reply to it."""
+        deadline = time.perf_counter() + timeout
+        with self._condition:
+            while not self._replies.get(chat_id):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return self._replies[chat_id][0] - self._sent_at[chat_id]
+
+    def get_updates(self, offset: int, timeout: float) -> list:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return list(self._updates)
+
+    def record_reply(self, chat_id: int, text: str) -> dict:
+        with self._condition:
+            self._replies.setdefault(chat_id, []).append(time.perf_counter())
+            self._condition.notify_all()
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+
+class _BotApiRequestHandler(BaseHTTPRequestHandler):
+    server: FakeTelegram
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            params = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            params = {}
+        method = self.path.rsplit('/', 1)[-1]
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Lemon', 'username': 'lemon_bot'}
+        elif method == 'getUpdates':
+            self.server.connected.set()
+            result = self.server.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        elif method == 'setWebhook':
+            self.server.webhook_url = params.get('url') or None
+            self.server.secret_token = params.get('secret_token')
+            self.server.connected.set()
+            result = True
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self.server.record_reply(int(params['chat_id']), params.get('text', ''))
+        else:
+            result = True
+
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run(fake: FakeTelegram, chats: int, rounds: int) -> None:
+    """Each chat opens and cancels a /quicktrade conversation `rounds` times, measuring every reply."""
+    latencies = []
+    lock = threading.Lock()
+
+    def conversation(chat_id: int) -> None:
+        for _ in range(rounds):
+            for text in ('/quicktrade', '/cancel'):
+                fake.send(chat_id, text)
+                latency = fake.wait_for_reply(chat_id)
+                if latency is not None:
+                    with lock:
+                        latencies.append(latency)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=conversation, args=(chat_id,)) for chat_id in range(1, chats + 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    mode = 'webhook' if fake.webhook_url else 'polling'
+    expected = chats * rounds * 2
+    if not latencies:
+        print(f'{mode}: no replies received')
+        return
+    print(f'{mode}: {len(latencies)}/{expected} replies in {elapsed:.2f}s ({len(latencies) / elapsed:.1f}/s), '
+          f'p50 {statistics.median(latencies) * 1000:.1f}ms, p99 {percentile(latencies, 0.99) * 1000:.1f}ms')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--chats', type=int, default=20, help='number of concurrent chats')
+    parser.add_argument('--rounds', type=int, default=5, help='conversations per chat')
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.host, args.port)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    print(f'Fake Telegram API listening on http://{args.host}:{args.port}/bot, waiting for the bot to connect...')
+    fake.connected.wait()
+    run(fake, args.chats, args.rounds)
+    fake.shutdown()
+
+
+if __name__ == '__main__':
+    main()
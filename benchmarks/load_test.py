@@ -0,0 +1,419 @@
+"""Offline load test of main.py's dispatcher against local stand-ins for the lemon.markets and Telegram APIs.
+
+Every chat plays a scripted conversation (/trade, /quicktrade, /positions or /moon) a number of times, sending its
+next message as soon as the bot has replied to the last one, so all chats are in a conversation at the same time.
+Updates are put straight into the dispatcher's update queue, replies go through the fake Telegram API over HTTP,
+and every lemon.markets call goes to benchmarks/fake_lemon.py, started in its own process:
+
+    python benchmarks/load_test.py --chats 2000 --rounds 2 --latency 0.05 --json run.json
+    python benchmarks/load_test.py --chats 2000 --rounds 2 --latency 0.05 --compare run.json
+
+The report lists the throughput, the time from a message to the bot's reply per handler (p50/p99) next to the
+mean time spent in the handler itself, the time from an order's activation to the fill notification, and the memory
+held per conversation. Telegram's flood limits are lifted in the outbox unless --flood-limits is given, and the
+bot's own output is discarded. Set BOT_ENGINE, BOT_WORKERS and the other variables as for main.py to compare
+configurations; results saved with --json can be compared with later runs with --compare.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from telegram import Update
+
+from fake_lemon import add_arguments
+from fake_telegram import FakeTelegram, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metrics  # noqa: E402
+from admission import BUSY, REPLIES  # noqa: E402
+
+# (handler, message, text the reply must contain) per step of a conversation
+SCENARIOS = {
+    'trade': [
+        ('trade', '/trade', 'What type of instrument'),
+        ('get_search_query', 'Stock', 'What is the name'),
+        ('get_instrument_name', 'apple', 'Please choose the instrument'),
+        ('get_isin', 'APPLE INC.', 'buy or sell'),
+        ('get_side', 'Buy', 'currently trading'),
+        ('get_quantity', '1', 'Please confirm or cancel'),
+        ('confirm_order', 'Confirm', 'Please wait'),
+        ('complete_order', 'No', 'Bye!'),
+    ],
+    'quicktrade': [
+        ('quick_trade', '/quicktrade', 'Please specify'),
+        ('perform_quicktrade', 'buy 1 apple stock', 'Is that correct?'),
+        ('confirm_quicktrade', 'Confirm', 'Please wait'),
+    ],
+    'positions': [
+        ('show_positions', '/positions', 'Name: '),
+    ],
+    'moon': [
+        ('to_the_moon', '/moon', 'to the moon'),
+    ],
+}
+# reply to an activated order, after which the order watcher reports the fill
+ACTIVATED = 'Please wait'
+# messages the order watcher sends on its own
+NOTIFICATIONS = ('Your order was', 'We\'re currently experiencing some delays')
+
+
+class Chat:
+    __slots__ = ('chat_id', 'script', 'rounds', 'step', 'sent_at', 'activated_at')
+
+    def __init__(self, chat_id: int, script: list, rounds: int):
+        self.chat_id = chat_id
+        self.script = script
+        self.rounds = rounds
+        self.step = 0
+        # perf_counter time the pending message was sent at, None while no reply is expected
+        self.sent_at: Optional[float] = None
+        self.activated_at: Optional[float] = None
+
+
+class ScriptedTelegram(FakeTelegram):
+    """Fake Telegram API that plays every chat's script and measures the replies."""
+
+    def __init__(self, chats: List[Chat], deliver, retry_after: float = 1.0, port: int = 0):
+        super().__init__('127.0.0.1', port, deliver=deliver)
+        self.retry_after = retry_after
+        self.chats = {chat.chat_id: chat for chat in chats}
+        self.active = len(chats)
+        self.done = threading.Event()
+
+        # handler -> seconds from a message to the reply
+        self.latencies: Dict[str, List[float]] = {}
+        self.fills: List[float] = []
+        self.unfilled = 0
+        self.errors: Dict[str, int] = {}
+        self.error_texts: List[str] = []
+        self.timeouts: Dict[str, int] = {}
+        # handler -> messages the bot turned away as too busy, which are sent again after `retry_after` seconds
+        self.busy: Dict[str, int] = {}
+        self._retries: List[tuple] = []
+        # replies that came while the chat was not waiting for one
+        self.unexpected = 0
+        self._lock = threading.Lock()
+
+    def start_chat(self, chat: Chat) -> None:
+        with self._lock:
+            message = self._next(chat)
+        self.send(chat.chat_id, message)
+
+    def record_reply(self, chat_id: int, text: str) -> dict:
+        result = super().record_reply(chat_id, text)
+        received_at = time.perf_counter()
+        with self._lock:
+            message = self._advance(self.chats.get(chat_id), text, received_at)
+        if message is not None:
+            self.send(chat_id, message)
+        return result
+
+    def retry(self) -> None:
+        """Sends the messages again that the bot was too busy for and are due."""
+        now = time.perf_counter()
+        with self._lock:
+            due = [chat for retry_at, chat in self._retries if retry_at <= now]
+            self._retries = [(retry_at, chat) for retry_at, chat in self._retries if retry_at > now]
+            messages = [(chat.chat_id, self._next(chat)) for chat in due]
+        for chat_id, message in messages:
+            self.send(chat_id, message)
+
+    def expire(self, timeout: float) -> None:
+        """Gives up on the chats that waited longer than `timeout` seconds for a reply."""
+        now = time.perf_counter()
+        with self._lock:
+            for chat in self.chats.values():
+                if chat.sent_at is not None and now - chat.sent_at > timeout:
+                    handler = chat.script[chat.step][0]
+                    self.timeouts[handler] = self.timeouts.get(handler, 0) + 1
+                    self._finish(chat)
+
+    def _advance(self, chat: Optional[Chat], text: str, received_at: float) -> Optional[str]:
+        """Records a reply and returns the chat's next message, if any."""
+        if chat is None:
+            return None
+        if text.startswith(NOTIFICATIONS):
+            if chat.activated_at is not None:
+                if 'executed' in text:
+                    self.fills.append(received_at - chat.activated_at)
+                else:
+                    self.unfilled += 1
+                chat.activated_at = None
+            return None
+        if chat.sent_at is None:
+            self.unexpected += 1
+            return None
+
+        handler, message, expected = chat.script[chat.step]
+        if text == REPLIES[BUSY]:
+            self.busy[handler] = self.busy.get(handler, 0) + 1
+            chat.sent_at = None
+            self._retries.append((received_at + self.retry_after, chat))
+            return None
+        if expected not in text:
+            self.errors[handler] = self.errors.get(handler, 0) + 1
+            if len(self.error_texts) < 5:
+                self.error_texts.append(f'{handler}: {text!r}')
+            self._finish(chat)
+            return None
+        self.latencies.setdefault(handler, []).append(received_at - chat.sent_at)
+        if expected == ACTIVATED:
+            chat.activated_at = received_at
+
+        chat.step += 1
+        if chat.step == len(chat.script):
+            chat.step = 0
+            chat.rounds -= 1
+            if not chat.rounds:
+                self._finish(chat)
+                return None
+        return self._next(chat)
+
+    @staticmethod
+    def _next(chat: Chat) -> str:
+        chat.sent_at = time.perf_counter()
+        return chat.script[chat.step][1]
+
+    def _finish(self, chat: Chat) -> None:
+        chat.sent_at = None
+        chat.rounds = 0
+        self.active -= 1
+        if not self.active:
+            self.done.set()
+
+
+def gauge(name: str):
+    """Reads one of the callback metrics main.register_metrics registered."""
+    return next(metric for metric in metrics.registry.metrics if metric.name == name).callback()
+
+
+def start_fake_lemon(args: argparse.Namespace) -> subprocess.Popen:
+    """Starts benchmarks/fake_lemon.py in its own process, so it does not compete with the bot for the GIL."""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_lemon.py'), '--port', str(port),
+         '--latency', str(args.latency), '--jitter', str(args.jitter), '--fill-delay', str(args.fill_delay),
+         '--instruments', str(args.instruments), '--positions', str(args.positions)],
+        stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError('The fake lemon.markets API did not start.')
+            time.sleep(0.05)
+    args.lemon_url = f'http://127.0.0.1:{port}/v1'
+    return process
+
+
+def run(args: argparse.Namespace, workdir: str) -> dict:
+    scenarios = args.scenarios.split(',')
+    chats = [Chat(chat_id, SCENARIOS[scenarios[chat_id % len(scenarios)]], args.rounds)
+             for chat_id in range(1, args.chats + 1)]
+    updater = None
+    telegram = ScriptedTelegram(chats, deliver=lambda data: updater.dispatcher.update_queue.put(
+        Update.de_json(data, updater.bot)), retry_after=args.retry_after)
+    threading.Thread(target=telegram.serve_forever, name='fake-telegram', daemon=True).start()
+
+    # trading_bot reads its configuration when it is imported
+    os.environ.update({
+        'BOT_TOKEN': '123:fake',
+        'TELEGRAM_BASE_URL': f'http://127.0.0.1:{telegram.server_address[1]}/bot',
+        'LEMON_MARKET_DATA_URL': args.lemon_url,
+        'LEMON_TRADING_URL': args.lemon_url,
+        'TRADING_API_KEY': 'fake',
+        'DATA_API_KEY': 'fake',
+        'INSTRUMENT_INDEX_PATH': os.path.join(workdir, 'instruments.json'),
+    })
+    os.environ.setdefault('MIC', 'XMUN')
+    # scripted chats repeat their conversations back to back, which the bot would take for duplicates
+    os.environ.setdefault('DUPLICATE_WINDOW', '0')
+    import eventlog
+    import main
+    from outbox import TokenBucket
+    from trading_bot import outbox
+
+    # the same logging pipeline as main.py, into the bot's output
+    eventlog.setup(level=args.log_level, sample_rate=args.log_sample, stream=sys.stdout)
+    if not args.flood_limits:
+        outbox.global_bucket = TokenBucket(1e6, 1e6)
+        outbox.chat_rate = outbox.chat_burst = 1e6
+
+    updater = main.create_updater(os.path.join(workdir, 'bot.db'))
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+    updater.job_queue.start()
+
+    peaks = {'sessions': 0, 'session_bytes': None, 'update_queue': 0}
+    async_engine = os.getenv('BOT_ENGINE', 'threaded') == 'async'
+
+    def sample() -> None:
+        while not telegram.done.wait(0.25):
+            peaks['update_queue'] = max(peaks['update_queue'], gauge('bot_update_queue'))
+            # the async engine keeps its conversations apart from the session store and does not report their size
+            sessions = gauge('bot_async_chats') if async_engine else gauge('bot_sessions')
+            if sessions > peaks['sessions']:
+                peaks['sessions'] = sessions
+                peaks['session_bytes'] = None if async_engine else gauge('bot_session_bytes')
+
+    handled_before = metrics.handler_seconds.totals()
+    started = time.perf_counter()
+    threading.Thread(target=sample, name='sampler', daemon=True).start()
+    for index, chat in enumerate(chats):
+        if args.ramp:
+            time.sleep(max(started + args.ramp * index / len(chats) - time.perf_counter(), 0))
+        telegram.start_chat(chat)
+    while not telegram.done.wait(0.1):
+        telegram.retry()
+        telegram.expire(args.timeout)
+    elapsed = time.perf_counter() - started
+    # give the last orders time to be reported
+    deadline = time.monotonic() + args.fill_delay + 5
+    while any(chat.activated_at is not None for chat in chats) and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    updater.persistence.flush()
+    telegram.shutdown()
+
+    handled = {labels[0]: (count - handled_before.get(labels, (0, 0.0))[0],
+                           total - handled_before.get(labels, (0, 0.0))[1])
+               for labels, (count, total) in metrics.handler_seconds.totals().items()}
+    steps = sum(len(values) for values in telegram.latencies.values())
+    handlers = {}
+    for scenario in scenarios:
+        for handler, message, expected in SCENARIOS[scenario]:
+            latencies = telegram.latencies.get(handler, [])
+            count, total = handled.get(handler, (0, 0.0))
+            handlers[handler] = {
+                'replies': len(latencies),
+                'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+                'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+                'handler_ms': total / count * 1000 if count else None,
+                'errors': telegram.errors.get(handler, 0),
+                'timeouts': telegram.timeouts.get(handler, 0),
+                'busy': telegram.busy.get(handler, 0),
+            }
+    return {
+        'config': {'chats': args.chats, 'rounds': args.rounds, 'scenarios': scenarios, 'latency': args.latency,
+                   'fill_delay': args.fill_delay, 'engine': os.getenv('BOT_ENGINE', 'threaded'),
+                   'workers': int(os.getenv('BOT_WORKERS', 4)), 'flood_limits': args.flood_limits},
+        'elapsed': elapsed,
+        'steps': steps,
+        'throughput': steps / elapsed,
+        'errors': sum(telegram.errors.values()),
+        'timeouts': sum(telegram.timeouts.values()),
+        'busy': sum(telegram.busy.values()),
+        'unexpected_replies': telegram.unexpected,
+        'error_samples': telegram.error_texts,
+        'handlers': handlers,
+        'order_fill': {'fills': len(telegram.fills), 'not_filled': telegram.unfilled,
+                       'p50_ms': percentile(telegram.fills, 0.5) * 1000 if telegram.fills else None,
+                       'p99_ms': percentile(telegram.fills, 0.99) * 1000 if telegram.fills else None},
+        'memory': {'peak_sessions': peaks['sessions'],
+                   'bytes_per_session': peaks['session_bytes'] / peaks['sessions']
+                   if peaks['session_bytes'] is not None else None,
+                   'peak_update_queue': peaks['update_queue'],
+                   # kilobytes on Linux
+                   'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024},
+    }
+
+
+def _value(value: Optional[float], baseline: Optional[float] = None, digits: int = 1) -> str:
+    if value is None:
+        return '-'
+    text = f'{value:,.{digits}f}'
+    if baseline:
+        text += f' ({(value - baseline) / baseline:+.0%})'
+    return text
+
+
+def print_report(result: dict, baseline: Optional[dict] = None) -> None:
+    base = baseline or {}
+    config = result['config']
+    print(f'{config["chats"]} chats x {config["rounds"]} rounds of {", ".join(config["scenarios"])}, '
+          f'{config["engine"]} engine, lemon latency {config["latency"] * 1000:.0f}ms')
+    print(f'{result["steps"]} replies in {result["elapsed"]:.2f}s: '
+          f'{_value(result["throughput"], base.get("throughput"))} replies/s, {result["errors"]} errors, '
+          f'{result["timeouts"]} timeouts, {result["busy"]} turned away as busy, '
+          f'{result["unexpected_replies"]} unexpected replies')
+    for sample in result['error_samples']:
+        print(f'  {sample}')
+
+    print(f'\n{"handler":<22}{"replies":>8}{"busy":>6}{"p50 ms":>18}{"p99 ms":>18}{"in handler ms":>18}')
+    for handler, row in result['handlers'].items():
+        base_row = base.get('handlers', {}).get(handler, {})
+        print(f'{handler:<22}{row["replies"]:>8}{row["busy"]:>6}'
+              + ''.join(f'{_value(row[key], base_row.get(key)):>18}' for key in ('p50_ms', 'p99_ms', 'handler_ms')))
+    fill, base_fill = result['order_fill'], base.get('order_fill', {})
+    print(f'{"order fill":<22}{fill["fills"]:>8}{"":>6}'
+          + ''.join(f'{_value(fill[key], base_fill.get(key)):>18}' for key in ('p50_ms', 'p99_ms')))
+
+    memory, base_memory = result['memory'], base.get('memory', {})
+    print(f'\npeak {memory["peak_sessions"]} sessions, '
+          f'{_value(memory["bytes_per_session"], base_memory.get("bytes_per_session"), 0)} bytes per session, '
+          f'peak update queue {memory["peak_update_queue"]}, '
+          f'max RSS {_value(memory["max_rss_mib"], base_memory.get("max_rss_mib"))} MiB')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=1000, help='number of concurrent chats')
+    parser.add_argument('--rounds', type=int, default=1, help='conversations per chat')
+    parser.add_argument('--scenarios', default='trade,quicktrade,positions,moon',
+                        help=f'comma-separated conversations the chats take turns with, of {", ".join(SCENARIOS)}')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which the chats are started')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for a reply')
+    parser.add_argument('--retry-after', type=float, default=1.0,
+                        help='seconds after which a message the bot was too busy for is sent again')
+    parser.add_argument('--lemon-url', help='URL of a running fake_lemon.py instead of starting one')
+    parser.add_argument('--flood-limits', action='store_true', help='keep the outbox within Telegram\'s limits')
+    parser.add_argument('--log-level', default='WARNING', help='level of the bot\'s log output')
+    parser.add_argument('--log-sample', type=float, default=0.01, help='share of the chats DEBUG events are logged for')
+    parser.add_argument('--bot-output', default=os.devnull, help='file the bot\'s printed output is written to')
+    parser.add_argument('--json', help='file to save the results to')
+    parser.add_argument('--compare', help='results of an earlier run, saved with --json, to compare with')
+    add_arguments(parser)
+    args = parser.parse_args()
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    lemon = start_fake_lemon(args) if args.lemon_url is None else None
+    try:
+        with tempfile.TemporaryDirectory() as workdir, open(args.bot_output, 'w') as output, \
+                contextlib.redirect_stdout(output):
+            result = run(args, workdir)
+    finally:
+        if lemon is not None:
+            lemon.terminate()
+            lemon.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
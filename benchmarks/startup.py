@@ -0,0 +1,185 @@
+"""Measures how long main.py takes from a cold start until it answers, against local stand-ins for the APIs.
+
+Every run starts `python main.py` in a fresh process, with the lemon.markets API served by benchmarks/fake_lemon.py
+and the Telegram API by benchmarks/fake_telegram.py. A /moon message is waiting for the bot before it starts, so the
+time to the first reply is what a user sees who writes to the bot while it restarts:
+
+    python benchmarks/startup.py --runs 5 --json before.json
+    python benchmarks/startup.py --runs 5 --compare before.json --max-ready 3
+
+The report lists the median and the slowest run of the time to import main.py, to the first getUpdates request,
+to the first reply and until the bot reports itself ready on /ready. The first run starts without an instrument
+snapshot on disk, the later ones with the snapshot the first run saved, unless --cold is given. With --max-ready,
+the benchmark fails if the median time until the bot is ready is longer, to catch regressions in CI.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+
+from fake_lemon import add_arguments
+from fake_telegram import FakeTelegram
+from load_test import ROOT, _value, start_fake_lemon
+
+STEPS = ('import', 'polling', 'first_reply', 'ready')
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def measure_import(output) -> float:
+    """Returns the seconds importing main.py takes on top of starting the interpreter."""
+    timings = []
+    for command in ('pass', 'import main'):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', command], cwd=ROOT, stdout=output, stderr=output, check=True)
+        timings.append(time.perf_counter() - started)
+    return timings[1] - timings[0]
+
+
+def ready_status(port: int) -> Optional[int]:
+    """Returns the status of the bot's /ready endpoint: 200 once it is ready, 503 before and 404 if it has none."""
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/ready', timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        # the metrics server is not listening yet
+        return None
+
+
+def run_once(args: argparse.Namespace, workdir: str, output, cold: bool) -> Dict[str, Optional[float]]:
+    """Starts the bot once and returns the seconds from starting its process to each step."""
+    if cold:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+    telegram = FakeTelegram(port=free_port())
+    threading.Thread(target=telegram.serve_forever, name='fake-telegram', daemon=True).start()
+    metrics_port = free_port()
+    environment = dict(
+        os.environ,
+        BOT_TOKEN='123:fake',
+        TELEGRAM_BASE_URL=f'http://127.0.0.1:{telegram.server_address[1]}/bot',
+        LEMON_MARKET_DATA_URL=args.lemon_url,
+        LEMON_TRADING_URL=args.lemon_url,
+        TRADING_API_KEY='fake',
+        DATA_API_KEY='fake',
+        MIC=os.getenv('MIC', 'XMUN'),
+        INSTRUMENT_INDEX_PATH=os.path.join(workdir, 'instruments.json'),
+        PERSISTENCE_PATH=os.path.join(workdir, 'bot.db'),
+        METRICS_PORT=str(metrics_port),
+    )
+
+    # the message is queued before the bot starts polling, as if it was sent during the restart
+    telegram.send(1, '/moon')
+    timings = dict.fromkeys(STEPS[1:])
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], cwd=workdir, env=environment,
+                               stdout=output, stderr=output)
+    try:
+        deadline = started + args.timeout
+        waiting = set(timings)
+        while waiting and time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f'The bot exited with {process.returncode} while starting.')
+            now = time.perf_counter() - started
+            if 'polling' in waiting and telegram.connected.is_set():
+                timings['polling'] = now
+                waiting.remove('polling')
+            if 'first_reply' in waiting and telegram.wait_for_reply(1, timeout=0) is not None:
+                timings['first_reply'] = now
+                waiting.remove('first_reply')
+            if 'ready' in waiting:
+                status = ready_status(metrics_port)
+                if status == 200:
+                    timings['ready'] = now
+                if status in (200, 404):
+                    waiting.remove('ready')
+            time.sleep(0.005)
+    finally:
+        # a graceful stop would wait for the long poll to return
+        process.kill()
+        process.wait()
+        telegram.shutdown()
+        telegram.server_close()
+    return timings
+
+
+def summarise(runs: List[Dict[str, Optional[float]]]) -> Dict[str, dict]:
+    summary = {}
+    for step in STEPS:
+        values = [run[step] for run in runs if run.get(step) is not None]
+        summary[step] = {'median_ms': statistics.median(values) * 1000 if values else None,
+                         'max_ms': max(values) * 1000 if values else None,
+                         'missing': len(runs) - len(values)}
+    return summary
+
+
+def print_report(result: dict, baseline: Optional[dict] = None) -> None:
+    base = (baseline or {}).get('steps', {})
+    print(f'{result["runs"]} starts, lemon latency {result["latency"] * 1000:.0f}ms, '
+          f'{"cold" if result["cold"] else "the first one cold"}')
+    print(f'\n{"step":<14}{"median ms":>20}{"max ms":>20}{"missing":>9}')
+    for step, row in result['steps'].items():
+        base_row = base.get(step, {})
+        print(f'{step:<14}{_value(row["median_ms"], base_row.get("median_ms")):>20}'
+              f'{_value(row["max_ms"], base_row.get("max_ms")):>20}{row["missing"]:>9}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='number of times the bot is started')
+    parser.add_argument('--cold', action='store_true', help='start every run without an instrument snapshot')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for the bot to be ready')
+    parser.add_argument('--lemon-url', help='URL of a running fake_lemon.py instead of starting one')
+    parser.add_argument('--bot-output', default=os.devnull, help='file the bot\'s output is written to')
+    parser.add_argument('--max-ready', type=float, help='fail if the bot takes longer to be ready, in seconds')
+    parser.add_argument('--json', help='file to save the results to')
+    parser.add_argument('--compare', help='results of an earlier run, saved with --json, to compare with')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    lemon = start_fake_lemon(args) if args.lemon_url is None else None
+    runs = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir, open(args.bot_output, 'w') as output:
+            imports = [measure_import(output) for _ in range(args.runs)]
+            for index in range(args.runs):
+                timings = run_once(args, workdir, output, cold=args.cold or index == 0)
+                runs.append({'import': imports[index], **timings})
+    finally:
+        if lemon is not None:
+            lemon.terminate()
+            lemon.wait()
+
+    result = {'runs': args.runs, 'cold': args.cold, 'latency': args.latency, 'steps': summarise(runs)}
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    ready_ms = result['steps']['ready']['median_ms']
+    if args.max_ready is not None and (ready_ms is None or ready_ms > args.max_ready * 1000):
+        print(f'\nThe bot took longer than {args.max_ready}s to be ready.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
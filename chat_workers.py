@@ -0,0 +1,94 @@
+import queue
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from telegram import Update
+from telegram.ext import Dispatcher, DispatcherHandlerStop, Handler
+
+import eventlog
+
+
+class ChatWorkers:
+    """Handles the dispatcher's updates on `workers` threads, the updates of each chat one at a time and in the order
+    they arrived, so a slow handler only holds up its own chat.
+
+    Every chat with updates waiting has a mailbox. A free worker takes a whole chat and runs its updates through all
+    handler groups, one after another, until the mailbox is empty.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, workers: int = 4):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        # chat id -> updates waiting, kept while a worker has the chat
+        self._mailboxes: Dict[int, Deque[Update]] = {}
+        self._lock = threading.Lock()
+        # chats with updates waiting and no worker yet
+        self._ready: queue.Queue = queue.Queue()
+        self._local = threading.local()
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            threading.Thread(target=self._run, name=f'chat-worker-{index}', daemon=True).start()
+
+    def put(self, chat_id: int, update: Update) -> None:
+        with self._lock:
+            mailbox = self._mailboxes.get(chat_id)
+            if mailbox is not None:
+                mailbox.append(update)
+                return
+            self._mailboxes[chat_id] = deque((update,))
+        self._ready.put(chat_id)
+
+    def handling(self) -> bool:
+        """Returns whether the calling thread is one of the workers."""
+        return getattr(self._local, 'worker', False)
+
+    def pending(self, chat_id: Optional[int] = None) -> int:
+        """Returns the number of updates waiting for a worker, of one chat or of all chats."""
+        with self._lock:
+            if chat_id is None:
+                return sum(len(mailbox) for mailbox in self._mailboxes.values())
+            return len(self._mailboxes.get(chat_id, ()))
+
+    def _run(self) -> None:
+        self._local.worker = True
+        while True:
+            chat_id = self._ready.get()
+            while True:
+                with self._lock:
+                    mailbox = self._mailboxes[chat_id]
+                    if not mailbox:
+                        del self._mailboxes[chat_id]
+                        break
+                    update = mailbox.popleft()
+                try:
+                    self.dispatcher.process_update(update)
+                except Exception as e:
+                    # the dispatcher hands handler errors to its error handlers, this is for anything else
+                    eventlog.error(e, chat_id=chat_id)
+
+
+class ChatWorkersHandler(Handler):
+    """Hands every update of a chat from the dispatcher's thread to the chat workers, which run it through the
+    handlers again."""
+
+    def __init__(self, workers: ChatWorkers):
+        super().__init__(lambda update, context: None)
+        self.workers = workers
+
+    def check_update(self, update: object) -> bool:
+        return isinstance(update, Update) and update.effective_chat is not None and not self.workers.handling()
+
+    def handle_update(self, update, dispatcher, check_result, context=None) -> None:
+        self.workers.put(update.effective_chat.id, update)
+        raise DispatcherHandlerStop()
+
+
+def install(dispatcher: Dispatcher, workers: int = 4) -> ChatWorkers:
+    """Runs the handlers of all groups on the chat workers instead of the dispatcher's thread, which only hands the
+    updates over."""
+    chat_workers = ChatWorkers(dispatcher, workers)
+    chat_workers.start()
+    dispatcher.add_handler(ChatWorkersHandler(chat_workers), group=-1)
+    return chat_workers
@@ -0,0 +1,188 @@
+import atexit
+import contextvars
+import datetime
+import hashlib
+import json
+import logging
+import queue
+import sys
+import zlib
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Optional
+
+# fields whose values never reach the log: balances are replaced, ids are replaced by a short hash so the events of
+# one order can still be told apart
+REDACTED = frozenset(('balance', 'cash_to_invest', 'buying_power', 'amount_bought_intraday', 'amount_sold_intraday'))
+HASHED = frozenset(('order_id', 'order_ids', 'idempotency'))
+_SCALARS = (str, int, float, bool, type(None))
+
+logger = logging.getLogger('bot')
+
+# handler and chat of the update being handled, added to every event logged while handling it
+handling: contextvars.ContextVar = contextvars.ContextVar('handling', default=None)
+
+# share of the chats whose DEBUG events are logged, chosen by chat id so a sampled conversation is logged completely
+debug_sample_rate = 1.0
+# handlers taking longer than this many seconds are logged for every chat, not only for the sampled ones
+slow_handler_seconds = 1.0
+# the handler all records go through once setup() has been called
+queue_handler: Optional['DroppingQueueHandler'] = None
+
+
+def _hash(value: Any) -> str:
+    return 'sha256:' + hashlib.sha256(str(value).encode()).hexdigest()[:10]
+
+
+def redact(value: Any, key: Optional[str] = None) -> Any:
+    """Returns a copy of `value` with balances and order ids redacted, at any depth of nested dicts and lists."""
+    if key is not None and value is not None:
+        if key in REDACTED:
+            return '[redacted]'
+        if key in HASHED:
+            return [_hash(item) for item in value] if isinstance(value, (list, tuple)) else _hash(value)
+    if isinstance(value, _SCALARS):
+        return value
+    if isinstance(value, dict):
+        return {name: redact(item, name) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return str(value)
+
+
+def sampled(chat_id: Optional[int]) -> bool:
+    if debug_sample_rate >= 1:
+        return True
+    if chat_id is None:
+        return False
+    return zlib.crc32(str(chat_id).encode()) % 10000 < debug_sample_rate * 10000
+
+
+def enabled(level: int, chat_id: Optional[int] = None) -> bool:
+    """Returns whether an event of `level` about a chat would be logged, so callers can skip building it."""
+    if not logger.isEnabledFor(level):
+        return False
+    if level <= logging.DEBUG:
+        current = handling.get()
+        return sampled(chat_id if chat_id is not None else current and current[1])
+    return True
+
+
+def event(name: str, level: int = logging.INFO, stacklevel: int = 2, **fields) -> None:
+    """Logs a structured event with the handler and chat being handled, if any, and the given fields.
+
+    DEBUG events are only logged for a sample of the chats. Fields are redacted right away, so nothing secret is
+    ever queued; turning them into JSON and writing them out happens on the listener's thread.
+    """
+    if not enabled(level, fields.get('chat_id')):
+        return
+    current = handling.get()
+    if current is not None:
+        fields.setdefault('handler', current[0])
+        if current[1] is not None:
+            fields.setdefault('chat_id', current[1])
+    # attribute the event to the function that logged it, not to this one
+    logger.log(level, name, extra={'fields': redact(fields)}, stacklevel=stacklevel)
+
+
+def error(e: BaseException, **fields) -> None:
+    """Logs an exception a handler or background job caught and recovered from."""
+    event('error', logging.WARNING, stacklevel=3, error=f'{type(e).__name__}: {e}', **fields)
+
+
+def chat_id_of(args: tuple) -> Optional[int]:
+    """Returns the id of the chat of the first update among a handler's arguments."""
+    for arg in args:
+        chat = getattr(arg, 'effective_chat', None)
+        if chat is not None:
+            return chat.id
+    return None
+
+
+def begin(handler: str, chat_id: Optional[int]) -> contextvars.Token:
+    """Adds the handler and chat to the events logged until `end`."""
+    return handling.set((handler, chat_id))
+
+
+def end(token: contextvars.Token, seconds: float, state: Any = None, e: Optional[BaseException] = None) -> None:
+    """Logs how long the handler took and the state it left the conversation in: failed and slow calls always,
+    the others at DEBUG."""
+    if e is not None:
+        event('handled', logging.ERROR, stacklevel=3, seconds=round(seconds, 4), error=f'{type(e).__name__}: {e}')
+    else:
+        level = logging.INFO if seconds >= slow_handler_seconds else logging.DEBUG
+        event('handled', level, stacklevel=3, seconds=round(seconds, 4), state=state)
+    handling.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats every record as one line of JSON, events with their fields and other records with their message."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+            'where': f'{record.module}.{record.funcName}',
+        }
+        data.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Puts records on a bounded queue for the listener thread, dropping them while the queue is full instead of
+    blocking the thread that logs."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only render what must not outlive the call: the message arguments and the traceback; the record is not
+        # copied, as this is the only handler that sees it
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup(level: str = 'INFO', library_level: str = 'WARNING', sample_rate: float = 0.01, slow_handler: float = 1.0,
+          max_queued: int = 10000, stream=None) -> QueueListener:
+    """Sends all log records through a queue to a background thread that writes them as JSON lines to `stream`
+    (default stderr), and returns the started listener.
+
+    python-telegram-bot, urllib3 and apscheduler log every request and job at DEBUG, so they only log from
+    `library_level` on.
+    """
+    global debug_sample_rate, slow_handler_seconds, queue_handler
+    debug_sample_rate = sample_rate
+    slow_handler_seconds = slow_handler
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter())
+    handler = queue_handler = DroppingQueueHandler(queue.Queue(max_queued))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name in ('telegram', 'urllib3', 'apscheduler'):
+        logging.getLogger(name).setLevel(library_level)
+
+    listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    # write out what is still queued when the bot exits
+    atexit.register(listener.stop)
+    return listener
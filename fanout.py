@@ -0,0 +1,52 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, wait
+from typing import Any, Callable, List, Optional
+
+# shared pool for upstream calls that handlers start together instead of one after another
+executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='fan-out')
+
+
+def submit(call: Callable[[], Any]) -> Future:
+    """Starts a call on the shared pool and returns its future."""
+    return executor.submit(call)
+
+
+def fan_out(*calls: Callable[[], Any], timeout: Optional[float] = 30.0, return_exceptions: bool = False) -> List[Any]:
+    """Runs independent calls concurrently and returns their results in order.
+
+    Waits up to `timeout` seconds for all calls together, then re-raises the first exception (in argument order) if
+    any call failed, with a TimeoutError for calls that have not finished. With `return_exceptions`, the exception of
+    a failed call is returned in place of its result instead, so the results of the others can still be used, e.g. to
+    cancel an order that was created while another call failed.
+    """
+    futures = [executor.submit(call) for call in calls]
+    wait(futures, timeout=timeout)
+    errors = [future.exception() if future.done() else TimeoutError() for future in futures]
+    if return_exceptions:
+        return [error if error is not None else future.result() for future, error in zip(futures, errors)]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [future.result() for future in futures]
+
+
+def run_bounded(calls: List[Callable[[], Any]], max_parallel: int = 8, timeout: Optional[float] = 30.0) -> List[Future]:
+    """Runs calls on the shared pool with at most `max_parallel` of them at a time.
+
+    Returns the futures of all calls once they have finished or `timeout` seconds have passed, so callers can deal
+    with each failure separately. Calls that had to wait for a slot until then are not started and their futures
+    never finish.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    slots = threading.BoundedSemaphore(max_parallel)
+    futures = []
+    for call in calls:
+        if not slots.acquire(timeout=max(0.0, deadline - time.monotonic()) if deadline is not None else None):
+            futures.append(Future())
+            continue
+        future = executor.submit(call)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+    wait(futures, timeout=max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+    return futures
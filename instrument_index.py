@@ -0,0 +1,232 @@
+import bisect
+import difflib
+import json
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from typing import List, Optional
+
+import eventlog
+
+# the fields of an instrument the bot needs to resolve and display it
+IndexedInstrument = namedtuple('IndexedInstrument', ['isin', 'name', 'title', 'type'])
+
+ISIN_PATTERN = re.compile(r'^[A-Z]{2}[A-Z0-9]{9}[0-9]$')
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def _normalise(text: str) -> str:
+    return ' '.join(TOKEN_PATTERN.findall((text or '').lower()))
+
+
+class _Snapshot:
+    """Immutable lookup structures built from one list of instruments."""
+
+    def __init__(self, instruments: List[IndexedInstrument], loaded_at: float):
+        self.instruments = instruments
+        self.loaded_at = loaded_at
+        self.by_isin = {instrument.isin: instrument for instrument in instruments}
+
+        # sorted (normalised name, isin) pairs for prefix search via bisect
+        keys = set()
+        # isin -> normalised name and title, to rank the matches of a query
+        self.texts = {}
+        # token -> isins of all instruments whose name or title contains the token
+        self.tokens = {}
+        for instrument in instruments:
+            for text in (instrument.name, instrument.title):
+                normalised = _normalise(text)
+                if not normalised:
+                    continue
+                keys.add((normalised, instrument.isin))
+                self.texts.setdefault(instrument.isin, []).append(normalised)
+                for token in normalised.split():
+                    self.tokens.setdefault(token, set()).add(instrument.isin)
+        self.keys = sorted(keys)
+        self.vocabulary = list(self.tokens)
+
+
+class InstrumentIndex:
+    """In-memory index of all instruments traded on a venue, used to resolve names and ISINs without an API call.
+
+    The index is loaded from a snapshot on disk (if present), refreshed from the lemon.markets API in the
+    background and written back to disk after every refresh.
+    """
+
+    def __init__(self, client, mic: Optional[str], path: str = 'instruments.json', refresh_interval: float = 86400.0,
+                 page_size: int = 100):
+        self.client = client
+        self.mic = mic
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+
+        self._snapshot = _Snapshot([], 0.0)
+        self._loaded_mtime = None
+        self._thread = None
+        # set once the index has been loaded from disk or downloaded, or the first download failed
+        self.loaded = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self._snapshot.instruments)
+
+    def start(self) -> None:
+        """Loads the snapshot from disk and keeps refreshing the index, all in the background.
+
+        Until `loaded` is set, searches find nothing and the bot searches the API instead.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='instrument-index', daemon=True)
+            self._thread.start()
+
+    def follow(self, interval: float = 60.0) -> None:
+        """Loads the snapshot from disk and reloads it whenever another process has saved a newer one.
+
+        Used by the workers of a sharded deployment, where only the ingress process refreshes the index.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._follow, args=(interval,), name='instrument-index',
+                                            daemon=True)
+            self._thread.start()
+
+    def get(self, isin: str) -> Optional[IndexedInstrument]:
+        """Returns the instrument with the given ISIN, or None if it is not indexed."""
+        return self._snapshot.by_isin.get(isin.upper())
+
+    def search(self, query: str, instrument_type: Optional[str] = None, limit: int = 10) -> List[IndexedInstrument]:
+        """Resolves a query by ISIN, then by name prefix or name tokens and finally by fuzzy token matches.
+
+        Name matches are ranked so the instrument a user most likely means comes first: exact names or titles, then
+        names containing every word of the query, then shorter names.
+        """
+        snapshot = self._snapshot
+        if not snapshot.instruments:
+            return []
+
+        candidates = []
+        if ISIN_PATTERN.match(query.upper()) and query.upper() in snapshot.by_isin:
+            candidates.append(query.upper())
+
+        normalised = _normalise(query)
+        if normalised:
+            tokens = normalised.split()
+            matches = set(self._prefix_matches(snapshot, normalised)).union(self._token_matches(snapshot, tokens))
+            candidates.extend(sorted(matches, key=lambda isin: self._rank(snapshot, isin, normalised, tokens)))
+
+            # tolerate typos by matching every query token against the closest known tokens
+            fuzzy_tokens = []
+            for token in tokens:
+                fuzzy_tokens.append(difflib.get_close_matches(token, snapshot.vocabulary, n=3, cutoff=0.8))
+            if all(fuzzy_tokens):
+                for combination in zip(*fuzzy_tokens):
+                    candidates.extend(self._token_matches(snapshot, combination))
+
+        results = []
+        seen = set()
+        for isin in candidates:
+            instrument = snapshot.by_isin[isin]
+            if isin in seen or (instrument_type and instrument.type != instrument_type):
+                continue
+            seen.add(isin)
+            results.append(instrument)
+            if len(results) == limit:
+                break
+        return results
+
+    @staticmethod
+    def _prefix_matches(snapshot: _Snapshot, prefix: str) -> List[str]:
+        matches = []
+        position = bisect.bisect_left(snapshot.keys, (prefix, ''))
+        while position < len(snapshot.keys) and snapshot.keys[position][0].startswith(prefix):
+            matches.append(snapshot.keys[position][1])
+            position += 1
+        return matches
+
+    @staticmethod
+    def _rank(snapshot: _Snapshot, isin: str, normalised: str, tokens: List[str]) -> tuple:
+        query_tokens = set(tokens)
+        return min((text != normalised, not query_tokens.issubset(text.split()), len(text), text, isin)
+                   for text in snapshot.texts[isin])
+
+    @staticmethod
+    def _token_matches(snapshot: _Snapshot, tokens) -> List[str]:
+        sets = [snapshot.tokens.get(token) for token in tokens]
+        if not sets or not all(sets):
+            return []
+        return sorted(set.intersection(*sets))
+
+    def refresh(self) -> None:
+        """Downloads all tradable instruments of the venue and replaces the index."""
+        instruments = []
+        page = 1
+        while True:
+            results = self.client.market_data.instruments.get(mic=[self.mic] if self.mic else None, tradable=True,
+                                                              limit=self.page_size, page=page).results
+            for instrument in results:
+                instrument_type = getattr(instrument.type, 'value', instrument.type)
+                instruments.append(IndexedInstrument(instrument.isin, instrument.name, instrument.title,
+                                                     str(instrument_type).lower()))
+            if len(results) < self.page_size:
+                break
+            page += 1
+
+        self._snapshot = _Snapshot(instruments, time.time())
+        eventlog.event('instrument_index_refreshed', instruments=len(instruments))
+        self.save()
+
+    def load(self) -> bool:
+        """Loads the index from disk, returns False if there is no usable snapshot."""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return False
+        self._loaded_mtime = mtime
+        if data.get('mic') != self.mic:
+            return False
+        instruments = [IndexedInstrument(*row) for row in data['instruments']]
+        self._snapshot = _Snapshot(instruments, data['loaded_at'])
+        return True
+
+    def save(self) -> None:
+        """Writes the index to disk, replacing the previous snapshot atomically."""
+        snapshot = self._snapshot
+        temporary_path = f'{self.path}.tmp'
+        try:
+            with open(temporary_path, 'w') as file:
+                json.dump({'mic': self.mic, 'loaded_at': snapshot.loaded_at,
+                           'instruments': [list(instrument) for instrument in snapshot.instruments]}, file)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            eventlog.error(e)
+
+    def _follow(self, interval: float) -> None:
+        self.load()
+        self.loaded.set()
+        while True:
+            time.sleep(interval)
+            try:
+                if os.path.getmtime(self.path) != self._loaded_mtime:
+                    self.load()
+            except OSError:
+                pass
+
+    def _run(self) -> None:
+        if self.load():
+            self.loaded.set()
+        while True:
+            age = time.time() - self._snapshot.loaded_at
+            if age < self.refresh_interval:
+                time.sleep(self.refresh_interval - age)
+            try:
+                self.refresh()
+                self.loaded.set()
+            except Exception as e:
+                eventlog.error(e)
+                # searches go to the API until the next attempt
+                self.loaded.set()
+                # retry sooner than the regular interval if the download failed
+                time.sleep(min(self.refresh_interval, 300))
@@ -0,0 +1,31 @@
+import threading
+from typing import Any, Callable
+
+
+class Lazy:
+    """Stands in for an object that is only created by `create()` when one of its attributes is first used.
+
+    Lets modules hand out an expensive object, such as the lemon.markets client with its SDK imports, at import
+    time, while the object is built on first use, possibly from a background thread that warms it up.
+    """
+
+    def __init__(self, create: Callable[[], Any]):
+        self._create = create
+        self._instance = None
+        self._lock = threading.Lock()
+
+    @property
+    def created(self) -> bool:
+        return self._instance is not None
+
+    def get(self) -> Any:
+        """Returns the object, creating it if this is the first use."""
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._create()
+        return self._instance
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for attributes Lazy itself does not have
+        return getattr(self.get(), name)
@@ -1,72 +1,410 @@
 import logging
+import multiprocessing
 import os
-from dotenv import load_dotenv
+import secrets
+import signal
+import threading
+from typing import Callable, Optional
 
-from trading_bot import TradingBot
+import admission
+import chat_workers
+import eventlog
+import metrics
+from persistence import SQLitePersistence
+from readiness import readiness
+from sharding import ShardedIngress
+from trading_bot import (TradingBot, alert_book, client, instrument_cache, instrument_index, lemon_session,
+                         order_watcher, outbox, portfolio_valuer, quote_feed, shared_cache, venue_calendar,
+                         warm_meme_titles, watchlists)
+from webhook import WebhookServer
 
+from telegram import Bot, Update
 from telegram.ext import (
+    CallbackContext,
     Updater,
     CommandHandler,
     MessageHandler,
     Filters,
     ConversationHandler,
+    TypeHandler,
 )
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.DEBUG)
-
 logger = logging.getLogger(__name__)
 
 
-def main() -> None:
-    load_dotenv()
-    """Start the bot."""
+def setup_logging() -> None:
+    """Writes the log as JSON lines to stderr from a background thread, so handlers never wait on log output."""
+    eventlog.setup(level=os.getenv('LOG_LEVEL', 'INFO'), library_level=os.getenv('LIBRARY_LOG_LEVEL', 'WARNING'),
+                   sample_rate=float(os.getenv('LOG_DEBUG_SAMPLE', 0.01)),
+                   slow_handler=float(os.getenv('LOG_SLOW_HANDLER', 1)))
+
+
+def create_webhook_server(bot: Bot, dispatcher=None, route: Optional[Callable[[dict], None]] = None) -> WebhookServer:
+    """Creates the embedded webhook server and registers its public URL with Telegram.
+
+    Only requests carrying the secret token are accepted. Without WEBHOOK_SECRET, a new one is generated and
+    registered along with the URL; if the webhook is set up elsewhere, the bot refuses to start without one.
+    """
+    webhook_url = os.getenv('WEBHOOK_URL')
+    secret_token = os.getenv('WEBHOOK_SECRET')
+    if not secret_token:
+        if not webhook_url:
+            raise RuntimeError('WEBHOOK_SECRET must be set when the webhook is not registered through WEBHOOK_URL')
+        secret_token = secrets.token_urlsafe(32)
+    server = WebhookServer(
+        dispatcher,
+        listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+        port=int(os.getenv('WEBHOOK_PORT', 8443)),
+        url_path=os.getenv('WEBHOOK_PATH', 'telegram'),
+        secret_token=secret_token,
+        route=route,
+    )
+
+    # register the public URL with Telegram, unless the webhook is set up elsewhere
+    if webhook_url:
+        bot.set_webhook(url=webhook_url, api_kwargs={'secret_token': secret_token})
+    return server
+
+
+def stop_on_signals() -> None:
+    """Raises KeyboardInterrupt on SIGTERM, which Heroku sends before every restart, and SIGABRT as on SIGINT, the
+    signals `Updater.idle` stops the bot on in polling mode."""
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, signal.default_int_handler)
+
+
+def start_webhook(updater: Updater) -> None:
+    """Receives updates through the embedded webhook server instead of long polling, until the process is told to
+    stop."""
+    server = create_webhook_server(updater.bot, dispatcher=updater.dispatcher)
+    stop_on_signals()
+    updater.job_queue.start()
+    thread = server.start()
+    logger.info('Webhook server listening on port %s', server.server_address[1])
+    readiness.done('receiving')
+
+    try:
+        while thread.is_alive():
+            thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # write out what the persistence still holds, as `Updater.idle` does on these signals
+        server.stop()
+        updater.job_queue.stop()
+        if updater.persistence:
+            updater.dispatcher.update_persistence()
+            updater.persistence.flush()
+
+
+def register_metrics(bot: TradingBot, updater: Updater, engine=None,
+                     control: Optional[admission.AdmissionControl] = None,
+                     workers: Optional[chat_workers.ChatWorkers] = None) -> None:
+    """Exposes queue depths, cache hit ratios and other counters the bot already keeps as metrics."""
+    registry = metrics.registry
+    registry.callback('bot_update_queue', 'Updates waiting for a dispatcher worker.',
+                      lambda: updater.dispatcher.update_queue.qsize() + (workers.pending() if workers else 0))
+    registry.callback('bot_sessions', 'Conversations kept in memory.', lambda: len(bot.sessions))
+    registry.callback('bot_session_bytes', 'Approximate memory held by conversations.', bot.sessions.memory)
+    registry.callback('bot_sessions_evicted_total', 'Conversations dropped to stay within MAX_SESSIONS.',
+                      lambda: bot.sessions.evicted, type='counter')
+    if engine is not None:
+        registry.callback('bot_async_chats', 'Conversations of the async engine.', lambda: len(engine.chats))
+    if control is not None:
+        registry.callback('bot_admissions_total', 'Updates admitted to the dispatcher or turned away, by reason.',
+                          lambda: {'admitted': control.admitted, **control.rejected}, labels=['result'],
+                          type='counter')
+    registry.callback('bot_pending_orders', 'Activated orders that are polled until they fill.', order_watcher.pending)
+    registry.callback('bot_outbox_pending', 'Messages queued in the outbox.', outbox.pending)
+    registry.callback('bot_outbox_messages_total', 'Messages the outbox sent, merged into others or retried.',
+                      lambda: {'sent': outbox.sent, 'merged': outbox.merged, 'retried': outbox.retried},
+                      labels=['result'], type='counter')
+    registry.callback('bot_alerts', 'Price alerts waiting to fire.', lambda: len(alert_book))
+    registry.callback('bot_persistence_writes_total', 'Batches written to the database.',
+                      lambda: updater.persistence.writes, type='counter')
+
+    caches = {'instruments': instrument_cache, 'quotes': quote_feed, 'portfolio': portfolio_valuer}
+    if shared_cache is not None:
+        caches['shared'] = shared_cache
+    registry.callback('bot_cache_hits_total', 'Lookups answered from a cache.',
+                      lambda: {name: cache.hits for name, cache in caches.items()}, labels=['cache'], type='counter')
+    registry.callback('bot_cache_misses_total', 'Lookups a cache could not answer.',
+                      lambda: {name: cache.misses for name, cache in caches.items()}, labels=['cache'],
+                      type='counter')
+    registry.callback('bot_cache_hit_ratio', 'Share of lookups answered from a cache.',
+                      lambda: {name: cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else 0.0
+                               for name, cache in caches.items()}, labels=['cache'])
+
+    registry.callback('bot_upstream_retries_total', 'lemon.markets API requests that were retried.',
+                      lambda: lemon_session.retried, type='counter')
+    registry.callback('bot_upstream_stale_total', 'lemon.markets API calls answered from the last good response.',
+                      lambda: lemon_session.stale_served, type='counter')
+    registry.callback('bot_ready', 'Whether the bot has started and warmed up its reference data.',
+                      lambda: int(readiness.ready.is_set()))
+    registry.callback('bot_startup_seconds', 'Seconds after startup began at which each step of it was done.',
+                      lambda: dict(readiness.steps), labels=['step'])
+    registry.callback('bot_log_records_dropped_total', 'Log records dropped because the log queue was full.',
+                      lambda: eventlog.queue_handler.dropped if eventlog.queue_handler else 0, type='counter')
+    registry.callback('bot_circuit_open', 'Whether the circuit breaker of a lemon.markets API host is open.',
+                      lambda: {host: int(breaker.is_open) for host, breaker in list(lemon_session.breakers.items())},
+                      labels=['host'])
+
+
+def serve_metrics(offset: int = 0) -> None:
+    """Serves /metrics, /profile and /ready if METRICS_PORT is set, on METRICS_PORT + `offset`."""
+    if os.getenv('METRICS_PORT'):
+        server = metrics.serve(int(os.getenv('METRICS_PORT')) + offset, readiness=readiness)
+        logger.info('Serving metrics on port %s', server.server_address[1])
+
+
+def create_updater(persistence_path: str, shard: Optional[int] = None) -> Updater:
+    """Creates the updater with all handlers and jobs registered, without receiving updates yet.
+
+    Reference data is loaded in the background meanwhile; the bot is ready once it is loaded and updates are received.
+    """
+    readiness.expect('receiving')
+    if shard is None:
+        # load the instrument snapshot from disk and keep it up to date in the background
+        instrument_index.start()
+    else:
+        # the ingress process refreshes the snapshot for all workers
+        instrument_index.follow()
+    # fetch the venue schedule once and refresh it at opening and closing times
+    venue_calendar.start()
+    # the lemon SDK is imported and the client created by whichever of these needs it first
+    readiness.warm('client', client.get)
+    readiness.warm('instruments', instrument_index.loaded.wait)
+    readiness.warm('venue', venue_calendar.loaded.wait)
+    readiness.warm('memes', warm_meme_titles)
+    # the ingress of a sharded deployment serves on METRICS_PORT, worker n on METRICS_PORT + n + 1
+    serve_metrics(shard + 1 if shard is not None else 0)
+
+    # conversations, sessions and watched orders are kept on disk so they survive a restart
+    persistence = SQLitePersistence(persistence_path)
+    persistence.start()
+
     # Create the Updater and pass it to your bot's token.
-    updater = Updater(os.getenv('BOT_TOKEN'), use_context=True)
+    # the connection pool to Telegram is sized for the workers
+    updater = Updater(os.getenv('BOT_TOKEN'), use_context=True,
+                      workers=int(os.getenv('BOT_WORKERS', 4)),
+                      base_url=os.getenv('TELEGRAM_BASE_URL'),
+                      persistence=persistence)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
+    # one handler instance for all chats, holding every chat's session
+    confirmation_timeout = float(os.getenv('CONFIRMATION_TIMEOUT', TradingBot.STATE_TIMEOUTS[TradingBot.QUANTITY]))
+    bot = TradingBot(
+        default_timeout=float(os.getenv('CONVERSATION_TIMEOUT', TradingBot.DEFAULT_TIMEOUT)),
+        state_timeouts={TradingBot.QUANTITY: confirmation_timeout, TradingBot.QUICK: confirmation_timeout,
+                        TradingBot.BASKET_CONFIRMATION: confirmation_timeout},
+        persistence=persistence,
+    )
+    # pick up watching the orders that were not finished before the restart
+    eventlog.event('restored', orders=order_watcher.resume(persistence, updater.bot),
+                   alerts=alert_book.resume(persistence), watchlists=watchlists.resume(persistence))
 
     conv_handler = ConversationHandler(
         # initiate the conversation
-        entry_points=[CommandHandler('trade', TradingBot().trade)],
+        entry_points=[CommandHandler('trade', bot.trade)],
         # different conversation steps and handlers that should be used if user sends a message
         # when conversation with them is currently in that state
         states={
             TradingBot.TYPE: [MessageHandler(Filters.regex('^(Stock|stock|ETF|etf)$') & ~Filters.regex('^/'),
-                                             TradingBot().get_search_query)],
-            TradingBot.REPLY: [MessageHandler(Filters.text & ~Filters.regex('^/'), TradingBot().get_instrument_name)],
-            TradingBot.NAME: [MessageHandler(Filters.text & ~Filters.regex('^/'), TradingBot().get_isin)],
-            TradingBot.ISIN: [MessageHandler(Filters.text & ~Filters.regex('^/'), TradingBot().get_side)],
-            TradingBot.SIDE: [MessageHandler(Filters.text & ~Filters.regex('^/'), TradingBot().get_quantity)],
-            TradingBot.QUANTITY: [MessageHandler(Filters.text & ~Filters.regex('^/'), TradingBot().confirm_order)],
-            TradingBot.CONFIRMATION: [MessageHandler(Filters.text, TradingBot().complete_order)]
+                                             bot.get_search_query)],
+            TradingBot.REPLY: [MessageHandler(Filters.text & ~Filters.regex('^/'), bot.get_instrument_name)],
+            TradingBot.NAME: [MessageHandler(Filters.text & ~Filters.regex('^/'), bot.get_isin)],
+            TradingBot.ISIN: [MessageHandler(Filters.text & ~Filters.regex('^/'), bot.get_side)],
+            TradingBot.SIDE: [MessageHandler(Filters.text & ~Filters.regex('^/'), bot.get_quantity)],
+            TradingBot.QUANTITY: [MessageHandler(Filters.text & ~Filters.regex('^/'), bot.confirm_order)],
+            TradingBot.CONFIRMATION: [MessageHandler(Filters.text, bot.complete_order)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, bot.expire)],
         },
         # if user currently in conversation but state has no handler or handle inappropriate for update
-        fallbacks=[CommandHandler(('cancel', 'end'), TradingBot().cancel)],
+        fallbacks=[CommandHandler(('cancel', 'end'), bot.cancel)],
+        # end conversations nobody has answered for the longest state timeout; the sweeper ends shorter ones
+        conversation_timeout=bot.default_timeout,
+        name='trade',
+        persistent=True,
     )
 
     quick_conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('quicktrade', TradingBot().quick_trade)],
+        entry_points=[CommandHandler('quicktrade', bot.quick_trade)],
         states={
             TradingBot.QUICKTRADE: [
-                MessageHandler(Filters.text & ~Filters.regex('^/'), TradingBot().perform_quicktrade)],
-            TradingBot.QUICK: [MessageHandler(Filters.text & ~Filters.regex('^/'), TradingBot().confirm_quicktrade)],
+                MessageHandler(Filters.text & ~Filters.regex('^/'), bot.perform_quicktrade)],
+            TradingBot.QUICK: [MessageHandler(Filters.text & ~Filters.regex('^/'), bot.confirm_quicktrade)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, bot.expire)],
         },
-        fallbacks=[CommandHandler('cancel', TradingBot().cancel)]
+        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        conversation_timeout=bot.default_timeout,
+        name='quicktrade',
+        persistent=True,
     )
 
-    positions_handler = CommandHandler('positions', TradingBot().show_positions)
-    start_handler = CommandHandler('start', TradingBot().start)
-    moon_handler = CommandHandler('moon', TradingBot().to_the_moon)
+    basket_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('basket', bot.basket)],
+        states={
+            TradingBot.BASKET: [MessageHandler(Filters.text & ~Filters.regex('^/'), bot.perform_basket)],
+            TradingBot.BASKET_CONFIRMATION: [MessageHandler(Filters.text & ~Filters.regex('^/'), bot.confirm_basket)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, bot.expire)],
+        },
+        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        conversation_timeout=bot.default_timeout,
+        name='basket',
+        persistent=True,
+    )
+
+    positions_handler = CommandHandler('positions', bot.show_positions)
+    portfolio_handler = CommandHandler('portfolio', bot.show_portfolio)
+    start_handler = CommandHandler('start', bot.start)
+    moon_handler = CommandHandler('moon', bot.to_the_moon)
+    alert_handlers = [
+        CommandHandler('alert', bot.alert),
+        CommandHandler('unalert', bot.unalert),
+        CommandHandler('watch', bot.watch),
+        CommandHandler('unwatch', bot.unwatch),
+    ]
     dispatcher.add_handler(start_handler)
-    dispatcher.add_handler(conv_handler)
+    engine = None
+    if os.getenv('BOT_ENGINE', 'threaded') == 'async':
+        # run /trade and /quicktrade as coroutines instead of on the dispatcher's worker threads
+        from async_bot import AsyncEngine, AsyncEngineHandler
+
+        engine = AsyncEngine(updater.bot, os.getenv('BOT_TOKEN'), base_url=os.getenv('TELEGRAM_BASE_URL'),
+                             connections=int(os.getenv('ASYNC_CONNECTIONS', 100)), persistence=persistence)
+        engine.start()
+        dispatcher.add_handler(AsyncEngineHandler(engine))
+        bot.on_end_conversations = engine.end
+    else:
+        dispatcher.add_handler(conv_handler)
+        dispatcher.add_handler(quick_conv_handler)
+        bot.conversation_handlers.extend([conv_handler, quick_conv_handler])
+        eventlog.event('sessions_restored', sessions=bot.recover())
+    # /basket is handled on the chat workers with either engine, so while it waits on its upstream calls it only
+    # holds up its own chat
+    dispatcher.add_handler(basket_conv_handler)
+    bot.conversation_handlers.append(basket_conv_handler)
     dispatcher.add_handler(moon_handler)
     dispatcher.add_handler(positions_handler)
-    dispatcher.add_handler(quick_conv_handler)
+    dispatcher.add_handler(portfolio_handler)
+    for handler in alert_handlers:
+        dispatcher.add_handler(handler)
+
+    # turn away duplicates, floods of a single chat and, once the backlog is too long, everything new
+    control = admission.AdmissionControl(max_in_flight=int(os.getenv('MAX_IN_FLIGHT', 3)),
+                                         duplicate_window=float(os.getenv('DUPLICATE_WINDOW', 2)),
+                                         max_backlog=int(os.getenv('MAX_BACKLOG', 1000)))
+    # run the handlers on BOT_WORKERS threads, each chat's updates one at a time and in order
+    workers = chat_workers.install(dispatcher, workers=int(os.getenv('BOT_WORKERS', 4)))
+    if engine is not None:
+        control.pending = engine.pending
+    control.backlog = lambda: workers.pending() + (engine.pending() if engine is not None else 0)
+    admission.install(updater, control, lambda chat_id, text: outbox.send(updater.bot, chat_id, text))
+
+    def sweep(context: CallbackContext) -> None:
+        bot.sweep(context)
+        if engine is not None:
+            engine.sweep(bot.timeout)
+
+    def schedule_jobs() -> None:
+        # expire idle sessions and report how many are live, right away so sessions expire even if warming up stalls
+        updater.job_queue.run_repeating(sweep, interval=float(os.getenv('SWEEP_INTERVAL', 60)))
+        # quote every instrument with alerts at once and notify the chats whose alerts fire, once the reference data
+        # the quotes need is warmed up
+        readiness.ready.wait()
+        updater.job_queue.run_repeating(bot.check_alerts, interval=float(os.getenv('ALERT_INTERVAL', 5)))
+
+    # apscheduler loads the trigger of the first repeating job through pkg_resources, which parses the requirements
+    # of every installed package; the jobs are added from their own thread, so this never holds up the first replies
+    threading.Thread(target=schedule_jobs, name='schedule-jobs', daemon=True).start()
+
+    register_metrics(bot, updater, engine, control, workers)
+    return updater
+
+
+def shard_path(path: str, index: int) -> str:
+    """Returns the database path of a worker, e.g. bot-2.db for bot.db."""
+    root, extension = os.path.splitext(path)
+    return f'{root}-{index}{extension}'
+
+
+def run_worker(index: int, updates: multiprocessing.Queue) -> None:
+    """Handles the updates the ingress routes to this worker process, with its own database."""
+    setup_logging()
+    # the ingress receives the same signals and stops the workers once they have handled what is queued for them
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_IGN)
+    updater = create_updater(shard_path(os.getenv('PERSISTENCE_PATH', 'bot.db'), index), shard=index)
+    # all workers send through the same bot, so together they must stay within its flood limit
+    outbox.share(int(os.getenv('BOT_SHARDS', 1)))
+    dispatcher = updater.dispatcher
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    updater.job_queue.start()
+    readiness.done('receiving')
+    eventlog.event('worker_started', worker=index)
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(data, updater.bot))
+    updater.job_queue.stop()
+    dispatcher.stop()
+    updater.persistence.flush()
+
+
+def run_sharded(shards: int) -> None:
+    """Receives updates in this process and hands them to `shards` worker processes, all updates of a chat to the
+    same worker."""
+    # quotes and the venue are fetched once for all workers
+    os.environ.setdefault('SHARED_CACHE_PATH', 'shared.db')
+    telegram_bot = Bot(os.getenv('BOT_TOKEN'), base_url=os.getenv('TELEGRAM_BASE_URL'))
+    ingress = ShardedIngress(telegram_bot, shards, run_worker)
+    ingress.start()
+    metrics.registry.callback('bot_routed_updates_total', 'Updates routed to each worker.',
+                              lambda: {str(index): count for index, count in enumerate(ingress.routed)},
+                              labels=['shard'], type='counter')
+    metrics.registry.callback('bot_worker_restarts_total', 'Workers started again after they exited.',
+                              lambda: ingress.restarts, type='counter')
+    serve_metrics()
+    # refresh the instrument snapshot the workers read
+    instrument_index.start()
+    readiness.warm('instruments', instrument_index.loaded.wait)
+    readiness.done('receiving')
+
+    stop_on_signals()
+    try:
+        if os.getenv('BOT_MODE', 'polling') == 'webhook':
+            server = create_webhook_server(telegram_bot, route=ingress.route)
+            thread = server.start()
+            logger.info('Webhook server listening on port %s', server.server_address[1])
+            while thread.is_alive():
+                thread.join(1)
+        else:
+            ingress.poll()
+    except KeyboardInterrupt:
+        pass
+    ingress.stop()
+
+
+def main() -> None:
+    """Start the bot."""
+    setup_logging()
+    shards = int(os.getenv('BOT_SHARDS', 1))
+    if shards > 1:
+        run_sharded(shards)
+        return
+
+    updater = create_updater(os.getenv('PERSISTENCE_PATH', 'bot.db'))
+
+    # Start the Bot, polling for updates unless webhook mode is configured
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        start_webhook(updater)
+        return
 
-    # Start the Bot
     updater.start_polling()
+    readiness.done('receiving')
 
     # Run the Bot until you press Ctrl-C
     updater.idle()
@@ -0,0 +1,288 @@
+import asyncio
+import bisect
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import eventlog
+
+# latency buckets in seconds, from a cached lookup to a slow order
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """Monotonically increasing count per label values."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_labels(self.labels, labels)} {value}' for labels, value in values]
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets per label values, as Prometheus expects them."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def totals(self) -> Dict[tuple, Tuple[int, float]]:
+        """Returns the number and the sum of the observed values per label values."""
+        with self._lock:
+            return {labels: (sum(counts), total) for labels, (counts, total) in self._values.items()}
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                samples.append(f'{self.name}_bucket{_labels((*self.labels, "le"), (*labels, bound))} {cumulative}')
+            samples.append(f'{self.name}_sum{_labels(self.labels, labels)} {total}')
+            samples.append(f'{self.name}_count{_labels(self.labels, labels)} {cumulative}')
+        return samples
+
+
+class Callback:
+    """Metric whose values are read from the bot's own counters and queues whenever the metrics are scraped.
+
+    `callback` returns a single value, or a dict of label values to values.
+    """
+
+    def __init__(self, name: str, help: str, callback: Callable, labels: Iterable[str] = (), type: str = 'gauge'):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labels = tuple(labels)
+        self.type = type
+
+    def samples(self) -> List[str]:
+        try:
+            values = self.callback()
+        except Exception as e:
+            eventlog.error(e, metric=self.name)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f'{self.name}{_labels(self.labels, labels if isinstance(labels, tuple) else (labels,))} {value}'
+                for labels, value in values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = ()) -> Histogram:
+        return self.register(Histogram(name, help, labels))
+
+    def callback(self, name: str, help: str, callback: Callable, labels: Iterable[str] = (),
+                 type: str = 'gauge') -> Callback:
+        return self.register(Callback(name, help, callback, labels, type))
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    """Profiles a sample of the calls of selected handlers with cProfile and sums up the results.
+
+    Only calls of handlers in `handlers` ('*' for all) are profiled, each with probability `rate`.
+    """
+
+    def __init__(self, handlers: Iterable[str] = (), rate: float = 0.01):
+        self.handlers = set(handlers)
+        self.rate = rate
+        self.profiled = 0
+        self._stats: Optional[pstats.Stats] = None
+        self._lock = threading.Lock()
+
+    def start(self, handler: str) -> Optional[cProfile.Profile]:
+        if not self.handlers or (handler not in self.handlers and '*' not in self.handlers) or \
+                random.random() >= self.rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # only one profiler can be active at a time on newer Pythons, skip this call then
+            return None
+        return profile
+
+    def stop(self, profile: cProfile.Profile) -> None:
+        profile.disable()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.profiled += 1
+
+    def report(self, limit: int = 40) -> str:
+        """Returns the functions with the most cumulative time over all profiled calls."""
+        with self._lock:
+            if self._stats is None:
+                return 'No calls profiled yet, set PROFILE_HANDLERS to profile handlers.\n'
+            output = io.StringIO()
+            self._stats.stream = output
+            output.write(f'{self.profiled} profiled calls\n')
+            self._stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+
+registry = Registry()
+handler_seconds = registry.histogram('bot_handler_seconds', 'Time spent in bot handlers.', ['handler'])
+handler_errors = registry.counter('bot_handler_errors_total', 'Exceptions raised by bot handlers.', ['handler'])
+upstream_seconds = registry.histogram('bot_upstream_seconds', 'Latency of lemon.markets API calls, including retries.',
+                                      ['operation'])
+upstream_errors = registry.counter('bot_upstream_errors_total', 'lemon.markets API calls that failed.', ['operation'])
+profiler = Profiler([handler for handler in os.getenv('PROFILE_HANDLERS', '').split(',') if handler],
+                    rate=float(os.getenv('PROFILE_RATE', 0.01)))
+
+
+def timed(handler):
+    """Records the latency and exceptions of a handler, logs them with the chat and the state the handler returned,
+    and profiles a sample of its calls if configured."""
+    name = handler.__name__
+
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def timed_coroutine(*args, **kwargs):
+            token = eventlog.begin(name, eventlog.chat_id_of(args))
+            started = time.perf_counter()
+            state = error = None
+            try:
+                state = await handler(*args, **kwargs)
+                return state
+            except Exception as e:
+                handler_errors.inc(name)
+                error = e
+                raise
+            finally:
+                seconds = time.perf_counter() - started
+                handler_seconds.observe(seconds, name)
+                eventlog.end(token, seconds, state, error)
+        return timed_coroutine
+
+    @functools.wraps(handler)
+    def timed_handler(*args, **kwargs):
+        profile = profiler.start(name)
+        token = eventlog.begin(name, eventlog.chat_id_of(args))
+        started = time.perf_counter()
+        state = error = None
+        try:
+            state = handler(*args, **kwargs)
+            return state
+        except Exception as e:
+            handler_errors.inc(name)
+            error = e
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            handler_seconds.observe(seconds, name)
+            eventlog.end(token, seconds, state, error)
+            if profile is not None:
+                profiler.stop(profile)
+    return timed_handler
+
+
+def operation(method: str, path: str) -> str:
+    """Returns the label of an API call without ids, e.g. 'POST orders/:id/activate'."""
+    # the first segment is the API version
+    segments = [segment for segment in path.split('/') if segment][1:]
+    return f'{method.upper()} ' + '/'.join(segment if segment.isalpha() else ':id' for segment in segments)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        readiness = getattr(self.server, 'readiness', None)
+        if self.path.rstrip('/') == '/metrics':
+            self._respond(registry.render(), 'text/plain; version=0.0.4')
+        elif self.path.rstrip('/') == '/profile':
+            self._respond(profiler.report(), 'text/plain')
+        elif self.path.rstrip('/') == '/ready' and readiness is not None:
+            status = readiness.status()
+            self._respond(json.dumps(status), 'application/json', 200 if status['ready'] else 503)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def _respond(self, body: str, content_type: str, code: int = 200) -> None:
+        data = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def serve(port: int, listen: str = '0.0.0.0', readiness=None) -> ThreadingHTTPServer:
+    """Serves /metrics in the Prometheus format and /profile from a background thread, and with a `readiness`
+    /ready, which answers 503 until the bot is ready and 200 after."""
+    server = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    server.readiness = readiness
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,191 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Optional
+
+from telegram import Bot, ReplyKeyboardMarkup, ReplyMarkup
+
+import eventlog
+from outbox import ORDER, MessageScheduler
+
+# order statuses after which polling stops without an execution price
+FAILED_STATUSES = ('canceled', 'cancelled', 'expired', 'rejected')
+# sent instead of the executed text if an executed order still has no price at its deadline
+EXECUTED_WITHOUT_PRICE_TEXT = 'Your order was executed, but its execution price is not available yet.'
+
+
+class PendingOrder:
+    """Activated order that is polled until it is executed, fails or runs past its deadline."""
+
+    def __init__(self, order_id: str, chat_id: int, bot: Bot, executed_text: str, timeout_text: str,
+                 failed_text: str, reply_markup: Optional[ReplyMarkup], deadline: float, interval: float):
+        self.order_id = order_id
+        self.chat_id = chat_id
+        self.bot = bot
+        self.executed_text = executed_text
+        self.timeout_text = timeout_text
+        self.failed_text = failed_text
+        self.reply_markup = reply_markup
+        self.deadline = deadline
+        self.interval = interval
+
+    def to_dict(self) -> dict:
+        return {
+            'order_id': self.order_id,
+            'chat_id': self.chat_id,
+            'executed_text': self.executed_text,
+            'timeout_text': self.timeout_text,
+            'failed_text': self.failed_text,
+            'reply_markup': self.reply_markup.to_dict() if self.reply_markup is not None else None,
+            # wall clock time, since the monotonic clock starts over with the process
+            'deadline': time.time() + self.deadline - time.monotonic(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, bot: Bot, interval: float) -> 'PendingOrder':
+        reply_markup = data['reply_markup']
+        if reply_markup is not None:
+            reply_markup = ReplyKeyboardMarkup.de_json(reply_markup, bot)
+        return cls(data['order_id'], data['chat_id'], bot, data['executed_text'], data['timeout_text'],
+                   data['failed_text'], reply_markup, deadline=time.monotonic() + data['deadline'] - time.time(),
+                   interval=interval)
+
+
+class OrderWatcher:
+    """Polls all pending orders from a single background thread and notifies the chat once an order fills.
+
+    Handlers register an order with `watch` and return straight away instead of blocking a dispatcher worker
+    in a polling loop.
+    """
+
+    def __init__(self, client, initial_interval: float = 1.0, max_interval: float = 10.0, backoff: float = 1.5,
+                 timeout: float = 180.0, outbox: Optional[MessageScheduler] = None):
+        self.client = client
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        # notifications are queued ahead of informational messages if an outbox is given
+        self.outbox = outbox
+        # saves watched orders so they can be resumed after a restart, see `resume`
+        self.persistence = None
+
+        # min-heap of (next poll time, sequence number, order) so the most urgent order is always on top
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, order_id: str, chat_id: int, bot: Bot,
+              executed_text: str = 'Your order was executed at €{price:,.2f} per share.',
+              timeout_text: str = 'We\'re currently experiencing some delays. Your order was not executed. '
+                                  'Please try again later.',
+              failed_text: str = 'Your order was {status}.',
+              reply_markup: Optional[ReplyMarkup] = None,
+              timeout: Optional[float] = None) -> None:
+        """Registers an activated order. `executed_text` is formatted with the execution price in euros."""
+        now = time.monotonic()
+        order = PendingOrder(order_id, chat_id, bot, executed_text, timeout_text, failed_text, reply_markup,
+                             deadline=now + (timeout if timeout is not None else self.timeout),
+                             interval=self.initial_interval)
+        if self.persistence is not None:
+            self.persistence.save_order(order_id, order.to_dict())
+        self._schedule(order, now + order.interval)
+
+    def resume(self, persistence, bot: Bot) -> int:
+        """Saves watched orders from now on and watches the orders saved before the last restart again.
+
+        Returns the number of resumed orders; those past their deadline are checked once more right away.
+        """
+        self.persistence = persistence
+        orders = [PendingOrder.from_dict(data, bot, self.initial_interval) for data in persistence.load_orders()]
+        for order in orders:
+            self._schedule(order, time.monotonic())
+        return len(orders)
+
+    def _schedule(self, order: PendingOrder, due: float) -> None:
+        with self._condition:
+            self._push(due, order)
+            self._ensure_started()
+            self._condition.notify()
+
+    def pending(self) -> int:
+        """Returns the number of orders that are still being watched."""
+        with self._condition:
+            return len(self._queue)
+
+    def _push(self, due: float, order: PendingOrder) -> None:
+        heapq.heappush(self._queue, (due, next(self._counter), order))
+
+    def _ensure_started(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='order-watcher', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    self._condition.wait(self._queue[0][0] - time.monotonic() if self._queue else None)
+                due_orders = []
+                now = time.monotonic()
+                while self._queue and self._queue[0][0] <= now:
+                    due_orders.append(heapq.heappop(self._queue)[2])
+
+            for order in due_orders:
+                try:
+                    done = self._poll(order)
+                except Exception as e:
+                    # one broken order must not stop the thread watching all others
+                    eventlog.error(e, chat_id=order.chat_id, order_id=order.order_id)
+                    done = time.monotonic() >= order.deadline
+                if done:
+                    if self.persistence is not None:
+                        self.persistence.delete_order(order.order_id)
+                else:
+                    order.interval = min(order.interval * self.backoff, self.max_interval)
+                    with self._condition:
+                        self._push(time.monotonic() + order.interval, order)
+
+    def _poll(self, order: PendingOrder) -> bool:
+        """Checks a single order, returns True once the order no longer needs to be watched."""
+        try:
+            summary = self.client.trading.orders.get_order(order.order_id).results
+        except Exception as e:
+            eventlog.error(e)
+            summary = None
+
+        if summary is not None and summary.status == 'executed':
+            price = getattr(summary, 'executed_price', None)
+            # the price may be filled in after the status, so the order is polled again until its deadline
+            if price is None and time.monotonic() < order.deadline:
+                return False
+            eventlog.event('order_executed', chat_id=order.chat_id, order_id=order.order_id)
+            self._send(order, order.executed_text.format(price=price / 10000) if price is not None
+                       else EXECUTED_WITHOUT_PRICE_TEXT)
+            return True
+
+        if summary is not None and summary.status in FAILED_STATUSES:
+            self._send(order, order.failed_text.format(status=summary.status))
+            return True
+
+        if time.monotonic() >= order.deadline:
+            # delete order that was not executed in time
+            try:
+                self.client.trading.orders.cancel(order.order_id)
+            except Exception as e:
+                eventlog.error(e)
+            self._send(order, order.timeout_text)
+            return True
+
+        return False
+
+    def _send(self, order: PendingOrder, text: str) -> None:
+        if self.outbox is not None:
+            self.outbox.send(order.bot, order.chat_id, text, order.reply_markup, priority=ORDER)
+            return
+        try:
+            order.bot.send_message(chat_id=order.chat_id, text=text, reply_markup=order.reply_markup)
+        except Exception as e:
+            eventlog.error(e)
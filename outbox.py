@@ -0,0 +1,213 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from telegram import Bot, ReplyMarkup
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import RetryAfter
+
+import eventlog
+
+# priorities, lower values are sent first
+ORDER, INFO = 0, 1
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and bursts of up to `capacity` events."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        # a bucket created after `now` was taken must not lose tokens
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Returns the seconds until a token is available."""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class OutgoingMessage:
+    __slots__ = ('bot', 'chat_id', 'text', 'reply_markup', 'priority')
+
+    def __init__(self, bot: Bot, chat_id: int, text: str, reply_markup: Optional[ReplyMarkup], priority: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.priority = priority
+
+
+class MessageScheduler:
+    """Sends messages within Telegram's flood limits from a background thread.
+
+    A global token bucket and one per chat limit how fast messages go out. Chats are served in order of the most
+    urgent message they have queued, messages within a chat in the order they were queued. Adjacent messages to the
+    same chat are merged into one as long as the result fits into a single message, and a message that hits a
+    flood limit is sent again once the `retry_after` Telegram asked for has passed.
+    """
+
+    def __init__(self, global_rate: float = 25.0, global_burst: float = 5.0, chat_rate: float = 1.0,
+                 chat_burst: float = 3.0, max_in_flight: int = 8):
+        # a bucket lets through up to rate + burst messages in any second, which stays below Telegram's 30 per second
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+
+        # chat id -> queued messages, token bucket and the time the chat may be sent to again after a 429
+        self._queues: Dict[int, deque] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._paused_until: Dict[int, float] = {}
+        # min-heap of (priority, sequence number, chat id) of chats with queued messages; stale entries are skipped
+        self._ready = []
+        self._counter = itertools.count()
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_in_flight, 'outbox')
+        self._max_in_flight = max_in_flight
+        self._pruned_at = time.monotonic()
+        self._thread = None
+
+    def send(self, bot: Bot, chat_id: int, text: str, reply_markup: Optional[ReplyMarkup] = None,
+             priority: int = INFO) -> None:
+        """Queues a message and returns immediately."""
+        with self._condition:
+            self._queues.setdefault(chat_id, deque()).append(
+                OutgoingMessage(bot, chat_id, text, reply_markup, priority))
+            heapq.heappush(self._ready, (priority, next(self._counter), chat_id))
+            self._ensure_started()
+            self._condition.notify()
+
+    def share(self, parts: int) -> None:
+        """Limits the scheduler to its share of the global rate when `parts` processes send through the same bot."""
+        with self._condition:
+            bucket = self.global_bucket
+            # a bucket below one token could never send
+            self.global_bucket = TokenBucket(bucket.rate / parts, max(1.0, bucket.capacity / parts))
+
+    def pending(self) -> int:
+        """Returns the number of queued messages."""
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _ensure_started(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                if time.monotonic() - self._pruned_at > 60:
+                    self._prune()
+                message, wait = self._next_message()
+                if message is None:
+                    self._condition.wait(wait)
+                    continue
+                self._in_flight.add(message.chat_id)
+            self._executor.submit(self._deliver, message)
+
+    def _next_message(self):
+        """Returns the next message that may be sent now, or None and how long to wait for one."""
+        now = time.monotonic()
+        if len(self._in_flight) >= self._max_in_flight:
+            return None, None
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+
+        deferred = []
+        message = None
+        while self._ready:
+            entry = heapq.heappop(self._ready)
+            chat_id = entry[2]
+            # skip chats that are being sent to or have nothing queued any more
+            if chat_id in self._in_flight or not self._queues.get(chat_id):
+                continue
+            chat_wait = max(self._paused_until.get(chat_id, 0.0) - now, self._bucket(chat_id).wait_time(now))
+            if chat_wait > 0:
+                deferred.append(entry)
+                wait = chat_wait if wait == 0 else min(wait, chat_wait)
+                continue
+            message = self._coalesce(self._queues[chat_id])
+            break
+
+        for entry in deferred:
+            heapq.heappush(self._ready, entry)
+        if message is None:
+            return None, wait or None
+
+        self.global_bucket.take()
+        self._bucket(message.chat_id).take()
+        return message, None
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _coalesce(self, queue: deque) -> OutgoingMessage:
+        """Takes the first message of a chat's queue, merged with the ones after it while they fit."""
+        message = queue.popleft()
+        # a keyboard belongs to the last message it is sent with, so nothing can be appended after one
+        while queue and message.reply_markup is None and queue[0].bot is message.bot and \
+                len(message.text) + 2 + len(queue[0].text) <= MAX_MESSAGE_LENGTH:
+            following = queue.popleft()
+            message = OutgoingMessage(message.bot, message.chat_id, f'{message.text}\n\n{following.text}',
+                                      following.reply_markup, min(message.priority, following.priority))
+            self.merged += 1
+        return message
+
+    def _deliver(self, message: OutgoingMessage) -> None:
+        retry = False
+        try:
+            message.bot.send_message(chat_id=message.chat_id, text=message.text, reply_markup=message.reply_markup)
+            self.sent += 1
+        except RetryAfter as e:
+            retry = True
+            self.retried += 1
+            with self._condition:
+                self._paused_until[message.chat_id] = time.monotonic() + e.retry_after
+        except Exception as e:
+            eventlog.error(e)
+
+        with self._condition:
+            self._in_flight.discard(message.chat_id)
+            queue = self._queues.get(message.chat_id)
+            if retry:
+                queue = self._queues.setdefault(message.chat_id, deque())
+                queue.appendleft(message)
+            if queue:
+                priority = min(queued.priority for queued in queue)
+                heapq.heappush(self._ready, (priority, next(self._counter), message.chat_id))
+            else:
+                # forget chats without queued messages so memory does not grow with every chat ever served
+                self._queues.pop(message.chat_id, None)
+                self._paused_until.pop(message.chat_id, None)
+            self._condition.notify()
+
+    def _prune(self) -> None:
+        """Drops the token buckets of idle chats."""
+        now = self._pruned_at = time.monotonic()
+        for chat_id, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            # a bucket can only be dropped once it is full again, otherwise the chat's rate limit would be reset
+            if bucket.tokens >= bucket.capacity and chat_id not in self._queues:
+                del self._buckets[chat_id]
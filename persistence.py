@@ -0,0 +1,181 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import DefaultDict, List, Optional, Tuple
+
+from telegram.ext import BasePersistence
+from telegram.ext.utils.types import ConversationDict
+
+import eventlog
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state INTEGER, PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS orders (order_id TEXT PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS alerts (alert_id TEXT PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS watchlists (chat_id INTEGER PRIMARY KEY, data TEXT);
+'''
+
+
+class SQLitePersistence(BasePersistence):
+    """Keeps conversation states, chat sessions, watched orders, alerts and watchlists in a SQLite database in WAL
+    mode.
+
+    Saving a row only replaces its pending value in memory. A background thread writes everything pending in one
+    transaction every `flush_interval` seconds, so handlers never wait for the disk and a chat that changes state
+    several times in between is written once.
+    """
+
+    def __init__(self, path: str = 'bot.db', flush_interval: float = 0.5):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=False)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.writes = 0
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode a commit is durable against crashes of the process, only a power loss may lose the last batch
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SCHEMA)
+        self._connection_lock = threading.Lock()
+
+        # table -> primary key -> row to write, or None to delete the row
+        self._pending = {'conversations': {}, 'sessions': {}, 'orders': {}, 'alerts': {}, 'watchlists': {}}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self) -> None:
+        """Starts writing pending rows in the background."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+            self._thread.start()
+
+    # conversations of python-telegram-bot's ConversationHandlers
+
+    def get_conversations(self, name: str) -> ConversationDict:
+        rows = self._select('SELECT key, state FROM conversations WHERE name = ?', (name,))
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        self._set('conversations', (name, json.dumps(key)), new_state)
+
+    # sessions, orders, alerts and watchlists
+
+    def save_session(self, chat_id: int, data: dict) -> None:
+        self._set('sessions', chat_id, json.dumps(data))
+
+    def delete_session(self, chat_id: int) -> None:
+        self._set('sessions', chat_id, None)
+
+    def load_sessions(self) -> List[Tuple[int, dict]]:
+        return [(chat_id, json.loads(data)) for chat_id, data in self._select('SELECT chat_id, data FROM sessions')]
+
+    def save_order(self, order_id: str, data: dict) -> None:
+        self._set('orders', order_id, json.dumps(data))
+
+    def delete_order(self, order_id: str) -> None:
+        self._set('orders', order_id, None)
+
+    def load_orders(self) -> List[dict]:
+        return [json.loads(data) for data, in self._select('SELECT data FROM orders')]
+
+    def save_alert(self, alert_id: str, data: dict) -> None:
+        self._set('alerts', alert_id, json.dumps(data))
+
+    def delete_alert(self, alert_id: str) -> None:
+        self._set('alerts', alert_id, None)
+
+    def load_alerts(self) -> List[dict]:
+        return [json.loads(data) for data, in self._select('SELECT data FROM alerts')]
+
+    def save_watchlist(self, chat_id: int, data: list) -> None:
+        self._set('watchlists', chat_id, json.dumps(data))
+
+    def delete_watchlist(self, chat_id: int) -> None:
+        self._set('watchlists', chat_id, None)
+
+    def load_watchlists(self) -> List[Tuple[int, list]]:
+        return [(chat_id, json.loads(data)) for chat_id, data in self._select('SELECT chat_id, data FROM watchlists')]
+
+    # user, chat and bot data are not stored, the bot keeps its state in sessions
+
+    def get_user_data(self) -> DefaultDict[int, dict]:
+        return defaultdict(dict)
+
+    def get_chat_data(self) -> DefaultDict[int, dict]:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        pass
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    def update_bot_data(self, data: dict) -> None:
+        pass
+
+    def flush(self) -> None:
+        """Writes all pending rows right away, called by python-telegram-bot on shutdown."""
+        self._write()
+
+    def _set(self, table: str, key, row) -> None:
+        with self._lock:
+            self._pending[table][key] = row
+
+    def _select(self, query: str, parameters: tuple = ()) -> list:
+        with self._connection_lock:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self._write()
+            except sqlite3.Error as e:
+                eventlog.error(e)
+
+    def _write(self) -> None:
+        # one batch at a time, so batches are committed in the order they were taken
+        with self._connection_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {table: {} for table in pending}
+            if not any(pending.values()):
+                return
+
+            self._connection.execute('BEGIN')
+            try:
+                self._write_rows(pending)
+                self._connection.execute('COMMIT')
+            except sqlite3.Error:
+                self._connection.execute('ROLLBACK')
+                # keep the batch for the next attempt, unless a row has been changed again in the meantime
+                with self._lock:
+                    for table, rows in pending.items():
+                        for key, row in rows.items():
+                            self._pending[table].setdefault(key, row)
+                raise
+        self.writes += 1
+
+    def _write_rows(self, pending: dict) -> None:
+        conversations = pending['conversations']
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)',
+            [(name, key, state) for (name, key), state in conversations.items() if state is not None])
+        self._connection.executemany(
+            'DELETE FROM conversations WHERE name = ? AND key = ?',
+            [key for key, state in conversations.items() if state is None])
+        for table, key_column in (('sessions', 'chat_id'), ('orders', 'order_id'), ('alerts', 'alert_id'),
+                                  ('watchlists', 'chat_id')):
+            rows = pending[table]
+            self._connection.executemany(
+                f'INSERT OR REPLACE INTO {table} VALUES (?, ?)',
+                [(key, data) for key, data in rows.items() if data is not None])
+            self._connection.executemany(
+                f'DELETE FROM {table} WHERE {key_column} = ?',
+                [(key,) for key, data in rows.items() if data is None])
@@ -0,0 +1,123 @@
+import threading
+import time
+from typing import TYPE_CHECKING, Optional
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# lemon.markets amounts are integers in hundredths of a cent
+PRICE_UNIT = 10000
+
+
+class PortfolioSnapshot:
+    """Valuation of all open positions at one point in time, one array entry per position."""
+
+    def __init__(self, names: list, isins: list, quantity: 'np.ndarray', cost: 'np.ndarray', price: 'np.ndarray'):
+        import numpy as np
+
+        self.names = names
+        self.isins = isins
+        self.quantity = quantity
+        self.cost = cost
+        self.price = price
+        self.taken_at = time.monotonic()
+
+        # all figures in one pass over the arrays instead of a loop over the positions
+        self.value = quantity * price
+        self.invested = quantity * cost
+        self.pnl = self.value - self.invested
+        self.total_value = float(self.value.sum())
+        self.total_invested = float(self.invested.sum())
+        self.total_pnl = self.total_value - self.total_invested
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.pnl_pct = np.where(self.invested != 0, self.pnl / self.invested * 100, 0.0)
+            self.weights = self.value / self.total_value * 100 if self.total_value else np.zeros_like(self.value)
+
+    def __len__(self) -> int:
+        return len(self.isins)
+
+    def render(self, max_lines: int = 40) -> str:
+        """Returns a single message summarising the portfolio, largest positions first."""
+        if not len(self):
+            return 'You do not have any open positions.'
+
+        total_pct = self.total_pnl / self.total_invested * 100 if self.total_invested else 0.0
+        lines = [
+            f'Portfolio value: €{self.total_value:,.2f}',
+            f'Unrealised P&L: €{self.total_pnl:+,.2f} ({total_pct:+.2f}%)',
+            '',
+        ]
+        order = (-self.value).argsort()
+        for shown, i in enumerate(order):
+            line = f'{self.names[i]}: {self.quantity[i]:g} × €{self.price[i]:,.2f} = €{self.value[i]:,.2f} ' \
+                   f'({self.weights[i]:.1f}%), P&L €{self.pnl[i]:+,.2f} ({self.pnl_pct[i]:+.2f}%)'
+            remaining = len(order) - shown
+            if shown == max_lines or sum(map(len, lines)) + len(lines) + len(line) + 40 > MAX_MESSAGE_LENGTH:
+                lines.append(f'... and {remaining} more positions.')
+                break
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def value_positions(positions: list, quotes: dict) -> PortfolioSnapshot:
+    """Values positions at the bid of their latest quote, or the estimate lemon.markets returns if there is none."""
+    # numpy is only imported once a portfolio is valued, so it does not slow down startup
+    import numpy as np
+
+    positions = [position for position in positions if position.quantity != 0]
+    prices = []
+    for position in positions:
+        quote = quotes.get(position.isin)
+        # quotes are in euros, the position's own figures in PRICE_UNIT
+        prices.append(float(quote.b) if quote is not None and quote.b else (position.estimated_price or 0) / PRICE_UNIT)
+    return PortfolioSnapshot(
+        names=[position.isin_title for position in positions],
+        isins=[position.isin for position in positions],
+        quantity=np.array([position.quantity for position in positions], dtype=np.float64),
+        cost=np.array([position.buy_price_avg or 0 for position in positions], dtype=np.float64) / PRICE_UNIT,
+        price=np.array(prices, dtype=np.float64),
+    )
+
+
+class PortfolioValuer:
+    """Values the account's portfolio, reusing a snapshot for `ttl` seconds.
+
+    All positions are fetched page by page and quoted with one batched quote request. Concurrent requests while a
+    snapshot is being taken wait for it instead of taking their own.
+    """
+
+    def __init__(self, client, quote_feed, ttl: float = 10.0, page_size: int = 100):
+        self.client = client
+        self.quote_feed = quote_feed
+        self.ttl = ttl
+        self.page_size = page_size
+        self.hits = 0
+        self.misses = 0
+
+        self._snapshot: Optional[PortfolioSnapshot] = None
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> PortfolioSnapshot:
+        with self._lock:
+            if self._snapshot is not None and time.monotonic() - self._snapshot.taken_at <= self.ttl:
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            positions = self.positions()
+            quotes = self.quote_feed.get_many({position.isin for position in positions if position.quantity != 0},
+                                              missing_ok=True)
+            self._snapshot = value_positions(positions, quotes)
+            return self._snapshot
+
+    def positions(self) -> list:
+        """Returns all positions of the account."""
+        response = self.client.trading.positions.get(limit=self.page_size)
+        positions = list(response.results)
+        page = 1
+        while response.pages is not None and page < response.pages:
+            page += 1
+            response = self.client.trading.positions.get(limit=self.page_size, page=page)
+            positions.extend(response.results)
+        return positions
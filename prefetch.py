@@ -0,0 +1,40 @@
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable
+
+from fanout import submit
+
+
+class Prefetch:
+    """Upstream calls started in the background while the user is still choosing the next step.
+
+    `collect` answers from the prefetched results if they belong to the same key and are younger than `max_age`
+    seconds, and runs the calls live otherwise (or if a prefetched call failed). Calls are started with `start`, on
+    the shared fan-out pool by default; the async engine starts coroutines as tasks instead and awaits `reuse`.
+    """
+
+    def __init__(self, key: Hashable, calls: Dict[str, Callable[[], Any]], max_age: float = 20.0,
+                 start: Callable[[Callable[[], Any]], Future] = submit):
+        self.key = key
+        self.max_age = max_age
+        self.start = start
+        self.started_at = time.monotonic()
+        self.futures: Dict[str, Future] = {name: start(call) for name, call in calls.items()}
+
+    def is_fresh(self, key: Hashable) -> bool:
+        return key == self.key and time.monotonic() - self.started_at <= self.max_age
+
+    def reuse(self, key: Hashable, calls: Dict[str, Callable[[], Any]]) -> Dict[str, Future]:
+        """Returns the futures of `calls`, prefetched ones where possible and newly started ones otherwise."""
+        fresh = self.is_fresh(key)
+        futures = {}
+        for name, call in calls.items():
+            future = self.futures.get(name) if fresh else None
+            if future is None or (future.done() and future.exception() is not None):
+                future = self.start(call)
+            futures[name] = future
+        return futures
+
+    def collect(self, key: Hashable, calls: Dict[str, Callable[[], Any]], timeout: float = 30.0) -> Dict[str, Any]:
+        """Returns the results of `calls`, using prefetched results where possible."""
+        return {name: future.result(timeout=timeout) for name, future in self.reuse(key, calls).items()}
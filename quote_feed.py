@@ -0,0 +1,195 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+import eventlog
+
+
+class QuoteFeed:
+    """Shared source of latest quotes for all chats.
+
+    Quotes younger than `max_age` seconds are answered from memory. Requests for ISINs that are not cached are
+    collected for `batch_window` seconds and fetched with a single batched `get_latest` call, and concurrent
+    requests for the same ISIN share one in-flight request. With a `shared` cache, quotes fetched by other processes
+    within `max_age` are used before asking the API.
+    """
+
+    def __init__(self, client, max_age: float = 0.5, batch_window: float = 0.01, batch_size: int = 10,
+                 timeout: float = 10.0, max_batches: int = 4, shared=None):
+        self.client = client
+        self.max_age = max_age
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+
+        # isin -> (time fetched, quote)
+        self._quotes = {}
+        # isin -> future of a request that has been queued or sent but not answered yet
+        self._in_flight: Dict[str, Future] = {}
+        self._pending = []
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+        # its own workers, since callers may already run on the shared fan-out executor
+        self._executor = ThreadPoolExecutor(max_batches, 'quotes')
+
+    def get(self, isin: str):
+        """Returns the latest quote of a single ISIN."""
+        return self.get_many([isin])[isin]
+
+    def get_many(self, isins: Iterable[str], missing_ok: bool = False) -> dict:
+        """Returns the latest quotes of several ISINs, fetching all missing ones in as few calls as possible.
+
+        With `missing_ok`, ISINs without a quote are left out of the result instead of raising a LookupError.
+        """
+        quotes, futures, leader = self._request(isins)
+        if leader:
+            time.sleep(self.batch_window)
+            self._flush()
+
+        for isin, future in futures.items():
+            try:
+                quotes[isin] = future.result(timeout=self.timeout)
+            except LookupError:
+                if not missing_ok:
+                    raise
+        return quotes
+
+    async def get_async(self, isin: str):
+        """Returns the latest quote of a single ISIN without blocking the event loop.
+
+        The request joins the same batches as `get`, which are sent from the feed's own threads.
+        """
+        quotes, futures, leader = self._request([isin])
+        if leader:
+            self._executor.submit(self._flush_after_window)
+        if isin in quotes:
+            return quotes[isin]
+        return await asyncio.wait_for(asyncio.wrap_future(futures[isin]), self.timeout)
+
+    def _request(self, isins: Iterable[str]) -> Tuple[dict, Dict[str, Future], bool]:
+        """Returns the cached quotes, the futures of the other ISINs and whether the caller has to send the batch."""
+        quotes = {}
+        futures = {}
+        leader = False
+        now = time.monotonic()
+
+        with self._lock:
+            for isin in isins:
+                cached = self._quotes.get(isin)
+                if cached is not None and now - cached[0] <= self.max_age:
+                    self.hits += 1
+                    quotes[isin] = cached[1]
+                    continue
+                self.misses += 1
+                future = self._in_flight.get(isin)
+                if future is None:
+                    future = self._in_flight[isin] = Future()
+                    self._pending.append(isin)
+                futures[isin] = future
+            # the first caller that finds no flush scheduled waits for the batch window and sends the batch
+            if self._pending and not self._flush_scheduled:
+                self._flush_scheduled = leader = True
+        return quotes, futures, leader
+
+    def cached(self, isin: str) -> Optional[object]:
+        """Returns the last known quote of an ISIN regardless of its age, or None."""
+        cached = self._quotes.get(isin)
+        return cached[1] if cached is not None else None
+
+    def _flush_after_window(self) -> None:
+        time.sleep(self.batch_window)
+        self._flush()
+
+    def _flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._flush_scheduled = False
+            futures = {isin: self._in_flight[isin] for isin in pending}
+        # ISINs whose futures are answered by a batch that has been handed to _fetch
+        handed_off = set()
+        error = None
+        try:
+            if self.shared is not None:
+                pending = self._resolve_shared(pending)
+
+            batches = [pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)]
+            # batches after the first are sent concurrently, e.g. when a whole portfolio is quoted at once
+            for batch in batches[1:]:
+                self._executor.submit(self._fetch, batch, futures)
+                handed_off.update(batch)
+            if batches:
+                handed_off.update(batches[0])
+                self._fetch(batches[0], futures)
+        except Exception as e:
+            eventlog.error(e)
+            error = e
+        finally:
+            # no caller may be left waiting for a future nothing is going to answer
+            self._settle([isin for isin in futures if isin not in handed_off], futures, error)
+
+    def _fetch(self, batch: list, futures: Dict[str, Future]) -> None:
+        error = None
+        try:
+            results = self.client.market_data.quotes.get_latest(isin=batch).results
+            self.batches += 1
+
+            fetched_at = time.monotonic()
+            received = {quote.isin: quote for quote in results}
+            with self._lock:
+                for isin in batch:
+                    future = self._in_flight.pop(isin)
+                    if isin in received:
+                        self._quotes[isin] = (fetched_at, received[isin])
+                        future.set_result(received[isin])
+                    else:
+                        future.set_exception(LookupError(f'No quote available for {isin}.'))
+            if self.shared is not None:
+                now = time.time()
+                self.shared.set_many({f'quote:{isin}': (now, quote) for isin, quote in received.items()},
+                                     self.max_age)
+        except Exception as e:
+            eventlog.error(e)
+            error = e
+        finally:
+            self._settle(batch, futures, error)
+
+    def _resolve_shared(self, pending: list) -> list:
+        """Answers pending ISINs from the shared cache and returns the ones that still have to be fetched."""
+        found = self.shared.get_many(f'quote:{isin}' for isin in pending)
+        if not found:
+            return pending
+        now, monotonic_now = time.time(), time.monotonic()
+        remaining = []
+        with self._lock:
+            for isin in pending:
+                entry = found.get(f'quote:{isin}')
+                if entry is None:
+                    remaining.append(isin)
+                    continue
+                fetched_at, quote = entry
+                # keep the age of the quote, so it is not treated as fresh for longer than max_age
+                self._quotes[isin] = (monotonic_now - (now - fetched_at), quote)
+                self._in_flight.pop(isin).set_result(quote)
+        return remaining
+
+    def _settle(self, isins: list, futures: Dict[str, Future], error: Optional[Exception]) -> None:
+        """Answers the futures among `futures` that are still pending, with the last known quotes where there are
+        any and with `error` otherwise."""
+        with self._lock:
+            for isin in isins:
+                future = futures[isin]
+                if self._in_flight.get(isin) is future:
+                    del self._in_flight[isin]
+                if future.done():
+                    continue
+                cached = self._quotes.get(isin)
+                if cached is not None:
+                    future.set_result(cached[1])
+                else:
+                    future.set_exception(error or LookupError(f'No quote available for {isin}.'))
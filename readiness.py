@@ -0,0 +1,62 @@
+import threading
+import time
+from typing import Callable, Dict, Set
+
+import eventlog
+
+
+class Readiness:
+    """Tells when the bot is ready and records how long each step of starting it took.
+
+    Reference data is warmed up by `warm` in background threads while the bot already receives updates; handlers
+    that need it before then fall back to the API. The bot is ready once every expected step is done.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        # step -> seconds after startup began at which it was done
+        self.steps: Dict[str, float] = {}
+        # step -> error of a warm-up that failed, its data is loaded on demand instead
+        self.failed: Dict[str, str] = {}
+        self.ready = threading.Event()
+
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def expect(self, step: str) -> None:
+        """Holds back readiness until `step` is done."""
+        with self._lock:
+            self._pending.add(step)
+            self.ready.clear()
+
+    def done(self, step: str) -> None:
+        with self._lock:
+            self.steps[step] = time.monotonic() - self.started_at
+            self._pending.discard(step)
+            if self._pending or self.ready.is_set():
+                return
+            self.ready.set()
+        eventlog.event('ready', seconds=round(self.steps[step], 3),
+                       steps={name: round(seconds, 3) for name, seconds in self.steps.items()})
+
+    def warm(self, step: str, load: Callable[[], object]) -> None:
+        """Runs `load` in a background thread, the step is done when it returns or fails."""
+        self.expect(step)
+
+        def run() -> None:
+            try:
+                load()
+            except Exception as e:
+                eventlog.error(e, step=step)
+                self.failed[step] = str(e)
+            self.done(step)
+
+        threading.Thread(target=run, name=f'warm-{step}', daemon=True).start()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {'ready': self.ready.is_set(), 'steps': dict(self.steps), 'pending': sorted(self._pending),
+                    'failed': dict(self.failed)}
+
+
+readiness = Readiness()
@@ -0,0 +1,154 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+
+class ChatSession:
+    """Conversation state of one chat, with a fixed set of fields instead of a free-form dict."""
+
+    __slots__ = (
+        # bookkeeping, kept by clear()
+        'chat_id', 'state', 'last_active',
+        # /trade
+        'type', 'search_query', 'instruments', 'name', 'isin', 'side', 'quantity', 'total', 'shares_owned',
+        # shared by /trade and /quicktrade; order_id is only set while the order is created but not activated
+        'bid', 'ask', 'balance', 'order_id', 'order_status', 'prefetch',
+        # /basket, one dict per order
+        'basket',
+    )
+    FIELDS = __slots__[3:]
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.state = None
+        self.last_active = time.monotonic()
+        self.clear()
+
+    def clear(self) -> None:
+        """Resets the conversation fields."""
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def unconfirmed_orders(self) -> List[str]:
+        """Returns the ids of orders that were created but not activated yet."""
+        order_ids = [self.order_id] if self.order_id is not None else []
+        for order in self.basket or ():
+            if order.get('order_id') is not None:
+                order_ids.append(order['order_id'])
+        return order_ids
+
+    def size(self) -> int:
+        """Returns the approximate number of bytes held by the session."""
+        size = sys.getsizeof(self)
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is None:
+                continue
+            size += sys.getsizeof(value)
+            if isinstance(value, dict):
+                size += sum(sys.getsizeof(key) + sys.getsizeof(item) for key, item in value.items())
+            elif isinstance(value, list):
+                size += sum(sys.getsizeof(item) for item in value)
+        return size
+
+    def to_dict(self) -> dict:
+        """Returns the session as JSON-compatible data, leaving out calls prefetched for the current step."""
+        data = {field: getattr(self, field) for field in self.FIELDS
+                if field != 'prefetch' and getattr(self, field) is not None}
+        data['state'] = self.state
+        # wall clock time, since the monotonic clock starts over with the process
+        data['last_active'] = time.time() - (time.monotonic() - self.last_active)
+        return data
+
+    @classmethod
+    def from_dict(cls, chat_id: int, data: dict) -> 'ChatSession':
+        session = cls(chat_id)
+        for field in cls.FIELDS:
+            setattr(session, field, data.get(field))
+        session.state = data.get('state')
+        session.last_active = time.monotonic() - max(time.time() - data.get('last_active', time.time()), 0)
+        return session
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{field}={getattr(self, field)!r}' for field in self.FIELDS
+                           if getattr(self, field) is not None)
+        return f'ChatSession({self.chat_id}, state={self.state}: {fields})'
+
+
+class SessionStore:
+    """Sessions of all chats, evicting the least recently used session once `max_sessions` is reached.
+
+    Evicted sessions are passed to `on_evict`, e.g. to cancel the orders they were waiting to confirm.
+    """
+
+    def __init__(self, max_sessions: int = 100000, on_evict: Optional[Callable[[ChatSession], None]] = None):
+        self.max_sessions = max_sessions
+        self.on_evict = on_evict
+        self.evicted = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int) -> ChatSession:
+        """Returns the session of a chat, creating it if necessary."""
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is None:
+                session = self._sessions[chat_id] = ChatSession(chat_id)
+                evicted = self._evict()
+            else:
+                self._sessions.move_to_end(chat_id)
+                evicted = []
+            session.last_active = time.monotonic()
+        self._evicted(evicted)
+        return session
+
+    def add(self, session: ChatSession) -> None:
+        """Adds a session, e.g. one restored after a restart, unless the chat already has one."""
+        with self._lock:
+            if session.chat_id in self._sessions:
+                return
+            self._sessions[session.chat_id] = session
+            evicted = self._evict()
+        self._evicted(evicted)
+
+    def _evict(self) -> List[ChatSession]:
+        evicted = []
+        while len(self._sessions) > self.max_sessions:
+            evicted.append(self._sessions.popitem(last=False)[1])
+        self.evicted += len(evicted)
+        return evicted
+
+    def _evicted(self, sessions: List[ChatSession]) -> None:
+        # called outside the lock, so the callback may use the store
+        if self.on_evict is not None:
+            for session in sessions:
+                self.on_evict(session)
+
+    def peek(self, chat_id: int) -> Optional[ChatSession]:
+        """Returns the session of a chat without creating it or marking it as used."""
+        return self._sessions.get(chat_id)
+
+    def pop(self, chat_id: int) -> Optional[ChatSession]:
+        with self._lock:
+            return self._sessions.pop(chat_id, None)
+
+    def expire(self, timeout: Callable[[Optional[int]], float]) -> List[ChatSession]:
+        """Removes and returns the sessions that have been idle for longer than `timeout(state)` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [session for session in self._sessions.values()
+                       if now - session.last_active > timeout(session.state)]
+            for session in expired:
+                del self._sessions[session.chat_id]
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def memory(self) -> int:
+        """Returns the approximate number of bytes held by all sessions."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return sys.getsizeof(self._sessions) + sum(session.size() for session in sessions)
@@ -0,0 +1,125 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import threading
+import time
+from typing import Callable, List, Optional
+
+from telegram import Bot
+
+import eventlog
+
+# parts of an update that carry the chat it belongs to
+CHAT_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member', 'chat_member',
+               'chat_join_request')
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring that maps keys to nodes.
+
+    Every node is placed on the ring `replicas` times, so keys spread evenly and adding or removing a node only
+    moves the keys of that node.
+    """
+
+    def __init__(self, nodes: List[int], replicas: int = 64):
+        self.nodes = list(nodes)
+        points = sorted((_hash(f'{node}:{replica}'), node) for node in self.nodes for replica in range(replicas))
+        self._hashes = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    def node(self, key) -> int:
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def chat_id_of(data: dict) -> Optional[int]:
+    """Returns the chat an update in Telegram's JSON format belongs to, or the user for updates without a chat."""
+    for field in CHAT_FIELDS:
+        if field in data:
+            return data[field]['chat']['id']
+    callback_query = data.get('callback_query')
+    if callback_query is not None and 'message' in callback_query:
+        return callback_query['message']['chat']['id']
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return None
+
+
+class ShardedIngress:
+    """Receives updates in one process and passes them on to `shards` worker processes.
+
+    Updates are routed by consistent hashing on the chat id, so all updates of a chat are handled by the same worker
+    and its conversation state never leaves that process. `worker(index, updates)` runs in every worker process and
+    takes the updates from a queue until it receives None; workers that die are started again with the same queue.
+    """
+
+    def __init__(self, bot: Bot, shards: int, worker: Callable[[int, multiprocessing.Queue], None]):
+        self.bot = bot
+        self.shards = shards
+        self.worker = worker
+        self.ring = HashRing(list(range(shards)))
+        self.routed = [0] * shards
+        self.restarts = 0
+
+        # spawned rather than forked, since this process already runs threads
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for _ in range(shards)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * shards
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        """Starts the workers and restarts any of them that exits while the ingress is running."""
+        for index in range(self.shards):
+            self._start_worker(index)
+        threading.Thread(target=self._supervise, name='shard-supervisor', daemon=True).start()
+
+    def route(self, data: dict) -> None:
+        """Queues an update, given in Telegram's JSON format, for the worker of its chat."""
+        chat_id = chat_id_of(data)
+        index = self.ring.node(chat_id) if chat_id is not None else 0
+        self.routed[index] += 1
+        self._queues[index].put(data)
+
+    def poll(self, timeout: int = 10) -> None:
+        """Long polls Telegram for updates and routes them until `stop` is called."""
+        offset = None
+        while not self._stopping.is_set():
+            try:
+                updates = self.bot.get_updates(offset=offset, timeout=timeout)
+            except Exception as e:
+                eventlog.error(e)
+                time.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.route(update.to_dict())
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Lets every worker finish the updates queued for it and waits for the workers to exit."""
+        self._stopping.set()
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout)
+        eventlog.event('ingress_stopped', routed=self.routed, restarts=self.restarts)
+
+    def _start_worker(self, index: int) -> None:
+        process = self._context.Process(target=self.worker, args=(index, self._queues[index]),
+                                        name=f'shard-{index}', daemon=True)
+        process.start()
+        self._processes[index] = process
+
+    def _supervise(self) -> None:
+        while not self._stopping.wait(1):
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive() and not self._stopping.is_set():
+                    eventlog.event('worker_restarted', logging.WARNING, worker=index, exit_code=process.exitcode)
+                    self.restarts += 1
+                    self._start_worker(index)
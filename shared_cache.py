@@ -0,0 +1,67 @@
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+import eventlog
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, expires REAL, value BLOB)'
+
+
+class SharedCache:
+    """Expiring key-value cache in a SQLite file, shared by the worker processes of a sharded deployment.
+
+    Values are pickled. The cache only saves upstream calls: any database error is printed and treated as a miss,
+    so a locked or broken file never fails a request.
+    """
+
+    def __init__(self, path: str = 'shared.db', prune_interval: float = 60.0):
+        self.path = path
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.misses = 0
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=1.0)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # losing the newest entries on a power loss only costs a few upstream calls
+        self._connection.execute('PRAGMA synchronous=OFF')
+        self._connection.execute(SCHEMA)
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Returns the values of all keys that are cached and not expired."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            with self._lock:
+                rows = self._connection.execute(
+                    f'SELECT key, value FROM entries WHERE key IN ({",".join("?" * len(keys))}) AND expires > ?',
+                    (*keys, time.time())).fetchall()
+        except sqlite3.Error as e:
+            eventlog.error(e)
+            rows = []
+        self.hits += len(rows)
+        self.misses += len(keys) - len(rows)
+        return {key: pickle.loads(value) for key, value in rows}
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items: Dict[str, Any], ttl: float) -> None:
+        """Caches all items for `ttl` seconds."""
+        expires = time.time() + ttl
+        rows = [(key, expires, pickle.dumps(value)) for key, value in items.items()]
+        try:
+            with self._lock:
+                self._connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', rows)
+                if time.monotonic() - self._pruned_at > self.prune_interval:
+                    self._pruned_at = time.monotonic()
+                    self._connection.execute('DELETE FROM entries WHERE expires <= ?', (time.time(),))
+        except sqlite3.Error as e:
+            eventlog.error(e)
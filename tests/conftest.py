@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+import pytest
+
+import trading_bot
+
+
+class FakeOrders:
+    """The orders endpoints of the lemon.markets client, recording what was cancelled and activated."""
+
+    def __init__(self):
+        self.cancelled = []
+        self.activated = []
+        # isin -> event the creation of its order waits for
+        self.hold = {}
+
+    def create(self, isin, **order):
+        if isin in self.hold:
+            self.hold[isin].wait(5)
+        return SimpleNamespace(results=SimpleNamespace(id=f'ord_{isin}', status='inactive'))
+
+    def cancel(self, order_id):
+        self.cancelled.append(order_id)
+
+    def activate(self, order_id):
+        self.activated.append(order_id)
+
+
+@pytest.fixture
+def orders(monkeypatch) -> FakeOrders:
+    """Replaces the client of trading_bot with fake orders."""
+    orders = FakeOrders()
+    monkeypatch.setattr(trading_bot, 'client', SimpleNamespace(trading=SimpleNamespace(orders=orders)))
+    # run the cancellations right away instead of on the fan-out pool
+    monkeypatch.setattr(trading_bot, 'submit', lambda call: call())
+    return orders
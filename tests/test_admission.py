@@ -0,0 +1,79 @@
+from queue import Queue
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, TypeHandler
+
+import admission
+from admission import BUSY, DUPLICATE, REPLIES, THROTTLED, AdmissionControl, AdmissionQueue
+
+BOT = Bot('123:fake')
+
+
+def message(update_id: int, chat_id: int, text: str) -> Update:
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text, 'chat': {'id': chat_id, 'type': 'private'}}}, BOT)
+
+
+def test_a_repeated_message_is_dropped_within_the_duplicate_window():
+    control = AdmissionControl(duplicate_window=60)
+
+    assert control.admit(1, '/positions', queued=0) is None
+    assert control.admit(1, '/positions', queued=0) == DUPLICATE
+    assert control.admit(1, '/moon', queued=0) is None
+    # the same text from another chat is not a duplicate
+    assert control.admit(2, '/positions', queued=0) is None
+
+    control.duplicate_window = 0
+    assert control.admit(1, '/moon', queued=0) is None
+    assert control.rejected[DUPLICATE] == 1
+
+
+def test_a_chat_is_throttled_until_its_updates_are_released():
+    control = AdmissionControl(max_in_flight=2)
+    assert control.admit(1, 'a', queued=0) is None
+    assert control.admit(1, 'b', queued=0) is None
+
+    assert control.admit(1, 'c', queued=0) == THROTTLED
+    assert control.admit(2, 'c', queued=0) is None
+    control.release(1)
+    assert control.admit(1, 'c', queued=0) is None
+
+
+def test_updates_handled_outside_the_dispatcher_count_towards_the_limits():
+    control = AdmissionControl(max_in_flight=2, max_backlog=10)
+    control.pending = lambda chat_id: 2 if chat_id == 1 else 0
+    control.backlog = lambda: 6
+
+    assert control.admit(1, 'a', queued=0) == THROTTLED
+    assert control.admit(2, 'a', queued=3) is None
+    assert control.admit(3, 'a', queued=4) == BUSY
+
+
+def test_the_queue_answers_rejected_updates_except_duplicates():
+    replies = []
+    queue = AdmissionQueue(AdmissionControl(max_in_flight=5, max_backlog=2),
+                           lambda chat_id, text: replies.append((chat_id, text)))
+    queue.put(message(1, 1, '/moon'))
+    queue.put(message(2, 1, '/moon'))
+    queue.put(message(3, 2, '/moon'))
+    queue.put(message(4, 3, '/moon'))
+
+    assert [queue.get().update_id for _ in range(queue.qsize())] == [1, 3]
+    assert replies == [(3, REPLIES[BUSY])]
+
+
+def test_an_update_is_released_once_all_handler_groups_handled_it():
+    dispatcher = Dispatcher(BOT, Queue(), workers=1, use_context=True)
+    control = AdmissionControl(max_in_flight=1)
+    handled = []
+    dispatcher.add_handler(TypeHandler(Update, lambda update, context: handled.append(control.admit(1, 'b', 0))))
+    queue = admission.install(SimpleNamespace(dispatcher=dispatcher, update_queue=None), control, print)
+    assert dispatcher.update_queue is queue
+
+    queue.put(message(1, 1, 'a'))
+    dispatcher.process_update(queue.get())
+
+    # the update was still in flight in group 0 and is released in group 1
+    assert handled == [THROTTLED]
+    assert control.admit(1, 'c', queued=0) is None
@@ -0,0 +1,70 @@
+import pytest
+
+from alerts import Alert, AlertBook
+
+ISIN = 'US0378331005'
+
+
+def alert(direction: str, price: float, chat_id: int = 1, isin: str = ISIN) -> Alert:
+    return Alert(chat_id, isin, 'APPLE INC.', direction, price)
+
+
+def test_rising_alerts_fire_on_the_bid_and_falling_alerts_on_the_ask():
+    book = AlertBook()
+    above, below = alert('above', 110.0), alert('below', 90.0)
+    book.add(above)
+    book.add(below)
+
+    # the ask reaching a rising threshold or the bid a falling one does not fire
+    assert book.check(ISIN, bid=89.0, ask=111.0) == []
+    assert book.check(ISIN, bid=110.0, ask=111.0) == [above]
+    assert book.check(ISIN, bid=89.0, ask=90.0) == [below]
+    assert len(book) == 0 and book.triggered == 2
+
+
+def test_a_price_fires_every_alert_it_crosses_and_no_other():
+    book = AlertBook()
+    alerts = [alert('above', price) for price in (105.0, 101.0, 120.0, 103.0)]
+    for each in alerts:
+        book.add(each)
+
+    fired = book.check(ISIN, bid=105.0, ask=106.0)
+
+    assert sorted(each.price for each in fired) == [101.0, 103.0, 105.0]
+    assert [each.price for each in book.of_chat(1)] == [120.0]
+    assert book.check('DE0007164600', bid=1000.0, ask=1000.0) == []
+
+
+def test_removed_alerts_do_not_fire():
+    book = AlertBook()
+    removed, kept = alert('below', 95.0), alert('below', 90.0)
+    book.add(removed)
+    book.add(kept)
+
+    assert book.remove(removed.alert_id) is removed
+    assert book.check(ISIN, bid=80.0, ask=80.0) == [kept]
+    assert book.remove(removed.alert_id) is None
+
+
+def test_heaps_are_compacted_once_most_entries_are_removed():
+    book = AlertBook()
+    alerts = [alert('above', 100.0 + index, chat_id=index) for index in range(40)]
+    for each in alerts:
+        book.add(each)
+
+    for each in alerts[:30]:
+        book.remove(each.alert_id)
+
+    assert len(book._above[ISIN]) <= 2 * 10 + 16
+    assert [each.price for each in book.check(ISIN, bid=200.0, ask=200.0)] == [100.0 + index for index in range(30, 40)]
+    assert book.isins() == []
+
+
+def test_a_chat_may_have_at_most_max_per_chat_alerts():
+    book = AlertBook(max_per_chat=2)
+    book.add(alert('above', 110.0))
+    book.add(alert('above', 120.0))
+
+    with pytest.raises(ValueError):
+        book.add(alert('above', 130.0))
+    book.add(alert('above', 130.0, chat_id=2))
@@ -0,0 +1,83 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram.ext import ConversationHandler
+
+from async_bot import AsyncChat, AsyncEngine, AsyncTradingBot
+from trading_bot import ORDER_EXPIRED_MESSAGE, TradingBot
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append(text)
+
+
+class FakeLemon:
+    def __init__(self):
+        self.activated = []
+        self.cancelled = []
+
+    async def activate_order(self, order_id):
+        self.activated.append(order_id)
+
+    async def cancel_order(self, order_id):
+        self.cancelled.append(order_id)
+
+
+def handle(handler_name: str, text: str, **session):
+    """Runs one handler of the async engine and returns its state, the replies and the fake lemon client."""
+    lemon, telegram = FakeLemon(), FakeTelegram()
+    bot = AsyncTradingBot(SimpleNamespace(lemon=lemon, bot=None))
+    chat = AsyncChat(1, telegram)
+    for field, value in session.items():
+        setattr(chat.session, field, value)
+    message = SimpleNamespace(text=text, message_id=7)
+    state = asyncio.run(getattr(bot, handler_name)(message, chat))
+    return state, telegram.sent, lemon
+
+
+def test_confirming_an_expired_order_tells_the_user_instead_of_activating_nothing():
+    for handler_name in ('confirm_order', 'confirm_quicktrade'):
+        state, sent, lemon = handle(handler_name, 'Confirm')
+
+        assert state == ConversationHandler.END
+        assert sent == [ORDER_EXPIRED_MESSAGE]
+        assert lemon.activated == []
+
+
+def test_a_rejected_quick_trade_is_neither_activated_nor_cancelled():
+    state, sent, lemon = handle('confirm_quicktrade', 'Confirm', order_id='ord_1', order_status='rejected')
+
+    assert state == ConversationHandler.END
+    assert sent == ['Insufficient holdings, ending conversation']
+    assert lemon.activated == lemon.cancelled == []
+
+
+def test_the_same_checks_as_the_threaded_handlers_decide_on_the_quantity():
+    session = dict(side='buy', ask=10.0, bid=9.0, balance=50 * 10000, name='APPLE INC.')
+
+    state, sent, lemon = handle('get_quantity', '6', **session)
+    assert state == TradingBot.SIDE
+    assert sent == ['You do not have enough money to buy 6.0 of APPLE INC.. Please enter a new amount.']
+
+    state, sent, lemon = handle('get_quantity', 'many', **session)
+    assert state == TradingBot.SIDE
+    assert sent == ['You\'ve entered an invalid amount. Please try again.']
+
+
+def test_ending_a_chats_conversations_clears_it_in_the_engine():
+    engine = AsyncEngine(None, '123:fake')
+    engine.lemon, telegram = FakeLemon(), FakeTelegram()
+    engine.chats = {chat_id: AsyncChat(chat_id, telegram) for chat_id in (1, 2)}
+    engine.chats[1].session.state, engine.chats[1].session.order_id = TradingBot.QUICK, 'ord_1'
+    bot = TradingBot()
+    bot.on_end_conversations = lambda chat_ids: asyncio.run(engine._end(chat_ids))
+
+    bot.end_conversations({1})
+    engine.loop.close()
+
+    assert list(engine.chats) == [2]
+    assert engine.lemon.cancelled == ['ord_1'] and telegram.sent == []
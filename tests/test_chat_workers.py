@@ -0,0 +1,40 @@
+import threading
+from queue import Queue
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, TypeHandler
+
+import chat_workers
+
+
+def message(update_id: int, chat_id: int, text: str, bot: Bot) -> Update:
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text, 'chat': {'id': chat_id, 'type': 'private'}}}, bot)
+
+
+def test_a_slow_chat_holds_up_only_its_own_updates():
+    bot = Bot('123:fake')
+    dispatcher = Dispatcher(bot, Queue(), workers=1, use_context=True)
+    handled = []
+    unblock = threading.Event()
+    finished = threading.Semaphore(0)
+
+    def handle(update, context):
+        if update.message.text == 'slow':
+            unblock.wait(5)
+        handled.append((update.effective_chat.id, update.message.text))
+        finished.release()
+
+    dispatcher.add_handler(TypeHandler(Update, handle))
+    chat_workers.install(dispatcher, workers=2)
+
+    for update_id, (chat_id, text) in enumerate([(1, 'slow'), (1, 'after'), (2, 'first'), (2, 'second')]):
+        dispatcher.process_update(message(update_id, chat_id, text, bot))
+    for _ in range(2):
+        assert finished.acquire(timeout=5)
+    assert handled == [(2, 'first'), (2, 'second')]
+
+    unblock.set()
+    for _ in range(2):
+        assert finished.acquire(timeout=5)
+    assert handled[2:] == [(1, 'slow'), (1, 'after')]
@@ -0,0 +1,49 @@
+from instrument_index import IndexedInstrument, InstrumentIndex, _Snapshot
+
+
+def make_index(*instruments) -> InstrumentIndex:
+    index = InstrumentIndex(client=None, mic='XMUN')
+    index._snapshot = _Snapshot([IndexedInstrument(*instrument) for instrument in instruments], 0.0)
+    return index
+
+
+def names(instruments) -> list:
+    return [instrument.name for instrument in instruments]
+
+
+def test_exact_name_ranks_before_longer_names_with_the_same_prefix():
+    index = make_index(('US0378331005', 'APPLE INC.', 'APPLE INC.', 'stock'),
+                       ('US0378501007', 'APPLE HOSPITALITY REIT INC.', 'APPLE HOSPITALITY REIT', 'stock'))
+
+    assert names(index.search('apple', 'stock')) == ['APPLE INC.', 'APPLE HOSPITALITY REIT INC.']
+    assert names(index.search('apple hospitality', 'stock')) == ['APPLE HOSPITALITY REIT INC.']
+
+
+def test_exact_title_ranks_first():
+    index = make_index(('US5949181045', 'MICROSOFT CORP.', 'MICROSOFT', 'stock'),
+                       ('US0000000001', 'MICROSOFT SOFTWARE HOLDINGS', 'MSH', 'stock'))
+
+    assert names(index.search('microsoft', 'stock'))[0] == 'MICROSOFT CORP.'
+
+
+def test_whole_word_matches_rank_before_prefixes_of_words():
+    index = make_index(('US0000000002', 'APPLIED APPLE', 'APPLIED APPLE', 'stock'),
+                       ('US0000000003', 'APPLEBEES', 'APPLEBEES', 'stock'),
+                       ('US0378331005', 'APPLE INC.', 'APPLE INC.', 'stock'))
+
+    assert names(index.search('apple', 'stock')) == ['APPLE INC.', 'APPLIED APPLE', 'APPLEBEES']
+
+
+def test_fuzzy_matches_come_last():
+    index = make_index(('US0378331005', 'APPLE INC.', 'APPLE INC.', 'stock'),
+                       ('US0000000004', 'APPLO MINING', 'APPLO', 'stock'))
+
+    assert names(index.search('applo', 'stock')) == ['APPLO MINING', 'APPLE INC.']
+
+
+def test_isin_and_type_filter():
+    index = make_index(('US0378331005', 'APPLE INC.', 'APPLE INC.', 'stock'),
+                       ('IE00B4L5Y983', 'ISHARES CORE MSCI WORLD', 'MSCI WORLD', 'etf'))
+
+    assert names(index.search('us0378331005')) == ['APPLE INC.']
+    assert index.search('apple', 'etf') == []
@@ -0,0 +1,64 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from order_watcher import EXECUTED_WITHOUT_PRICE_TEXT, OrderWatcher
+
+
+class FakeOrders:
+    def __init__(self, *summaries):
+        # results returned by get_order, the last one over and over
+        self.summaries = list(summaries)
+
+    def get_order(self, order_id):
+        summary = self.summaries.pop(0) if len(self.summaries) > 1 else self.summaries[0]
+        return SimpleNamespace(results=summary)
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.sent = []
+        self.done = threading.Event()
+
+    def send(self, bot, chat_id, text, reply_markup=None, priority=None):
+        self.sent.append((chat_id, text))
+        self.done.set()
+
+
+def watcher(*summaries) -> OrderWatcher:
+    client = SimpleNamespace(trading=SimpleNamespace(orders=FakeOrders(*summaries)))
+    return OrderWatcher(client, initial_interval=0.01, max_interval=0.01, outbox=FakeOutbox())
+
+
+def test_an_executed_order_without_a_price_is_polled_again():
+    order_watcher = watcher(SimpleNamespace(status='executed', executed_price=None),
+                            SimpleNamespace(status='executed', executed_price=1234500))
+
+    order_watcher.watch('ord_1', 1, None)
+
+    assert order_watcher.outbox.done.wait(2)
+    assert order_watcher.outbox.sent == [(1, 'Your order was executed at €123.45 per share.')]
+
+
+def test_an_executed_order_still_without_a_price_at_its_deadline_is_reported_without_one():
+    order_watcher = watcher(SimpleNamespace(status='executed', executed_price=None))
+
+    order_watcher.watch('ord_1', 1, None, timeout=0.05)
+
+    assert order_watcher.outbox.done.wait(2)
+    assert order_watcher.outbox.sent == [(1, EXECUTED_WITHOUT_PRICE_TEXT)]
+
+
+def test_an_order_that_cannot_be_reported_does_not_stop_the_others():
+    order_watcher = watcher(SimpleNamespace(status='executed', executed_price=1000000))
+    order_watcher.watch('ord_1', 1, None, executed_text='{price:unknown}', timeout=0.05)
+    order_watcher.watch('ord_2', 2, None)
+
+    assert order_watcher.outbox.done.wait(2)
+    assert order_watcher.outbox.sent == [(2, 'Your order was executed at €100.00 per share.')]
+    # the broken order is dropped at its deadline
+    for _ in range(100):
+        if not order_watcher.pending():
+            break
+        time.sleep(0.01)
+    assert order_watcher.pending() == 0
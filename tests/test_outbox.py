@@ -0,0 +1,110 @@
+import pytest
+from telegram import ReplyKeyboardRemove
+from telegram.error import RetryAfter
+
+from outbox import INFO, ORDER, MessageScheduler, TokenBucket
+
+
+class FakeBot:
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.sent = []
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """Returns a factory of schedulers whose messages are taken by the test instead of the background thread."""
+    monkeypatch.setattr(MessageScheduler, '_ensure_started', lambda self: None)
+    return MessageScheduler
+
+
+def test_token_bucket_allows_a_burst_and_then_the_rate():
+    bucket = TokenBucket(rate=2.0, capacity=3.0)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.wait_time(now) == 0
+        bucket.take()
+
+    assert bucket.wait_time(now) == pytest.approx(0.5)
+    assert bucket.wait_time(now + 0.5) == 0
+    # an idle bucket fills up to its capacity, not beyond
+    assert bucket.wait_time(now + 60) == 0 and bucket.tokens == 3.0
+
+
+def test_global_bucket_limits_the_messages_of_all_chats(scheduler):
+    outbox = scheduler(global_rate=1.0, global_burst=2.0, chat_rate=100.0, chat_burst=100.0)
+    bot = FakeBot()
+    for chat_id in (1, 2, 3):
+        outbox.send(bot, chat_id, 'hello')
+
+    assert [outbox._next_message()[0].chat_id for _ in range(2)] == [1, 2]
+    message, wait = outbox._next_message()
+    assert message is None and wait == pytest.approx(1.0, abs=0.1)
+
+
+def test_chat_bucket_holds_up_only_its_own_chat(scheduler):
+    outbox = scheduler(chat_rate=1.0, chat_burst=1.0)
+    bot = FakeBot()
+    # keyboards keep the messages of chat 1 from being merged
+    outbox.send(bot, 1, 'first', reply_markup=ReplyKeyboardRemove())
+    outbox.send(bot, 1, 'second', reply_markup=ReplyKeyboardRemove())
+    outbox.send(bot, 2, 'other')
+
+    assert outbox._next_message()[0].text == 'first'
+    assert outbox._next_message()[0].text == 'other'
+    message, wait = outbox._next_message()
+    assert message is None and wait == pytest.approx(1.0, abs=0.1)
+
+
+def test_chats_are_served_by_the_priority_of_their_messages(scheduler):
+    outbox = scheduler()
+    bot = FakeBot()
+    outbox.send(bot, 1, 'positions', priority=INFO)
+    outbox.send(bot, 2, 'your order was executed', priority=ORDER)
+
+    assert [outbox._next_message()[0].chat_id for _ in range(2)] == [2, 1]
+
+
+def test_adjacent_messages_are_merged_up_to_a_keyboard(scheduler):
+    outbox = scheduler()
+    bot = FakeBot()
+    keyboard = ReplyKeyboardRemove()
+    outbox.send(bot, 1, 'one')
+    outbox.send(bot, 1, 'two', priority=ORDER)
+    outbox.send(bot, 1, 'three', reply_markup=keyboard)
+    outbox.send(bot, 1, 'four')
+
+    message = outbox._next_message()[0]
+    assert message.text == 'one\n\ntwo\n\nthree'
+    assert message.reply_markup is keyboard and message.priority == ORDER
+    assert outbox.merged == 2 and outbox.pending() == 1
+
+
+def test_a_message_hitting_the_flood_limit_is_sent_again_after_retry_after(scheduler):
+    outbox = scheduler()
+    bot = FakeBot(RetryAfter(5))
+    outbox.send(bot, 1, 'hello')
+    message = outbox._next_message()[0]
+
+    outbox._deliver(message)
+
+    assert outbox.retried == 1 and outbox.pending() == 1 and bot.sent == []
+    message, wait = outbox._next_message()
+    assert message is None and wait == pytest.approx(5.0, abs=0.1)
+
+    outbox._paused_until[1] = 0.0
+    outbox._deliver(outbox._next_message()[0])
+    assert bot.sent == [(1, 'hello')] and outbox.pending() == 0
+
+
+def test_share_splits_the_global_rate_between_processes():
+    outbox = MessageScheduler(global_rate=25.0, global_burst=5.0)
+
+    outbox.share(10)
+
+    assert outbox.global_bucket.rate == 2.5 and outbox.global_bucket.capacity == 1.0
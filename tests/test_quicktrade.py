@@ -0,0 +1,105 @@
+import threading
+import time
+from concurrent.futures import TimeoutError
+from types import SimpleNamespace
+
+import pytest
+
+from fanout import fan_out, run_bounded
+import trading_bot
+from trading_bot import TradingBot
+
+
+def fail(error: Exception):
+    def call():
+        raise error
+    return call
+
+
+def test_fan_out_returns_exceptions_in_place_of_results():
+    error = ValueError('no quote')
+
+    assert fan_out(lambda: 1, fail(error), return_exceptions=True) == [1, error]
+    with pytest.raises(ValueError):
+        fan_out(lambda: 1, fail(error))
+
+
+def test_fan_out_waits_for_all_calls_together():
+    release = threading.Event()
+    started = time.monotonic()
+
+    results = fan_out(*[lambda: release.wait(5)] * 3, timeout=0.2, return_exceptions=True)
+
+    release.set()
+    assert time.monotonic() - started < 0.5
+    assert all(isinstance(result, TimeoutError) for result in results)
+
+
+def test_run_bounded_does_not_start_calls_waiting_for_a_slot_past_the_timeout():
+    release = threading.Event()
+    started = time.monotonic()
+
+    futures = run_bounded([lambda: release.wait(5)] * 3, max_parallel=1, timeout=0.2)
+
+    release.set()
+    assert time.monotonic() - started < 0.5
+    assert not any(future.done() for future in futures[1:])
+
+
+class FakeQuotes:
+    def get(self, isin):
+        raise TimeoutError('quote timed out')
+
+
+def message(text: str):
+    replies = []
+
+    def reply_text(text: str, **kwargs) -> None:
+        replies.append(text)
+
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1),
+                             message=SimpleNamespace(text=text, message_id=7, reply_text=reply_text))
+    return update, replies
+
+
+def test_quicktrade_cancels_the_created_order_when_the_quote_fails(monkeypatch, orders):
+    monkeypatch.setattr(trading_bot, 'quote_feed', FakeQuotes())
+    monkeypatch.setattr(trading_bot, 'find_instruments', lambda search, instrument_type: [
+        SimpleNamespace(isin='US0378331005', name='APPLE INC.')])
+    bot = TradingBot()
+    bot.quick_trade(message('/quicktrade')[0], SimpleNamespace(bot=None))
+    update, replies = message('buy 1 apple stock')
+
+    state = bot.perform_quicktrade(update, SimpleNamespace(bot=None))
+
+    assert state == trading_bot.ConversationHandler.END
+    assert replies == ['There was an error, ending conversation.']
+    assert orders.cancelled == ['ord_US0378331005']
+
+
+def test_basket_cancels_the_orders_created_after_the_timeout(monkeypatch, orders):
+    orders.hold['SLOW'] = threading.Event()
+    monkeypatch.setattr(trading_bot, 'quote_feed', SimpleNamespace(get_many=lambda isins, missing_ok: {}))
+    monkeypatch.setattr(trading_bot, 'order_watcher', SimpleNamespace(watch=lambda *args, **kwargs: None))
+    monkeypatch.setattr(trading_bot, 'find_instruments', lambda search, instrument_type: [
+        SimpleNamespace(isin=search.upper(), name=search)])
+    monkeypatch.setattr(TradingBot, 'BASKET_TIMEOUT', 0.2)
+    bot = TradingBot()
+    bot.basket(message('/basket')[0], SimpleNamespace(bot=None))
+    update, replies = message('buy 1 fast stock\nbuy 1 slow stock')
+
+    assert bot.perform_basket(update, SimpleNamespace(bot=None)) == TradingBot.BASKET_CONFIRMATION
+    assert 'timed out' in replies[-1] and 'these 1 orders' in replies[-1]
+
+    # the slow order is created after the basket was shown without it
+    orders.hold['SLOW'].set()
+    for _ in range(50):
+        if orders.cancelled:
+            break
+        threading.Event().wait(0.05)
+    assert orders.cancelled == ['ord_SLOW']
+
+    update, replies = message('Confirm')
+    assert bot.confirm_basket(update, SimpleNamespace(bot=None)) == trading_bot.ConversationHandler.END
+    assert orders.activated == ['ord_FAST']
+    assert replies[-1].startswith('1 of 1 orders were activated.')
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import pytest
+
+from quote_feed import QuoteFeed
+
+
+class FakeQuotes:
+    def __init__(self):
+        self.calls = []
+
+    def get_latest(self, isin):
+        self.calls.append(list(isin))
+        return SimpleNamespace(results=[SimpleNamespace(isin=item, a=2.0, b=1.0) for item in isin])
+
+
+class BrokenShared:
+    def get_many(self, keys):
+        raise OSError('database is locked')
+
+
+def make_feed(**kwargs):
+    quotes = FakeQuotes()
+    return QuoteFeed(SimpleNamespace(market_data=SimpleNamespace(quotes=quotes)), batch_window=0, timeout=1,
+                     **kwargs), quotes
+
+
+def test_a_failing_shared_cache_fails_the_request_instead_of_leaving_it_in_flight():
+    feed, quotes = make_feed(shared=BrokenShared())
+
+    with pytest.raises(OSError):
+        feed.get('US0378331005')
+    assert feed._in_flight == {}
+
+    # the next request tries again instead of joining a future nobody answers
+    feed.shared = None
+    assert feed.get('US0378331005').a == 2.0
+    assert quotes.calls == [['US0378331005']]
+
+
+def test_a_malformed_answer_fails_the_batch_and_later_requests_try_again():
+    feed, quotes = make_feed()
+    feed.client.market_data.quotes = SimpleNamespace(get_latest=lambda isin: SimpleNamespace(results=[None]))
+
+    with pytest.raises(AttributeError):
+        feed.get_many(['US0378331005', 'US5949181045'])
+    assert feed._in_flight == {}
+
+    feed.client.market_data.quotes = quotes
+    assert set(feed.get_many(['US0378331005', 'US5949181045'])) == {'US0378331005', 'US5949181045'}
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+from telegram.ext import ConversationHandler, MessageHandler
+
+from sessions import SessionStore
+from trading_bot import SESSION_EXPIRED, TradingBot
+
+
+def test_eviction_passes_the_evicted_sessions_on():
+    evicted = []
+    store = SessionStore(max_sessions=2, on_evict=evicted.append)
+    for chat_id in (1, 2, 3):
+        store.get(chat_id)
+
+    assert [session.chat_id for session in evicted] == [1]
+    assert store.evicted == 1 and store.peek(1) is None
+
+
+def test_forget_cancels_the_unconfirmed_order(orders):
+    bot = TradingBot()
+    bot.sessions.get(1).order_id = 'ord_1'
+
+    session = bot.forget(1)
+
+    assert orders.cancelled == ['ord_1']
+    assert session.order_id is None and bot.sessions.peek(1) is None
+
+
+def test_evicting_a_session_cancels_its_unconfirmed_orders(orders):
+    bot = TradingBot(sessions=SessionStore(max_sessions=1))
+    bot.sessions.get(1).basket = [{'order_id': 'ord_1'}, {'order_id': None}, {'order_id': 'ord_2'}]
+
+    bot.sessions.get(2)
+
+    assert orders.cancelled == ['ord_1', 'ord_2']
+
+
+def message(chat_id: int, text: str):
+    replies = []
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id),
+                             message=SimpleNamespace(text=text, message_id=7,
+                                                     reply_text=lambda text, **kwargs: replies.append(text)))
+    return update, replies
+
+
+def test_evicting_a_session_ends_its_conversation(orders):
+    bot = TradingBot(sessions=SessionStore(max_sessions=1))
+    handler = ConversationHandler(entry_points=[MessageHandler(None, bot.trade)], states={}, fallbacks=[])
+    bot.conversation_handlers.append(handler)
+    context = SimpleNamespace(user_data={})
+    bot.trade(message(1, '/trade')[0], context)
+    handler.conversations[(1, 1)] = TradingBot.SIDE
+
+    bot.trade(message(2, '/trade')[0], context)
+    # a message chat 1 sent before its conversation ended finds no session
+    update, replies = message(1, '5')
+    state = bot.get_quantity(update, context)
+
+    assert (1, 1) not in handler.conversations
+    assert state == ConversationHandler.END and replies == [SESSION_EXPIRED.text]
+    assert bot.sessions.peek(1) is None and bot.sessions.peek(2).state == TradingBot.TYPE
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import pytest
+import requests
+from aiohttp import web
+
+from async_lemon import AsyncLemonClient
+from transport import CircuitOpenError, TransportSession
+
+
+def open_breaker(session: TransportSession, host: str) -> None:
+    breaker = session.breaker(host)
+    for _ in range(breaker.threshold):
+        breaker.record_failure()
+    # let the next request through as the half-open trial
+    breaker.opened_at = time.monotonic() - breaker.cooldown
+
+
+def test_trial_failing_with_another_error_settles_the_breaker(monkeypatch):
+    session = TransportSession(retries=0)
+    open_breaker(session, 'api.test')
+
+    def broken(*args, **kwargs):
+        raise requests.exceptions.ChunkedEncodingError('connection broken')
+
+    monkeypatch.setattr(requests.Session, 'request', broken)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        session.get('http://api.test/v1/orders/ord_1')
+
+    # the breaker is open again rather than stuck with a trial that never ends, and lets the next trial through
+    breaker = session.breaker('api.test')
+    assert breaker.is_open and not breaker._trial_running
+    breaker.opened_at = time.monotonic() - breaker.cooldown
+    assert breaker.allow()
+
+
+def serve(handler):
+    """Runs `handler` for GET /v1/quotes/latest on a local server and returns its runner and URL."""
+    async def start():
+        app = web.Application()
+        app.router.add_get('/v1/quotes/latest', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        return runner, f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/v1'
+    return start()
+
+
+def test_async_client_retries_reads_and_serves_stale_quotes_when_the_circuit_opens():
+    answers = []
+
+    async def quotes(request):
+        answers.append(request.query.getall('isin'))
+        if len(answers) in (2, 3, 4):
+            return web.Response(status=503)
+        return web.json_response({'results': [{'isin': 'US0378331005', 'a': 150.0, 'b': 149.0}]})
+
+    async def run():
+        runner, url = await serve(quotes)
+        transport = TransportSession(retries=2, backoff=0, breaker_threshold=3)
+        lemon = AsyncLemonClient('trading', 'data', market_data_url=url, transport=transport)
+        try:
+            first = await lemon.get_latest_quotes(['US0378331005'])
+            # three failed attempts open the circuit, the last good quote is served instead
+            second = await lemon.get_latest_quotes(['US0378331005'])
+            assert transport.breaker(url.split('/')[2]).is_open
+            third = await lemon.get_latest_quotes(['US0378331005'])
+            return first, second, third, transport
+        finally:
+            await lemon.close()
+            await runner.cleanup()
+
+    first, second, third, transport = asyncio.run(run())
+    assert first[0].a == second[0].a == third[0].a == 150.0
+    assert len(answers) == 4
+    assert transport.retried == 2 and transport.stale_served == 2
+
+
+def test_async_client_fails_fast_without_stale_data():
+    async def run():
+        transport = TransportSession(breaker_threshold=1)
+        lemon = AsyncLemonClient('trading', 'data', trading_url='http://127.0.0.1:9/v1', transport=transport)
+        try:
+            with pytest.raises(Exception):
+                await lemon.get_balance()
+            with pytest.raises(CircuitOpenError):
+                await lemon.get_balance()
+        finally:
+            await lemon.close()
+
+    asyncio.run(run())
@@ -0,0 +1,87 @@
+import os
+import signal
+import threading
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from webhook import SECRET_HEADER, WebhookServer
+
+
+class FakeBot:
+
+    def __init__(self):
+        self.webhooks = []
+
+    def set_webhook(self, url, api_kwargs=None):
+        self.webhooks.append((url, api_kwargs))
+
+
+def post(server: WebhookServer, headers: dict) -> int:
+    request = urllib.request.Request(f'http://127.0.0.1:{server.server_address[1]}/telegram', data=b'{}',
+                                     headers=headers, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_server_refuses_requests_without_the_secret():
+    routed = []
+    server = WebhookServer(None, listen='127.0.0.1', port=0, secret_token='secret', route=routed.append)
+    server.start()
+    try:
+        assert post(server, {}) == 403
+        assert post(server, {SECRET_HEADER: 'wrong'}) == 403
+        assert post(server, {SECRET_HEADER: 'secret'}) == 200
+    finally:
+        server.stop()
+    assert routed == [{}]
+
+
+def test_server_requires_a_secret():
+    with pytest.raises(ValueError):
+        WebhookServer(None, listen='127.0.0.1', port=0, route=print)
+
+
+def test_secret_is_generated_and_registered(monkeypatch):
+    monkeypatch.setenv('WEBHOOK_URL', 'https://bot.test/telegram')
+    monkeypatch.delenv('WEBHOOK_SECRET', raising=False)
+    monkeypatch.setenv('WEBHOOK_LISTEN', '127.0.0.1')
+    monkeypatch.setenv('WEBHOOK_PORT', '0')
+    bot = FakeBot()
+    server = main.create_webhook_server(bot, route=print)
+    server.server_close()
+    assert server.secret_token
+    assert bot.webhooks == [('https://bot.test/telegram', {'secret_token': server.secret_token})]
+
+
+def test_refuses_to_start_without_a_secret_or_url(monkeypatch):
+    monkeypatch.delenv('WEBHOOK_URL', raising=False)
+    monkeypatch.delenv('WEBHOOK_SECRET', raising=False)
+    with pytest.raises(RuntimeError):
+        main.create_webhook_server(FakeBot(), route=print)
+
+
+def test_sigterm_flushes_persistence(monkeypatch):
+    flushed = threading.Event()
+    stopped = threading.Event()
+    serving = threading.Thread(target=stopped.wait, daemon=True)
+    server = SimpleNamespace(start=lambda: serving.start() or serving, stop=stopped.set, server_address=('', 0))
+    monkeypatch.setattr(main, 'create_webhook_server', lambda bot, dispatcher: server)
+    updater = SimpleNamespace(bot=None, dispatcher=SimpleNamespace(update_persistence=lambda: None),
+                              job_queue=SimpleNamespace(start=lambda: None, stop=lambda: None),
+                              persistence=SimpleNamespace(flush=flushed.set))
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT)}
+    threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    try:
+        main.start_webhook(updater)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    assert stopped.is_set()
+    assert flushed.is_set()
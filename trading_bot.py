@@ -1,43 +1,542 @@
-import datetime
+import functools
+import logging
 import os
 import random
+import threading
 import time
+from collections import namedtuple
+from typing import Callable, List, NamedTuple, Optional
 
-import dotenv
 from dotenv import load_dotenv
-from lemon import api
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, ReplyMarkup
 from telegram.ext import CallbackContext, ConversationHandler
 
+from alerts import Alert, AlertBook, Watchlists
+from basket import FORMAT, parse_basket, summarise
+import eventlog
+from fanout import fan_out, run_bounded, submit
+from instrument_cache import TTLCache
+from instrument_index import ISIN_PATTERN, InstrumentIndex
+from lazy import Lazy
+import metrics
+from order_watcher import OrderWatcher
+from outbox import MessageScheduler
+from persistence import SQLitePersistence
+from portfolio import PortfolioValuer
+from prefetch import Prefetch
+from quote_feed import QuoteFeed
+from sessions import ChatSession, SessionStore
+from shared_cache import SharedCache
+import transport
+from venue_calendar import VenueCalendar
+
 load_dotenv()
-# create your api client with separate trading and market data api tokens
-client = api.create(
-    trading_api_token=os.environ.get('TRADING_API_KEY'),
-    market_data_api_token=os.environ.get('DATA_API_KEY'),
-    env='paper'
-)
 
+# pooled keep-alive connections with per-endpoint timeouts, retries for reads and a circuit breaker
+lemon_session = transport.TransportSession(pool_size=int(os.getenv('LEMON_POOL_SIZE', 32)))
 
-class TradingBot:
-    TYPE, ID, SECRET, REPLY, NAME, ISIN, SIDE, QUANTITY, CONFIRMATION, QUICK, QUICKTRADE = range(11)
 
-    dotenv_file = dotenv.find_dotenv()
-    dotenv.load_dotenv(dotenv_file)
+def create_client():
+    """Creates the lemon.markets client on the API hosts configured, sending its requests through `lemon_session`."""
+    from lemon import api
+
+    # create your api client with separate trading and market data api tokens
+    lemon_client = api.create(
+        trading_api_token=os.environ.get('TRADING_API_KEY'),
+        market_data_api_token=os.environ.get('DATA_API_KEY'),
+        env='paper'
+    )
+    # the API hosts can be pointed elsewhere, e.g. at the local stand-in in benchmarks/fake_lemon.py
+    for lemon_api, url_variable in ((lemon_client.market_data, 'LEMON_MARKET_DATA_URL'),
+                                    (lemon_client.trading, 'LEMON_TRADING_URL')):
+        if os.getenv(url_variable):
+            lemon_api._base_url = os.getenv(url_variable).rstrip('/') + '/'
+    transport.install(lemon_client, session=lemon_session)
+    return lemon_client
+
+
+# the client and the lemon SDK are only loaded once the client is first used, usually by the warm-up after startup
+client = Lazy(create_client)
+
+# messages that are not a direct reply, sent within Telegram's flood limits
+outbox = MessageScheduler()
+
+# single background watcher that polls activated orders until they are executed
+order_watcher = OrderWatcher(client, outbox=outbox)
+
+# instrument search results shared across handlers and chats, keyed on (search, type)
+instrument_cache = TTLCache(maxsize=512, ttl=600)
+
+
+def search_instruments(search: str, instrument_type: str) -> list:
+    """Searches for instruments, answering repeated searches from the instrument cache."""
+    return instrument_cache.get_or_load(
+        (search, instrument_type),
+        lambda: client.market_data.instruments.get(search=search, type=instrument_type).results
+    )
+
+
+# local index of all instruments on the configured venue, refreshed in the background
+instrument_index = InstrumentIndex(client, os.getenv('MIC'),
+                                   path=os.getenv('INSTRUMENT_INDEX_PATH', 'instruments.json'))
+
+# quotes and the venue fetched by one worker process are reused by the others in a sharded deployment
+shared_cache = SharedCache(os.getenv('SHARED_CACHE_PATH')) if os.getenv('SHARED_CACHE_PATH') else None
+
+# opening days and hours of the configured venue, so market hours can be checked without an API call
+venue_calendar = VenueCalendar(client, os.getenv('MIC'), shared=shared_cache)
+
+# latest quotes shared by all chats, fetched in batches
+quote_feed = QuoteFeed(client, shared=shared_cache)
+
+# valuation of the whole portfolio, shared for a few seconds by all /portfolio requests
+portfolio_valuer = PortfolioValuer(client, quote_feed, ttl=float(os.getenv('PORTFOLIO_TTL', 10)))
+
+# price alerts and watchlists of all chats, checked by a single job that polls the quote feed
+alert_book = AlertBook()
+watchlists = Watchlists()
+
+# the stocks /moon picks from: GME, BB, CLOV, AMC, PLTR, WISH, NIO, TSLA, Tilray, NOK
+MEME_ISINS = ['US36467W1099', 'CA09228F1036', 'US18914F1030', 'US00165C1045', 'US69608A1088', 'US21077C1071',
+              'US62914V1061', 'US88160R1014', 'US88688T1007', 'FI0009000681']
+# isin -> title of the meme stocks, looked up once after startup
+meme_titles = {}
+
+
+def warm_meme_titles() -> None:
+    """Looks up the titles of all meme stocks with a single API call."""
+    for instrument in client.market_data.instruments.get(isin=MEME_ISINS).results:
+        meme_titles[instrument.isin] = instrument.title
+
+
+def find_instruments(search: str, instrument_type: str) -> list:
+    """Resolves instruments from the local index and only searches the API if the index has no match."""
+    return instrument_index.search(search, instrument_type) or search_instruments(search, instrument_type)
+
+
+def resolve_instrument(query: str):
+    """Returns the instrument with the given ISIN, or the best match for a name, or None."""
+    if ISIN_PATTERN.match(query.upper()):
+        isin = query.upper()
+        instrument = instrument_index.get(isin)
+        if instrument is None:
+            results = client.market_data.instruments.get(isin=[isin]).results
+            instrument = results[0] if results else None
+        return instrument
+    instrument_list = find_instruments(query.lower(), 'stock') or find_instruments(query.lower(), 'etf')
+    return instrument_list[0] if instrument_list else None
+
+
+def trade_data_calls(isin: str) -> dict:
+    """Returns the independent calls get_side needs: latest quote, account balance and position."""
+    return {
+        'quote': lambda: quote_feed.get(isin),
+        'balance': lambda: client.trading.account.get().results.balance,
+        'positions': lambda: client.trading.positions.get(isin).results,
+    }
+
+
+def log_session(session: ChatSession) -> None:
+    """Logs the conversation state of a chat at DEBUG, if the chat is among the sampled ones."""
+    if eventlog.enabled(logging.DEBUG, session.chat_id):
+        eventlog.event('session', logging.DEBUG, stacklevel=3, session=session.to_dict())
+
+
+def idempotency_key(chat_id: int, message_id: int, *parts) -> str:
+    """Returns the idempotency key of an order placed in reply to a message, so handling the message again, e.g. a
+    webhook update Telegram delivers twice, returns the order created the first time instead of placing another."""
+    return '-'.join(str(part) for part in (chat_id, message_id, *parts))
+
+
+TIMEOUT_MESSAGE = 'This conversation timed out. Send /start if you would like to make any other trades.'
+ORDER_EXPIRED_MESSAGE = 'Your order was not confirmed in time and has been cancelled. ' \
+                        'Send /start if you would like to make any other trades.'
+ERROR_MESSAGE = "There was an error, ending the conversation. If you'd like to try again, send /start."
+QUICKTRADE_ERROR_MESSAGE = 'There was an error, ending conversation.'
+PROCESSING_MESSAGE = 'Please wait while we process your order.'
+BYE_MESSAGE = 'Bye! Come back and send /start if you would like to make any other trades.'
+
 
+class Step(NamedTuple):
+    """The state a conversation step leaves the conversation in and what it replies."""
+    state: int
+    text: str
+    reply_markup: Optional[ReplyMarkup] = None
+
+
+QuickTrade = namedtuple('QuickTrade', ['side', 'quantity', 'search', 'instrument_type'])
+
+
+def keyboard(*buttons: str) -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup([list(buttons)], one_time_keyboard=True)
+
+
+# The steps of the /trade and /quicktrade conversations, shared by the handlers of TradingBot and the coroutines of
+# the async engine: each one updates the session and decides on the reply, the handlers only talk to the APIs.
+
+def begin_trade(session: ChatSession) -> Step:
+    session.clear()
+    return Step(TradingBot.TYPE, 'What type of instrument do you want to trade?', keyboard('Stock', 'ETF'))
+
+
+def choose_type(session: ChatSession, text: str) -> Step:
+    session.type = text.lower()
+    return Step(TradingBot.REPLY, f'What is the name of the {session.type} you would like to trade?')
+
+
+def list_instruments(session: ChatSession, instruments: list) -> Step:
+    # remember which ISIN belongs to which button so that choose_instrument does not need to search again
+    session.instruments = {instrument.name: instrument.isin for instrument in instruments}
+    return Step(TradingBot.NAME, 'Please choose the instrument you wish to trade. If you do not see the desired '
+                                 'instrument, press "Other".', keyboard(*session.instruments, 'Other'))
+
+
+def choose_instrument(session: ChatSession, text: str) -> Step:
+    """Records the chosen instrument; the handler starts prefetching its trade data if the step asks for the side."""
+    if text == 'Other':
+        return Step(TradingBot.REPLY, 'Please be more specific in your search query.')
+    if text not in (session.instruments or {}):
+        return Step(TradingBot.NAME, 'Please choose one of the instruments listed or press "Other".')
+    session.name = text
+    session.isin = session.instruments[text]
+    return Step(TradingBot.ISIN, f'Would you like to buy or sell {session.name}?', keyboard('Buy', 'Sell'))
+
+
+def choose_side(session: ChatSession, text: str, calls: dict) -> dict:
+    """Records the side and returns the ones of `calls` it needs: the position only matters when selling."""
+    session.side = text.lower()
+    if session.side == 'buy':
+        calls.pop('positions', None)
+    return calls
+
+
+def ask_quantity(session: ChatSession, results: dict) -> Step:
+    """Asks how many shares to trade, given the quote, the balance and (on sell) the positions in `results`."""
+    session.bid, session.ask = results['quote'].b, results['quote'].a
+    session.balance = results['balance']
+    if session.side == 'buy':
+        return Step(TradingBot.SIDE, f'This instrument is currently trading for €{session.ask}, your total balance '
+                                     f'is €{session.balance / 10000:,.2f}. '
+                                     f'How many shares do you wish to {session.side}?')
+    positions = results['positions']
+    session.shares_owned = positions[0].quantity if positions else 0
+    return Step(TradingBot.SIDE, f'This instrument can be sold for €{round(session.bid, 2)}, you currently own '
+                                 f'{session.shares_owned} share(s). How many shares do you wish to {session.side}?')
+
+
+def check_quantity(session: ChatSession, text: str) -> Optional[Step]:
+    """Records the quantity and returns the step asking for another one if it cannot be ordered, or None."""
+    try:
+        session.quantity = float(text.lower())
+    except ValueError:
+        return Step(TradingBot.SIDE, 'You\'ve entered an invalid amount. Please try again.')
+
+    # if user indicates 0 to buy, then prompt to enter new amount or end current process
+    if session.quantity == 0:
+        return Step(TradingBot.SIDE, 'You have indicated you do not wish to buy any shares, type '
+                                     '/cancel to abort this process or enter a new amount.')
+
+    session.total = session.quantity * float(session.ask if session.side == 'buy' else session.bid)
+    if session.side == 'buy' and session.total > session.balance / 10000:
+        return Step(TradingBot.SIDE, f'You do not have enough money to buy {session.quantity} of {session.name}. '
+                                     'Please enter a new amount.')
+    if session.side == 'sell' and session.shares_owned < session.quantity:
+        return Step(TradingBot.SIDE, f'You do not have enough shares of {session.name}. Please enter a new amount.')
+    if not session.quantity.is_integer():
+        return Step(TradingBot.SIDE, 'You\'ve entered an invalid amount. Please try again.')
+    return None
+
+
+def confirm_quantity(session: ChatSession) -> Step:
+    return Step(TradingBot.QUANTITY, f'You\'ve indicated that you wish to {session.side} {int(session.quantity)} '
+                                     f'share(s) of {session.name} at a total of €{round(session.total, 2)}. '
+                                     f'Please confirm or cancel your order to continue.', keyboard('Confirm', 'Cancel'))
+
+
+def check_order_confirmation(session: ChatSession, text: str) -> Optional[Step]:
+    """Returns the step for a reply that does not activate the order, or None if the order is to be activated.
+
+    The handler cancels the order, if there still is one, before replying with the step.
+    """
+    if text == 'Cancel':
+        return Step(TradingBot.CONFIRMATION, 'You\'ve cancelled your order. Would you like to make another trade?',
+                    keyboard('Yes', 'No'))
+    if session.order_id is None:
+        return Step(ConversationHandler.END, ORDER_EXPIRED_MESSAGE, ReplyKeyboardRemove())
+    return None
+
+
+def watch_trade_order(order_id: str, chat_id: int, bot) -> None:
+    """Lets the order watcher report the execution price of an activated /trade order."""
+    order_watcher.watch(
+        order_id, chat_id, bot,
+        executed_text='Your order was executed at €{price:,.2f} per share. Would you like to make another trade?',
+        timeout_text='We\'re currently experiencing some delays. Your order was not executed. '
+                     'Would you like to make another trade?',
+        failed_text='Your order was {status}. Would you like to make another trade?',
+        reply_markup=keyboard('Yes', 'No'),
+    )
+
+
+def complete_trade(session: ChatSession, text: str) -> Step:
+    if text == 'Yes':
+        return begin_trade(session)
+    return Step(ConversationHandler.END, BYE_MESSAGE, ReplyKeyboardRemove())
+
+
+def begin_quicktrade(session: ChatSession) -> Step:
+    session.clear()
+    return Step(TradingBot.QUICKTRADE, 'Please specify your quick trade in the following format: \'buy 5 apple stock\'')
+
+
+def parse_quicktrade(text: str) -> Optional[QuickTrade]:
+    """Returns the order of a quick trade like 'buy 5 apple stock', or None if it does not have four words.
+
+    Raises a ValueError if the quantity is not a whole number.
+    """
+    elements = text.split(' ')
+    if len(elements) != 4:
+        return None
+    instrument_type = elements[3].lower()
+    if instrument_type.startswith('share'):
+        instrument_type = 'stock'
+    return QuickTrade(elements[0].lower(), int(elements[1]), elements[2].lower(), instrument_type)
+
+
+QUICKTRADE_FORMAT = Step(ConversationHandler.END,
+                         'A quick trade must be placed in the following format: \'/quicktrade buy 5 apple stock\'')
+INSTRUMENT_NOT_FOUND = Step(ConversationHandler.END,
+                            'Instrument not found, please be more specific. Use /start to try again.')
+
+
+def confirm_quicktrade_order(session: ChatSession, trade: QuickTrade, instrument, order, quote) -> Step:
+    """Keeps the order a quick trade created and asks to confirm it at the quoted price.
+
+    `order` and `quote` may be the exceptions the calls failed with; the error of the order is raised, and the error
+    of the quote once the order is kept, so the handler cancels it.
+    """
+    if isinstance(order, Exception):
+        raise order
+    session.order_status = order.status
+    session.order_id = order.id
+    if isinstance(quote, Exception):
+        raise quote
+
+    session.bid, session.ask = quote.b, quote.a
+    price = session.ask if trade.side == 'buy' else session.bid
+    return Step(TradingBot.QUICK, f'You indicated that you wish to {trade.side} {trade.quantity} {instrument.name} '
+                                  f'{trade.instrument_type} at €{price} per share. Is that correct?',
+                keyboard('Confirm', 'Cancel'))
+
+
+def check_quicktrade_confirmation(session: ChatSession, text: str) -> Optional[Step]:
+    """Returns the step for a reply that does not activate the quick trade's order, or None if it is to be activated.
+
+    The handler cancels the order, if there still is one, before replying with the step.
+    """
+    if text == 'Confirm':
+        if session.order_status == 'rejected':
+            # a rejected order cannot be activated, nor does it need cancelling
+            session.order_id = None
+            return Step(ConversationHandler.END, 'Insufficient holdings, ending conversation')
+        if session.order_id is None:
+            return Step(ConversationHandler.END, ORDER_EXPIRED_MESSAGE, ReplyKeyboardRemove())
+        return None
+    if text == 'Cancel':
+        return Step(ConversationHandler.END, 'You cancelled the order. Ending conversation.')
+    return Step(ConversationHandler.END, QUICKTRADE_ERROR_MESSAGE)
+
+
+def reply(update: Update, step: Step) -> int:
+    """Sends the reply of a step and returns its state."""
+    update.message.reply_text(step.text, reply_markup=step.reply_markup)
+    return step.state
+
+
+SESSION_EXPIRED = Step(ConversationHandler.END, 'Your session has expired. Send /start if you would like to make any '
+                                               'other trades.', ReplyKeyboardRemove())
+
+
+def conversation_step(handler=None, *, entry: bool = False):
+    """Records the state a handler leaves its chat's conversation in and saves the session, or drops the session
+    once the conversation ends.
+
+    Steps other than `entry` points continue a conversation, so they end it as expired if its session is gone, e.g.
+    because it was evicted to stay within MAX_SESSIONS.
+    """
+    if handler is None:
+        return functools.partial(conversation_step, entry=entry)
+
+    @functools.wraps(handler)
+    def step(self, update: Update, context: CallbackContext) -> int:
+        chat_id = update.effective_chat.id
+        if not entry:
+            session = self.sessions.peek(chat_id)
+            if session is None or session.state is None:
+                return reply(update, SESSION_EXPIRED)
+        state = handler(self, update, context)
+        if state == ConversationHandler.END:
+            self.forget(chat_id)
+        elif state is not None:
+            # a session evicted during the step is not created again, so the next step finds it expired
+            session = self.sessions.peek(chat_id)
+            if session is None:
+                return state
+            session.state = state
+            if self.persistence is not None:
+                self.persistence.save_session(session.chat_id, session.to_dict())
+        return state
+    return step
+
+
+class TradingBot:
+    TYPE, ID, SECRET, REPLY, NAME, ISIN, SIDE, QUANTITY, CONFIRMATION, QUICK, QUICKTRADE, BASKET, \
+        BASKET_CONFIRMATION = range(13)
+
+    # seconds a conversation may stay idle in a state before it is ended; a created order waiting for confirmation
+    # is cancelled sooner than a half-finished search is forgotten
+    DEFAULT_TIMEOUT = 900
+    STATE_TIMEOUTS = {QUANTITY: 300, QUICK: 300, BASKET_CONFIRMATION: 300}
+
+    # orders a /basket may contain, how many of its upstream calls run at the same time and how long they may take
+    MAX_BASKET = 20
+    BASKET_PARALLELISM = 8
+    BASKET_TIMEOUT = 30.0
+
+    def __init__(self, sessions: SessionStore = None, default_timeout: float = None, state_timeouts: dict = None,
+                 persistence: SQLitePersistence = None):
+        # conversation state of every chat, shared by all handlers of this instance
+        # an empty store is falsy, so it is tested against None
+        self.sessions = sessions if sessions is not None else \
+            SessionStore(max_sessions=int(os.getenv('MAX_SESSIONS', 100000)))
+        if self.sessions.on_evict is None:
+            self.sessions.on_evict = self.evicted
+        self.default_timeout = default_timeout or TradingBot.DEFAULT_TIMEOUT
+        self.state_timeouts = {**TradingBot.STATE_TIMEOUTS, **(state_timeouts or {})}
+        # sessions are saved after every conversation step so conversations survive a restart
+        self.persistence = persistence
+        # ConversationHandlers whose conversations are ended together with expired sessions, and a callback that ends
+        # the chats' conversations anywhere else, i.e. in the async engine
+        self.conversation_handlers: List[ConversationHandler] = []
+        self.on_end_conversations: Optional[Callable[[set], None]] = None
+
+    def recover(self) -> int:
+        """Restores the sessions saved before the last restart and returns how many there were."""
+        if self.persistence is None:
+            return 0
+        sessions = [ChatSession.from_dict(chat_id, data) for chat_id, data in self.persistence.load_sessions()]
+        for session in sorted(sessions, key=lambda session: session.last_active):
+            self.sessions.add(session)
+        return len(sessions)
+
+    def forget(self, chat_id: int) -> Optional[ChatSession]:
+        """Drops the session of a chat, in memory and on disk, and cancels the orders it has not confirmed."""
+        if self.persistence is not None:
+            self.persistence.delete_session(chat_id)
+        session = self.sessions.pop(chat_id)
+        if session is not None:
+            self.discard_order(session)
+        return session
+
+    def evicted(self, session: ChatSession) -> None:
+        """Ends the conversation of a session dropped to stay within the session limit and cancels its unconfirmed
+        orders."""
+        self.end_conversations({session.chat_id})
+        if self.persistence is not None:
+            self.persistence.delete_session(session.chat_id)
+        self.discard_order(session)
+
+    def end_conversations(self, chat_ids: set) -> None:
+        """Ends the conversations of the given chats in all registered ConversationHandlers and the async engine."""
+        for handler in self.conversation_handlers:
+            # the handler reads, updates and persists its conversations under this lock on the dispatcher's threads
+            with handler._conversations_lock:
+                for key in [key for key in handler.conversations if key[0] in chat_ids]:
+                    handler.conversations.pop(key, None)
+                    if handler.persistent:
+                        handler.persistence.update_conversation(handler.name, key, None)
+        if self.on_end_conversations is not None and chat_ids:
+            self.on_end_conversations(chat_ids)
+
+    def timeout(self, state: int) -> float:
+        """Returns the idle timeout of a conversation state in seconds."""
+        return self.state_timeouts.get(state, self.default_timeout)
+
+    def discard_order(self, session: ChatSession) -> None:
+        """Cancels the orders of a session that were created but never activated."""
+        order_ids = session.unconfirmed_orders()
+        session.order_id = None
+        for order in session.basket or ():
+            order['order_id'] = None
+        if not order_ids:
+            return
+
+        def cancel_orders():
+            for order_id in order_ids:
+                try:
+                    client.trading.orders.cancel(order_id)
+                except Exception as e:
+                    eventlog.error(e)
+
+        submit(cancel_orders)
+
+    @metrics.timed
+    def sweep(self, context: CallbackContext) -> None:
+        """Periodic job that expires idle sessions and reports how many sessions are live."""
+        started = time.monotonic()
+        expired = self.sessions.expire(self.timeout)
+        self.end_conversations({session.chat_id for session in expired})
+        for session in expired:
+            if self.persistence is not None:
+                self.persistence.delete_session(session.chat_id)
+            if not session.unconfirmed_orders():
+                continue
+            self.discard_order(session)
+            outbox.send(context.bot, session.chat_id, ORDER_EXPIRED_MESSAGE, reply_markup=ReplyKeyboardRemove())
+
+        # python-telegram-bot keeps an (unused) chat_data dict for every chat it has seen
+        chat_data = context.dispatcher.chat_data
+        for chat_id in [chat_id for chat_id, data in list(chat_data.items()) if not data]:
+            chat_data.pop(chat_id, None)
+
+        eventlog.event('sessions_swept', live=len(self.sessions), kib=round(self.sessions.memory() / 1024, 1),
+                       expired=len(expired), evicted=self.sessions.evicted,
+                       seconds=round(time.monotonic() - started, 4))
+
+    @metrics.timed
+    def expire(self, update: Update, context: CallbackContext) -> None:
+        """Ends a conversation that was idle for longer than its timeout."""
+        session = self.forget(update.effective_chat.id)
+        # the sweeper has already ended conversations without a session
+        if session is not None:
+            outbox.send(context.bot, update.effective_chat.id, TIMEOUT_MESSAGE, reply_markup=ReplyKeyboardRemove())
+
+    @metrics.timed
     def start(self, update: Update, context: CallbackContext) -> int:
         """Initiates conversation."""
-        context.chat_data.clear()
+        self.forget(update.effective_chat.id)
+        # /start is handled before the conversations see it, so whatever the chat was in the middle of ends here
+        self.end_conversations({update.effective_chat.id})
         context.user_data.clear()
 
         # collect user's name
         user = update.message.from_user.name
 
-        venue = client.market_data.venues.get(os.getenv('MIC')).results[0].is_open
-
         # if Trading Venue closed, indicate next opening time and end conversation
-        if not venue.is_open:
-            opening_date: str = venue.opening_days[0].strftime('%d/%m/%Y')
-            opening_time: str = venue.opening_hours.start.strftime('%H:%m')
+        try:
+            is_open = venue_calendar.is_open()
+            next_opening = venue_calendar.next_opening()
+        except Exception as e:
+            eventlog.error(e)
+            update.message.reply_text(ERROR_MESSAGE)
+            return ConversationHandler.END
+
+        if not is_open:
+            if next_opening is None:
+                update.message.reply_text('This exchange is closed at the moment. Please try again later.')
+                return ConversationHandler.END
+            opening_date: str = next_opening.strftime('%d/%m/%Y')
+            opening_time: str = next_opening.strftime('%H:%M')
             update.message.reply_text(
                 f'This exchange is closed at the moment. Please try again on {opening_date} at {opening_time}.'
             )
@@ -50,443 +549,397 @@ class TradingBot:
             'Regular Commands (no input required):\n'
             '/trade - place trade\n'
             '/quicktrade - place shortform trade\n'
+            '/basket - place several shortform trades at once\n'
+            '/portfolio - value your portfolio\n'
+            '/alert - set price alerts\n'
+            '/watch - watch the prices of instruments\n'
             '/positions - list your positions\n'
             '/moon - meme stock generator\n'
         )
 
-        print("Conversation started.")
-        print(context.chat_data)
+        eventlog.event('conversation_started', logging.DEBUG)
 
+    @metrics.timed
+    @conversation_step(entry=True)
     def quick_trade(self, update: Update, context: CallbackContext) -> int:
         """Initiates quick trade sequence."""
-        context.chat_data.clear()
-
-        update.message.reply_text(
-            'Please specify your quick trade in the following format: \'buy 5 apple stock\''
-        )
-        return TradingBot.QUICKTRADE
+        return reply(update, begin_quicktrade(self.sessions.get(update.effective_chat.id)))
 
+    @metrics.timed
+    @conversation_step
     def perform_quicktrade(self, update: Update, context: CallbackContext) -> int:
         """Places quicktrade order."""
-        trade_elements = update.message.text.split(' ')
-
-        if len(trade_elements) != 4:
-            update.message.reply_text(
-                'A quick trade must be placed in the following format: \'/quicktrade buy 5 apple stock\''
+        session = self.sessions.get(update.effective_chat.id)
+        try:
+            trade = parse_quicktrade(update.message.text)
+            if trade is None:
+                return reply(update, QUICKTRADE_FORMAT)
+
+            instrument_list = find_instruments(trade.search, trade.instrument_type)
+            if eventlog.enabled(logging.DEBUG):
+                eventlog.event('instruments_found', logging.DEBUG, search=trade.search,
+                               isins=[instrument.isin for instrument in instrument_list])
+
+            # in case user searches for stock that is not offered, return a prompt to start and end the convo
+            if len(instrument_list) == 0:
+                return reply(update, INSTRUMENT_NOT_FOUND)
+
+            instrument = instrument_list[0]
+            # place the order and fetch the quote at the same time
+            order, latest_quote = fan_out(
+                lambda: client.trading.orders.create(isin=instrument.isin,
+                                                     expires_at=0,
+                                                     quantity=trade.quantity,
+                                                     side=trade.side,
+                                                     idempotency=idempotency_key(
+                                                         update.effective_chat.id,
+                                                         update.message.message_id)).results,
+                lambda: quote_feed.get(instrument.isin),
+                return_exceptions=True
             )
-            return ConversationHandler.END
-        else:
-            try:
-                side = trade_elements[0].lower()
-                quantity = int(trade_elements[1])
-                search = trade_elements[2].lower()
-                if trade_elements[3].lower().startswith('share'):
-                    instrument_type = 'stock'
-                else:
-                    instrument_type = trade_elements[3].lower()
+            return reply(update, confirm_quicktrade_order(session, trade, instrument, order, latest_quote))
 
-                instrument_list = client.market_data.instruments.get(search=search, type=instrument_type).results
-                print(f"Search of {search} gave instruments: {instrument_list}")
+        except Exception as e:
+            eventlog.error(e)
+            # the order exists if only the quote failed, so it is cancelled instead of left open
+            self.discard_order(session)
+            return reply(update, Step(ConversationHandler.END, QUICKTRADE_ERROR_MESSAGE))
 
-                # in case user searches for stock that is not offered, return a prompt to start and end the convo
-                if len(instrument_list) == 0:
-                    update.message.reply_text("Instrument not found, please be more specific. Use /start to try again.")
-                    return ConversationHandler.END
+    @metrics.timed
+    @conversation_step
+    def confirm_quicktrade(self, update: Update, context: CallbackContext) -> int:
+        """Activates quicktrade order."""
+        session = self.sessions.get(update.effective_chat.id)
+        step = check_quicktrade_confirmation(session, update.message.text)
+        if step is not None:
+            self.discard_order(session)
+            return reply(update, step)
 
-                instrument = instrument_list[0]
-                order = client.trading.orders.create(isin=instrument.isin,
-                                                     expires_at=0,
-                                                     quantity=quantity,
-                                                     side=side).results
-                context.chat_data['order_status'] = order.status
-                context.chat_data['order_id'] = order.id
+        try:
+            log_session(session)
+            client.trading.orders.activate(session.order_id)
+        except Exception as e:
+            eventlog.error(e)
+            return reply(update, Step(ConversationHandler.END, QUICKTRADE_ERROR_MESSAGE))
+        # once activated, the order must no longer be cancelled when the session expires
+        order_id, session.order_id = session.order_id, None
+        update.message.reply_text(PROCESSING_MESSAGE)
+        order_watcher.watch(order_id, update.effective_chat.id, context.bot)
+        return ConversationHandler.END
 
-                latest_quote = client.market_data.quotes.get_latest(isin=[instrument.isin]).results[0]
-                [context.chat_data['bid'], context.chat_data['ask']] = latest_quote.b, latest_quote.a
-                reply_keyboard = [['Confirm', 'Cancel']]
+    @metrics.timed
+    @conversation_step(entry=True)
+    def basket(self, update: Update, context: CallbackContext) -> int:
+        """Initiates basket sequence."""
+        session = self.sessions.get(update.effective_chat.id)
+        session.clear()
 
-                if side == 'buy':
-                    price = context.chat_data['ask']
-                else:
-                    price = context.chat_data['bid']
+        update.message.reply_text(
+            f'Please send up to {TradingBot.MAX_BASKET} quick trades, one per line in the following format: {FORMAT}'
+        )
+        return TradingBot.BASKET
+
+    @metrics.timed
+    @conversation_step
+    def perform_basket(self, update: Update, context: CallbackContext) -> int:
+        """Places all orders of a basket and asks for one confirmation."""
+        session = self.sessions.get(update.effective_chat.id)
+        orders, errors = parse_basket(update.message.text, TradingBot.MAX_BASKET)
+        if not orders:
+            update.message.reply_text('\n'.join(errors + ['No orders found, ending conversation.']))
+            return ConversationHandler.END
 
-                update.message.reply_text(
-                    f'You indicated that you wish to {side} {quantity} {instrument.name} {instrument_type} at €{price} '
-                    f'per share. Is that correct?',
-                    reply_markup=ReplyKeyboardMarkup(
-                        reply_keyboard, one_time_keyboard=True,
-                    ),
-                )
-                return TradingBot.QUICK
+        # every order is searched and created in its own call, so one slow search does not hold up the others
+        lock, abandoned = threading.Lock(), threading.Event()
+        run_bounded([functools.partial(self.create_basket_order, order,
+                                       idempotency_key(update.effective_chat.id, update.message.message_id, index),
+                                       lock, abandoned)
+                     for index, order in enumerate(orders)],
+                    max_parallel=TradingBot.BASKET_PARALLELISM, timeout=TradingBot.BASKET_TIMEOUT)
+        with lock:
+            # the orders created so far are the ones shown and activated; the others are cancelled once created
+            abandoned.set()
+            for order in orders:
+                if order.get('order_id') is None and not order.get('error') and order.get('status') != 'rejected':
+                    order['error'] = 'the order timed out'
+        # keep the created orders in the session first, so they are cancelled if the conversation expires
+        session.basket = orders
+        placed = [order for order in orders if order.get('order_id') is not None]
+        if not placed:
+            update.message.reply_text(
+                f'{summarise(orders, errors)}\n\nNone of the orders could be placed, ending conversation.')
+            return ConversationHandler.END
 
-            except Exception as e:
-                print(e)
-                update.message.reply_text(
-                    "There was an error, ending conversation.")
-                return ConversationHandler.END
+        try:
+            quotes = quote_feed.get_many({order['isin'] for order in placed}, missing_ok=True)
+        except Exception as e:
+            eventlog.error(e)
+            quotes = {}
+        for order in placed:
+            quote = quotes.get(order['isin'])
+            if quote is not None:
+                order['price'] = float(quote.a if order['side'] == 'buy' else quote.b)
 
-    def confirm_quicktrade(self, update: Update, context: CallbackContext) -> int:
-        """Activates quicktrade order."""
-        reply = update.message.text
-        if reply == 'Confirm':
-            if context.chat_data['order_status'] == 'rejected':
-                update.message.reply_text(
-                    "Insufficient holdings, ending conversation"
-                )
-                return ConversationHandler.END
-            try:
-                print(context.chat_data)
-                activate_order = client.trading.orders.activate(context.chat_data['order_id'])
-                update.message.reply_text(
-                    "Please wait while we process your order."
-                )
-                start = datetime.datetime.now()
-                while True and len(context.chat_data['order_id']) > 1:
-
-                    order_summary = client.trading.orders.get_order(
-                        context.chat_data['order_id']
-                    )
-                    if order_summary.results.status == 'executed':
-                        context.chat_data['average_price'] = order_summary.results.executed_price
-                        print('Quick-trade executed.')
-                        break
-                    elif datetime.datetime.now() - start >= datetime.timedelta(minutes=3):
-                        update.message.reply_text(
-                            'We\'re currently experiencing some delays. Your order was not executed. Please try again '
-                            'later. '
-                        )
-                        # delete inactive order
-                        client.trading.orders.cancel(context.chat_data['order_id'])
-                        return ConversationHandler.END
-                    time.sleep(2)
+        reply_keyboard = [['Confirm', 'Cancel']]
+        update.message.reply_text(
+            f'{summarise(orders, errors)}\n\nDo you want to place these {len(placed)} orders?',
+            reply_markup=ReplyKeyboardMarkup(
+                reply_keyboard, one_time_keyboard=True,
+            ),
+        )
+        return TradingBot.BASKET_CONFIRMATION
 
-                update.message.reply_text(
-                    f'Your order was executed at €{context.chat_data["average_price"] / 10000:,.2f} per share. '
-                )
-                return ConversationHandler.END
+    @staticmethod
+    def create_basket_order(order: dict, idempotency: str, lock: threading.Lock, abandoned: threading.Event) -> None:
+        """Resolves the instrument of a basket order and creates the order, noting any error on the order.
 
+        Once the basket is `abandoned`, i.e. summarised without waiting for this order any longer, the order is left
+        as it is and an order created after all is cancelled.
+        """
+        result = {}
+        try:
+            instrument_list = find_instruments(order['search'], order['type'])
+            if len(instrument_list) == 0:
+                result['error'] = 'instrument not found'
+            else:
+                instrument = instrument_list[0]
+                result['isin'], result['name'] = instrument.isin, instrument.name
+                created = client.trading.orders.create(isin=instrument.isin,
+                                                       expires_at=0,
+                                                       quantity=order['quantity'],
+                                                       side=order['side'],
+                                                       idempotency=idempotency).results
+                result['status'] = created.status
+                # rejected orders cannot be activated, so they are shown but not kept
+                if created.status != 'rejected':
+                    result['order_id'] = created.id
+        except Exception as e:
+            eventlog.error(e)
+            result['error'] = 'the order could not be placed'
+
+        with lock:
+            if not abandoned.is_set():
+                order.update(result)
+                return
+        if result.get('order_id') is not None:
+            eventlog.event('basket_order_abandoned', logging.WARNING, order_id=result['order_id'])
+            try:
+                client.trading.orders.cancel(result['order_id'])
             except Exception as e:
-                print(e)
-                update.message.reply_text(
-                    "There was an error, ending conversation.")
-                return ConversationHandler.END
-        elif reply == 'Cancel':
-            update.message.reply_text(
-                "You cancelled the order. Ending conversation.")
+                eventlog.error(e, order_id=result['order_id'])
 
+    @metrics.timed
+    @conversation_step
+    def confirm_basket(self, update: Update, context: CallbackContext) -> int:
+        """Activates all orders of a basket and reports each fill as it arrives."""
+        session = self.sessions.get(update.effective_chat.id)
+        reply = update.message.text
+        if reply == 'Cancel':
+            self.discard_order(session)
+            update.message.reply_text(
+                "You cancelled the orders. Ending conversation.", reply_markup=ReplyKeyboardRemove())
             return ConversationHandler.END
-        else:
+        if reply != 'Confirm':
+            self.discard_order(session)
             update.message.reply_text(
-                "There was an error, ending conversation.")
+                "There was an error, ending conversation.", reply_markup=ReplyKeyboardRemove())
+            return ConversationHandler.END
+
+        orders = [order for order in session.basket or () if order.get('order_id') is not None]
+        if not orders:
+            update.message.reply_text(ORDER_EXPIRED_MESSAGE, reply_markup=ReplyKeyboardRemove())
             return ConversationHandler.END
 
+        futures = run_bounded([functools.partial(client.trading.orders.activate, order['order_id'])
+                               for order in orders], max_parallel=TradingBot.BASKET_PARALLELISM)
+        activated = 0
+        failed = []
+        for order, future in zip(orders, futures):
+            if not future.done() or future.exception() is not None:
+                if future.done():
+                    eventlog.error(future.exception(), order_id=order['order_id'])
+                else:
+                    eventlog.event('activation_timed_out', logging.WARNING, order_id=order['order_id'])
+                failed.append(order)
+                continue
+            # once activated, the order must no longer be cancelled when the session expires
+            order_id, order['order_id'] = order['order_id'], None
+            activated += 1
+            description = f'{order["side"]} {order["quantity"]} {order["name"]}'
+            order_watcher.watch(order_id, update.effective_chat.id, context.bot,
+                                executed_text=f'Your order to {description} was executed at €{{price:,.2f}} '
+                                              f'per share.',
+                                failed_text=f'Your order to {description} was {{status}}.')
+        # orders that could not be activated are cancelled together with the session
+        self.discard_order(session)
+
+        lines = [f'{activated} of {len(orders)} orders were activated. '
+                 'You will get a message as soon as each one is executed.']
+        lines.extend(f'Could not activate the order to {order["side"]} {order["quantity"]} {order["name"]}.'
+                     for order in failed)
+        update.message.reply_text('\n'.join(lines), reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+
+    @metrics.timed
+    @conversation_step(entry=True)
     def trade(self, update: Update, context: CallbackContext) -> int:
         """Retrieves financial instrument type."""
-        context.chat_data.clear()
+        session = self.sessions.get(update.effective_chat.id)
         context.user_data.clear()
+        step = begin_trade(session)
+        log_session(session)
+        return reply(update, step)
 
-        reply_keyboard = [['Stock', 'ETF']]
-
-        print(f'chat_data {context.chat_data}')
-
-        update.message.reply_text(
-            'What type of instrument do you want to trade?',
-            reply_markup=ReplyKeyboardMarkup(
-                reply_keyboard, one_time_keyboard=True,
-            ),
-        )
-        return TradingBot.TYPE
-
+    @metrics.timed
+    @conversation_step
     def get_search_query(self, update: Update, context: CallbackContext) -> int:
         """Prompts user to enter instrument name."""
-        # store user response in dictionary with key 'type'
-        context.chat_data['type'] = update.message.text.lower()
-
-        print(f'chat_data {context.chat_data}')
-
-        update.message.reply_text(
-            f'What is the name of the {context.chat_data["type"]} you would like to trade?')
-
-        return TradingBot.REPLY
+        session = self.sessions.get(update.effective_chat.id)
+        step = choose_type(session, update.message.text)
+        log_session(session)
+        return reply(update, step)
 
+    @metrics.timed
+    @conversation_step
     def get_instrument_name(self, update: Update, context: CallbackContext) -> int:
         """Searches for instrument and prompts user to select an instrument."""
-        context.chat_data['search_query'] = update.message.text.lower()
+        session = self.sessions.get(update.effective_chat.id)
+        session.search_query = update.message.text.lower()
 
-        print(f'chat_data {context.chat_data}')
+        log_session(session)
 
         try:
-            instruments = client.market_data.instruments.get(search=context.chat_data['search_query'],
-                                                             type=context.chat_data['type']).results
+            instruments = find_instruments(session.search_query, session.type)
         except Exception as e:
-            print(e)
-            update.message.reply_text(
-                "There was an error, ending the conversation. If you'd like to try again, send /start.")
-            return ConversationHandler.END
-
-        names = [instrument.name for instrument in instruments]
-        names.append('Other')
-
-        reply_keyboard = [names]
-
-        update.message.reply_text(
-            f'Please choose the instrument you wish to trade. If you do not see the desired instrument, press "Other".',
-            reply_markup=ReplyKeyboardMarkup(
-                reply_keyboard, one_time_keyboard=True,
-            ),
-        )
-        return TradingBot.NAME
+            eventlog.error(e)
+            return reply(update, Step(ConversationHandler.END, ERROR_MESSAGE))
+        return reply(update, list_instruments(session, instruments))
 
+    @metrics.timed
+    @conversation_step
     def get_isin(self, update: Update, context: CallbackContext) -> int:
         """Retrieves ISIN and prompts user to select side (buy/sell)."""
-        text = update.message.text
-
-        try:
-            instrument = client.market_data.instruments.get(search=context.chat_data['search_query'],
-                                                            type=context.chat_data['type']).results[0]
-        except Exception as e:
-            print(e)
-            update.message.reply_text(
-                "There was an error, ending the conversation. If you'd like to try again, send /start.")
-            return ConversationHandler.END
-
-        if text == 'Other':
-            update.message.reply_text("Please be more specific in your search query.")
-            return TradingBot.REPLY
-
-        # if user chooses name, find isin
-        else:
-            context.chat_data['name'] = text
-            context.chat_data['isin'] = instrument.isin
-
-            reply_keyboard = [['Buy', 'Sell']]
-            update.message.reply_text(
-                f'Would you like to buy or sell {context.chat_data["name"]}?',
-                reply_markup=ReplyKeyboardMarkup(
-                    reply_keyboard, one_time_keyboard=True,
-                )
-            )
-            print(f'chat_data {context.chat_data}')
-
-            return TradingBot.ISIN
-
+        session = self.sessions.get(update.effective_chat.id)
+        step = choose_instrument(session, update.message.text)
+        if step.state == TradingBot.ISIN:
+            # start fetching what get_side needs while the user decides whether to buy or sell
+            session.prefetch = Prefetch(session.isin, trade_data_calls(session.isin))
+            log_session(session)
+        return reply(update, step)
+
+    @metrics.timed
+    @conversation_step
     def get_side(self, update: Update, context: CallbackContext) -> int:
         """Retrieves total balance (buy) or amount of shares owned (sell), most recent price and prompts user to
         indicate quantity. """
-        context.chat_data['side'] = update.message.text.lower()
+        session = self.sessions.get(update.effective_chat.id)
+        calls = choose_side(session, update.message.text, trade_data_calls(session.isin))
+
+        # quote, balance and (on sell) position were prefetched in get_isin, anything missing or stale is fetched
+        # concurrently now
+        prefetch, session.prefetch = session.prefetch or Prefetch(session.isin, {}), None
         try:
-            latest_quote = client.market_data.quotes.get_latest(context.chat_data['isin']).results[0]
-            [context.chat_data['bid'], context.chat_data['ask']] = latest_quote.b, latest_quote.a
-            context.chat_data['balance'] = client.trading.account.get().results.balance
+            step = ask_quantity(session, prefetch.collect(session.isin, calls))
         except Exception as e:
-            print(e)
-            update.message.reply_text(
-                "There was an error, ending the conversation. If you'd like to try again, send /start.")
-            return ConversationHandler.END
-
-        # if user chooses buy, present ask price, total balance and ask how many to buy
-        if context.chat_data['side'] == 'buy':
-            update.message.reply_text(
-                f'This instrument is currently trading for €{context.chat_data["ask"]}, your total balance is '
-                f'€{context.chat_data["balance"] / 10000:,.2f}. '
-                f'How many shares do you wish to {context.chat_data["side"]}?'
-            )
-        # if user chooses sell, retrieve how many shares owned
-        else:
-            positions = client.trading.positions.get(context.chat_data['isin'])
-            print(f"Your positions are: {positions}")
-
-            # initialise shares owned to 0
-            context.chat_data['shares_owned'] = 0
-
-            if len(positions.results) != 0:
-                context.chat_data['shares_owned'] = positions.results[0].quantity
-
-            update.message.reply_text(
-                f'This instrument can be sold for €{round(context.chat_data["bid"], 2)}, you currently own '
-                f'{context.chat_data["shares_owned"]} share(s). '
-                f'How many shares do you wish to {context.chat_data["side"]}?'
-            )
-
-            print(f'chat_data {context.chat_data}')
-
-        return TradingBot.SIDE
+            eventlog.error(e)
+            return reply(update, Step(ConversationHandler.END, ERROR_MESSAGE))
+        log_session(session)
+        return reply(update, step)
 
+    @metrics.timed
+    @conversation_step
     def get_quantity(self, update: Update, context: CallbackContext) -> int:
         """Processes quantity (handles error if purchase/sale not possible), places order (if possible) and prompts
         user to confirm order. """
-        context.chat_data['quantity'] = float(update.message.text.lower())
-
-        reply_keyboard = [['Confirm', 'Cancel']]
-
-        # if user indicates 0 to buy, then prompt to enter new amount or end current process
-        if context.chat_data['quantity'] == 0:
-            update.message.reply_text(
-                'You have indicated you do not wish to buy any shares, type '
-                '/cancel to abort this process or enter a new amount.'
-            )
-            return TradingBot.SIDE
-
-        # determine total cost of buy or sell
-        if context.chat_data['side'] == 'buy':
-            context.chat_data['total'] = context.chat_data['quantity'] * float(context.chat_data['ask'])
-        else:
-            context.chat_data['total'] = context.chat_data['quantity'] * float(context.chat_data['bid'])
-
-        # if buy and can't afford buy, prompt user to enter new amount
-        if context.chat_data['side'] == 'buy' and context.chat_data['total'] > context.chat_data['balance'] / 10000:
-            update.message.reply_text(
-                f'You do not have enough money to buy {context.chat_data["quantity"]} of {context.chat_data["name"]}. '
-                'Please enter a new amount.'
-            )
-            return TradingBot.SIDE
+        session = self.sessions.get(update.effective_chat.id)
+        step = check_quantity(session, update.message.text)
+        if step is not None:
+            return reply(update, step)
 
-        # if sell and don't have that many shares, prompt user to enter new amount
-        elif context.chat_data['side'] == 'sell' and context.chat_data['shares_owned'] < context.chat_data['quantity']:
-            update.message.reply_text(
-                f'You do not have enough shares of {context.chat_data["name"]}. '
-                'Please enter a new amount.'
-            )
-            return TradingBot.SIDE
-
-        # if quantity not an int, prompt user to enter new amount
-        elif not context.chat_data['quantity'].is_integer():
-            update.message.reply_text(
-                'You\'ve entered an invalid amount. Please try again.'
-            )
-            return TradingBot.SIDE
-
-        else:
-            try:
-                # place order
-                context.chat_data['order_id'] = \
-                    client.trading.orders.create(
-                        isin=context.chat_data['isin'],
-                        expires_at=0,
-                        side=context.chat_data['side'],
-                        quantity=context.chat_data['quantity']
-                    ).results.id
-            except Exception as e:
-                print(e)
-                update.message.reply_text(
-                    "There was an error, ending the conversation. If you'd like to try again, send /start.")
-                return ConversationHandler.END
-
-            update.message.reply_text(
-                f'You\'ve indicated that you wish to {context.chat_data["side"]} {int(context.chat_data["quantity"])} '
-                f'share(s) of {context.chat_data["name"]} at a total of €{round(context.chat_data["total"], 2)}. '
-                f'Please confirm or cancel your order to continue.',
-                reply_markup=ReplyKeyboardMarkup(
-                    reply_keyboard, one_time_keyboard=True,
-                )
-            )
-            print(f'chat_data {context.chat_data}')
-
-            return TradingBot.QUANTITY
+        try:
+            # place order
+            session.order_id = client.trading.orders.create(
+                isin=session.isin,
+                expires_at=0,
+                side=session.side,
+                quantity=int(session.quantity),
+                idempotency=idempotency_key(update.effective_chat.id, update.message.message_id)
+            ).results.id
+        except Exception as e:
+            eventlog.error(e)
+            return reply(update, Step(ConversationHandler.END, ERROR_MESSAGE))
+        log_session(session)
+        return reply(update, confirm_quantity(session))
 
+    @metrics.timed
+    @conversation_step
     def confirm_order(self, update: Update, context: CallbackContext) -> int:
         """Activates order (if applicable), displays purchase/sale price and prompts user to indicate whether any
         additional trades should be made. """
-        context.chat_data['order_decision'] = update.message.text
-        reply_keyboard = [['Yes', 'No']]
-
-        if context.chat_data['order_decision'] == 'Cancel':
-            update.message.reply_text(
-                'You\'ve cancelled your order. Would you like to make another trade?',
-                reply_markup=ReplyKeyboardMarkup(
-                    reply_keyboard, one_time_keyboard=True,
-                )
-            )
-        else:
-            try:
-                client.trading.orders.activate(
-                    context.chat_data['order_id'],
-                )
-            except Exception as e:
-                print(e)
-                update.message.reply_text(
-                    "There was an error, ending the conversation. If you'd like to try again, send /start.")
-                return ConversationHandler.END
-
-            # keep checking order status until executed so that execution price can be retrieved
-            update.message.reply_text(
-                'Please wait while we process your order.'
-            )
-            while True:
-                order_summary = client.trading.orders.get_order(
-                    context.chat_data['order_id'],
-                )
-                if order_summary.results.status == 'executed':
-                    print('Trade executed.')
-                    break
-                time.sleep(2)
-
-            context.chat_data['average_price'] = order_summary.results.executed_price
-
-            update.message.reply_text(
-                f'Your order was executed at €{context.chat_data["average_price"] / 10000:,.2f} per share. '
-                'Would you like to make another trade?',
-                reply_markup=ReplyKeyboardMarkup(
-                    reply_keyboard, one_time_keyboard=True
-                )
-            )
-        print(f'chat_data {context.chat_data}')
+        session = self.sessions.get(update.effective_chat.id)
+        step = check_order_confirmation(session, update.message.text)
+        if step is not None:
+            self.discard_order(session)
+            return reply(update, step)
 
+        try:
+            client.trading.orders.activate(session.order_id)
+        except Exception as e:
+            eventlog.error(e)
+            return reply(update, Step(ConversationHandler.END, ERROR_MESSAGE))
+        # once activated, the order must no longer be cancelled when the session expires
+        order_id, session.order_id = session.order_id, None
+
+        # the order watcher reports the execution price once the order is executed
+        update.message.reply_text(PROCESSING_MESSAGE)
+        watch_trade_order(order_id, update.effective_chat.id, context.bot)
+        log_session(session)
         return TradingBot.CONFIRMATION
 
+    @metrics.timed
+    @conversation_step
     def complete_order(self, update: Update, context: CallbackContext) -> int:
         """Prompts user to continue or end conversation."""
-        if update.message.text == 'Yes':
-            context.chat_data.clear()
-            reply_keyboard = [['Stock', 'ETF']]
-            update.message.reply_text(
-                'What type of instrument do you want to trade?',
-                reply_markup=ReplyKeyboardMarkup(
-                    reply_keyboard, one_time_keyboard=True,
-                ),
-            )
-            return TradingBot.TYPE
-        else:
-            update.message.reply_text(
-                "Bye! Come back and send /start if you would like to make any other trades.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            return ConversationHandler.END
+        session = self.sessions.get(update.effective_chat.id)
+        return reply(update, complete_trade(session, update.message.text))
 
+    @metrics.timed
+    @conversation_step(entry=True)
     def cancel(self, update: Update, context: CallbackContext) -> int:
         """Cancels and ends the conversation."""
-        update.message.reply_text(
-            "Bye! Come back and send /start if you would like to make any other trades.",
-            reply_markup=ReplyKeyboardRemove()
-        )
-        print(f'chat_data {context.chat_data}')
-        return ConversationHandler.END
+        session = self.sessions.get(update.effective_chat.id)
+        self.discard_order(session)
+        log_session(session)
+        return reply(update, Step(ConversationHandler.END, BYE_MESSAGE, ReplyKeyboardRemove()))
 
+    @metrics.timed
     def to_the_moon(self, update: Update, context: CallbackContext):
         """Randomly prints a meme stock."""
         try:
-            # GME, BB, CLOV, AMC, PLTR, WISH, NIO, TSLA, Tilray, NOK
-            memes = ['US36467W1099', 'CA09228F1036', 'US18914F1030', 'US00165C1045', 'US69608A1088', 'US21077C1071',
-                     'US62914V1061', 'US88160R1014', 'US88688T1007', 'FI0009000681']
-            meme_stock = client.market_data.instruments.get(isin=[random.choice(memes)]).results[0].title
+            meme_isin = random.choice(MEME_ISINS)
+            meme_stock = meme_titles.get(meme_isin)
+            if meme_stock is None:
+                instrument = instrument_index.get(meme_isin) or \
+                    client.market_data.instruments.get(isin=[meme_isin]).results[0]
+                meme_stock = meme_titles[meme_isin] = instrument.title
         except Exception as e:
-            print(e)
-            update.message.reply_text(
-                "There was an error, ending the conversation. If you'd like to try again, send /start.")
+            eventlog.error(e)
+            update.message.reply_text(ERROR_MESSAGE)
             return ConversationHandler.END
 
         update.message.reply_text(
             f'{meme_stock} to the moon 🚀'
         )
 
-    def show_positions(self, update: Update):
+    @metrics.timed
+    def show_positions(self, update: Update, context: CallbackContext):
+        """Lists positions, queued in the outbox so a large portfolio goes out in a few merged messages."""
         try:
             positions = client.trading.positions.get().results
-            print(f" Your positions are: {positions}")
+            eventlog.event('positions', logging.DEBUG, positions=len(positions))
         except Exception as e:
-            print(e)
-            update.message.reply_text(
-                "There was an error, ending the conversation. If you'd like to try again, send /start.")
+            eventlog.error(e)
+            update.message.reply_text(ERROR_MESSAGE)
             return ConversationHandler.END
 
         for position in positions:
@@ -495,10 +948,149 @@ class TradingBot:
             average_price = position.buy_price_avg
 
             if quantity != 0:
-                update.message.reply_text(
+                outbox.send(
+                    context.bot,
+                    update.effective_chat.id,
                     f'Name: {name}\n'
                     f'Quantity: {quantity}\n'
                     f'Average Price: €{average_price / 10000:,.2f}'
                 )
 
         return ConversationHandler.END
+
+    @metrics.timed
+    def show_portfolio(self, update: Update, context: CallbackContext):
+        """Sends the value, unrealised profit and loss and weight of all positions in a single message."""
+        try:
+            snapshot = portfolio_valuer.snapshot()
+        except Exception as e:
+            eventlog.error(e)
+            update.message.reply_text(ERROR_MESSAGE)
+            return ConversationHandler.END
+
+        update.message.reply_text(snapshot.render())
+        return ConversationHandler.END
+
+    @metrics.timed
+    def alert(self, update: Update, context: CallbackContext):
+        """Sets a price alert, or lists the chat's alerts when sent without arguments."""
+        chat_id = update.effective_chat.id
+        args = context.args or []
+        if not args:
+            alerts = alert_book.of_chat(chat_id)
+            if not alerts:
+                update.message.reply_text(
+                    'You have no price alerts. Set one with \'/alert apple above 150\'.')
+                return
+            lines = [f'{number}. {alert.describe()}' for number, alert in enumerate(alerts, 1)]
+            update.message.reply_text('Your price alerts:\n' + '\n'.join(lines) + '\n\nRemove one with /unalert 1.')
+            return
+
+        try:
+            direction = args[-2].lower()
+            price = float(args[-1].replace(',', '.').lstrip('€'))
+            if len(args) < 3 or direction not in ('above', 'below') or price <= 0:
+                raise ValueError
+        except (IndexError, ValueError):
+            update.message.reply_text('An alert must be set in the following format: \'/alert apple above 150\'')
+            return
+
+        try:
+            instrument = resolve_instrument(' '.join(args[:-2]))
+        except Exception as e:
+            eventlog.error(e)
+            update.message.reply_text("There was an error, please try again.")
+            return
+        if instrument is None:
+            update.message.reply_text('Instrument not found, please be more specific.')
+            return
+
+        alert = Alert(chat_id, instrument.isin, instrument.name, direction, price)
+        try:
+            alert_book.add(alert)
+        except ValueError as e:
+            update.message.reply_text(str(e))
+            return
+        update.message.reply_text(f'I\'ll let you know once {alert.describe()}.')
+
+    @metrics.timed
+    def unalert(self, update: Update, context: CallbackContext):
+        """Removes a price alert by its number in the /alert list."""
+        alerts = alert_book.of_chat(update.effective_chat.id)
+        try:
+            alert = alerts[int(context.args[0]) - 1]
+        except (IndexError, TypeError, ValueError):
+            update.message.reply_text('Please send the number of the alert from the /alert list, e.g. /unalert 1.')
+            return
+        alert_book.remove(alert.alert_id)
+        update.message.reply_text(f'Removed the alert for {alert.describe()}.')
+
+    @metrics.timed
+    def watch(self, update: Update, context: CallbackContext):
+        """Adds an instrument to the chat's watchlist, or shows the watchlist with its latest prices."""
+        chat_id = update.effective_chat.id
+        if context.args:
+            try:
+                instrument = resolve_instrument(' '.join(context.args))
+            except Exception as e:
+                eventlog.error(e)
+                update.message.reply_text("There was an error, please try again.")
+                return
+            if instrument is None:
+                update.message.reply_text('Instrument not found, please be more specific.')
+                return
+            try:
+                added = watchlists.add(chat_id, instrument.isin, instrument.name)
+            except ValueError as e:
+                update.message.reply_text(str(e))
+                return
+            update.message.reply_text(
+                f'Added {instrument.name} to your watchlist.' if added else f'You already watch {instrument.name}.')
+            return
+
+        entries = watchlists.get(chat_id)
+        if not entries:
+            update.message.reply_text('Your watchlist is empty. Add an instrument with \'/watch apple\'.')
+            return
+        try:
+            # one batched quote request for the whole watchlist
+            quotes = quote_feed.get_many([isin for isin, name in entries], missing_ok=True)
+        except Exception as e:
+            eventlog.error(e)
+            quotes = {}
+        lines = []
+        for isin, name in entries:
+            quote = quotes.get(isin)
+            prices = f'bid €{quote.b:,.2f}, ask €{quote.a:,.2f}' if quote is not None else 'no quote'
+            lines.append(f'{name} ({isin}): {prices}')
+        update.message.reply_text('\n'.join(lines))
+
+    @metrics.timed
+    def unwatch(self, update: Update, context: CallbackContext):
+        """Removes an instrument from the chat's watchlist by ISIN or name."""
+        chat_id = update.effective_chat.id
+        query = ' '.join(context.args or []).lower()
+        for isin, name in watchlists.get(chat_id):
+            if query and (query == isin.lower() or query in name.lower()):
+                watchlists.remove(chat_id, isin)
+                update.message.reply_text(f'Removed {name} from your watchlist.')
+                return
+        update.message.reply_text('That instrument is not on your watchlist, send /watch to see it.')
+
+    @metrics.timed
+    def check_alerts(self, context: CallbackContext) -> None:
+        """Periodic job that quotes every ISIN with alerts in batches and notifies the chats whose alerts fire."""
+        isins = alert_book.isins()
+        if not isins:
+            return
+        try:
+            quotes = quote_feed.get_many(isins, missing_ok=True)
+        except Exception as e:
+            eventlog.error(e)
+            return
+        for isin, quote in quotes.items():
+            for alert in alert_book.check(isin, quote.b, quote.a):
+                price = quote.b if alert.direction == 'above' else quote.a
+                outbox.send(context.bot, alert.chat_id,
+                            f'Price alert: {alert.name} ({alert.isin}) is now {alert.direction} '
+                            f'€{alert.price:,.2f} at €{price:,.2f}.')
@@ -0,0 +1,208 @@
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from instrument_cache import TTLCache
+
+# (connect, read) timeouts in seconds per endpoint, keyed on the first path segment after the API version
+ENDPOINT_TIMEOUTS = {
+    'quotes': (2.0, 3.0),
+    'instruments': (2.0, 5.0),
+    'venues': (2.0, 5.0),
+    'account': (2.0, 5.0),
+    'positions': (2.0, 5.0),
+    'orders': (2.0, 10.0),
+}
+DEFAULT_TIMEOUT = (2.0, 5.0)
+
+# endpoints whose last good response may be served while the API is unavailable; trading data such as order
+# status or balances must never be answered from a stale copy
+STALE_ENDPOINTS = ('quotes', 'instruments', 'venues')
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of sending a request while the circuit breaker of its host is open."""
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and lets a single trial request through after `cooldown`."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class TransportSession(requests.Session):
+    """Session for the lemon client with a sized keep-alive pool, per-endpoint timeouts, jittered retries for
+    idempotent reads and a circuit breaker per API host that fails fast and serves stale market data instead.
+    """
+
+    def __init__(self, pool_size: int = 32, retries: int = 2, backoff: float = 0.2, breaker_threshold: int = 5,
+                 breaker_cooldown: float = 30.0, stale_ttl: float = 300.0):
+        super().__init__()
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.stale_ttl = stale_ttl
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.retried = 0
+        self.stale_served = 0
+
+        # url -> last successful response of a stale-tolerant endpoint
+        self._last_good = TTLCache(maxsize=2048, ttl=stale_ttl)
+        self._lock = threading.Lock()
+
+        # retries are handled here, so the adapter must not retry on its own
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+            return self.breakers[host]
+
+    def attempts(self, method: str) -> int:
+        """Returns how often a request is tried: idempotent reads are retried, anything else is sent once."""
+        return self.retries + 1 if method.upper() == 'GET' else 1
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Returns the seconds to wait before retrying after `attempt` failed."""
+        self.retried += 1
+        # full jitter keeps retries of many threads from hitting the API in lockstep
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        """Sends a request and records its latency and whether it failed, per API operation."""
+        operation = metrics.operation(method, urlsplit(url).path)
+        started = time.perf_counter()
+        try:
+            response = self._request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.upstream_errors.inc(operation)
+            raise
+        finally:
+            metrics.upstream_seconds.observe(time.perf_counter() - started, operation)
+        if response.status_code >= 400:
+            metrics.upstream_errors.inc(operation)
+        return response
+
+    def _request(self, method, url, *args, **kwargs) -> requests.Response:
+        parts = urlsplit(url)
+        endpoint = endpoint_of(parts.path)
+        kwargs['timeout'] = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        breaker = self.breaker(parts.netloc)
+        idempotent = method.upper() == 'GET'
+        attempts = self.attempts(method)
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                return self._stale_or_raise(endpoint, url, kwargs.get('params'),
+                                            CircuitOpenError(f'{parts.netloc} is unavailable, failing fast'))
+            response = None
+            error = None
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                # settle a half-open trial whatever happened, also when the request failed with another error such
+                # as a broken chunked response, or the breaker would stay half-open for good
+                if response is not None and response.status_code < 500:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+
+            if response is not None:
+                if response.status_code < 500:
+                    if idempotent and response.ok and endpoint in STALE_ENDPOINTS:
+                        self._last_good.set(self._cache_key(url, kwargs.get('params')), response)
+                    if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                        return response
+                elif attempt == attempts - 1:
+                    return self._stale_or_return(endpoint, url, kwargs.get('params'), response)
+
+            if attempt < attempts - 1:
+                time.sleep(self.backoff_delay(attempt))
+            elif error is not None:
+                return self._stale_or_raise(endpoint, url, kwargs.get('params'), error)
+
+    @staticmethod
+    def _cache_key(url: str, params) -> str:
+        return f'{url}?{sorted(params.items()) if isinstance(params, dict) else params}'
+
+    def _stale(self, endpoint: str, url: str, params) -> Optional[requests.Response]:
+        if endpoint not in STALE_ENDPOINTS:
+            return None
+        return self._last_good.get(self._cache_key(url, params))
+
+    def _stale_or_raise(self, endpoint: str, url: str, params, error: Exception) -> requests.Response:
+        stale = self._stale(endpoint, url, params)
+        if stale is None:
+            raise error
+        self.stale_served += 1
+        return stale
+
+    def _stale_or_return(self, endpoint: str, url: str, params, response: requests.Response) -> requests.Response:
+        stale = self._stale(endpoint, url, params)
+        if stale is None:
+            return response
+        self.stale_served += 1
+        return stale
+
+
+def endpoint_of(path: str) -> str:
+    # '/v1/quotes/latest' -> 'quotes'
+    segments = [segment for segment in path.split('/') if segment]
+    return segments[1] if len(segments) > 1 else ''
+
+
+def install(client, session: Optional[TransportSession] = None, **kwargs) -> TransportSession:
+    """Replaces the HTTP sessions of a lemon client's market data and trading APIs with one `TransportSession`,
+    `session` if given or a new one created with `kwargs`."""
+    if session is None:
+        session = TransportSession(**kwargs)
+    for api in (client.market_data, client.trading):
+        api._session.close()
+        api._session = session
+    return session
@@ -0,0 +1,130 @@
+import datetime
+import threading
+import time
+from typing import Optional
+
+import eventlog
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+
+class VenueCalendar:
+    """Keeps the opening days and hours of a trading venue and answers `is_open` from the local clock.
+
+    The venue is fetched once and then only refreshed at the next opening or closing time, or after `ttl`
+    seconds, whichever comes first. Refreshes happen in a background thread, so handlers never wait on the API
+    once the calendar has been loaded. With a `shared` cache, the venue is fetched once for all processes.
+    """
+
+    def __init__(self, client, mic: Optional[str], ttl: float = 6 * 60 * 60, shared=None):
+        self.client = client
+        self.mic = mic
+        self.ttl = ttl
+        self.shared = shared
+
+        self._venue = None
+        self._valid_until = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+        # set once the first attempt to load the venue has finished
+        self.loaded = threading.Event()
+
+    def start(self) -> None:
+        """Loads the venue and keeps it up to date in the background."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='venue-calendar', daemon=True)
+            self._thread.start()
+
+    @property
+    def venue(self):
+        """Returns the cached venue, only fetching it if it has never been loaded."""
+        if self._venue is None:
+            with self._lock:
+                if self._venue is None:
+                    self.refresh()
+        return self._venue
+
+    def refresh(self) -> None:
+        key = f'venue:{self.mic}'
+        fetched = False
+        try:
+            venue = self.shared.get(key) if self.shared is not None else None
+            if venue is None:
+                venue = self.client.market_data.venues.get(self.mic).results[0]
+                fetched = True
+            self._venue = venue
+        except Exception as e:
+            if self._venue is None:
+                raise
+            # keep answering from the last known schedule and try again in a minute
+            eventlog.error(e)
+            self._valid_until = time.time() + 60
+            return
+
+        boundary = self._next_boundary(self.now())
+        valid_until = time.time() + self.ttl
+        if boundary is not None:
+            valid_until = min(valid_until, boundary.timestamp())
+        self._valid_until = valid_until
+        if fetched and self.shared is not None:
+            self.shared.set(key, self._venue, valid_until - time.time())
+
+    def now(self) -> datetime.datetime:
+        """Returns the current time in the venue's time zone."""
+        return datetime.datetime.now(self._timezone())
+
+    def is_open(self, now: Optional[datetime.datetime] = None) -> bool:
+        """Returns whether the venue is open at `now` (default: the current time)."""
+        venue = self.venue
+        now = now or self.now()
+        return now.date() in venue.opening_days and \
+            venue.opening_hours.start <= now.time().replace(tzinfo=None) < venue.opening_hours.end
+
+    def next_opening(self, now: Optional[datetime.datetime] = None) -> Optional[datetime.datetime]:
+        """Returns the next time the venue opens after `now`, or None if no opening day is known."""
+        venue = self.venue
+        now = now or self.now()
+        for day in sorted(venue.opening_days):
+            opening = self._at(day, venue.opening_hours.start)
+            if opening > now:
+                return opening
+        return None
+
+    def _next_boundary(self, now: datetime.datetime) -> Optional[datetime.datetime]:
+        """Returns the next opening or closing time after `now`."""
+        venue = self._venue
+        for day in sorted(venue.opening_days):
+            for moment in (venue.opening_hours.start, venue.opening_hours.end):
+                boundary = self._at(day, moment)
+                if boundary > now:
+                    return boundary
+        return None
+
+    def _at(self, day: datetime.date, moment: datetime.time) -> datetime.datetime:
+        return datetime.datetime.combine(day, moment.replace(tzinfo=None), tzinfo=self._timezone())
+
+    def _timezone(self) -> Optional[datetime.tzinfo]:
+        # the lemon client attaches a pytz time zone to the opening hours, which must not be passed to
+        # datetime.combine directly, so look it up by name instead
+        start = getattr(getattr(self._venue, 'opening_hours', None), 'start', None)
+        name = getattr(getattr(start, 'tzinfo', None), 'zone', None)
+        if name and ZoneInfo is not None:
+            try:
+                return ZoneInfo(name)
+            except Exception:
+                pass
+        return datetime.datetime.now().astimezone().tzinfo
+
+    def _run(self) -> None:
+        while True:
+            try:
+                with self._lock:
+                    self.refresh()
+            except Exception as e:
+                eventlog.error(e)
+                self._valid_until = time.time() + 60
+            self.loaded.set()
+            time.sleep(max(self._valid_until - time.time(), 1))
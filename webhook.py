@@ -0,0 +1,84 @@
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    server: 'WebhookServer'
+
+    def do_POST(self) -> None:
+        if self.path.rstrip('/') != self.server.url_path:
+            self._respond(404)
+            return
+        secret_token = self.server.secret_token
+        if not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), secret_token):
+            self._respond(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._respond(400)
+            return
+
+        # hand the update straight to the dispatcher, or the ingress of a sharded deployment, and answer Telegram
+        # right away
+        if self.server.route is not None:
+            self.server.route(data)
+        else:
+            dispatcher = self.server.dispatcher
+            dispatcher.update_queue.put(Update.de_json(data, dispatcher.bot))
+        self._respond(200)
+
+    def _respond(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        # every update would otherwise be written to stderr
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """Embedded HTTP listener that receives updates pushed by Telegram and queues them for the dispatcher.
+
+    Requests without `secret_token` in the X-Telegram-Bot-Api-Secret-Token header are refused. If `route` is given,
+    updates are passed to it in Telegram's JSON format instead and there is no dispatcher.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, dispatcher: Optional[Dispatcher], listen: str = '0.0.0.0', port: int = 8443,
+                 url_path: str = 'telegram', secret_token: str = '',
+                 route: Optional[Callable[[dict], None]] = None):
+        if not secret_token:
+            raise ValueError('a secret token is required, anyone could send the bot updates otherwise')
+        super().__init__((listen, port), _WebhookRequestHandler)
+        self.dispatcher = dispatcher
+        self.route = route
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token
+
+    def start(self) -> threading.Thread:
+        """Starts the dispatcher and serves webhook requests from a background thread."""
+        if self.dispatcher is not None:
+            threading.Thread(target=self.dispatcher.start, name='dispatcher', daemon=True).start()
+        thread = threading.Thread(target=self.serve_forever, name='webhook', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self.dispatcher is not None:
+            self.dispatcher.stop()